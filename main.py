@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -10,19 +11,27 @@ from dotenv import load_dotenv
 from interactions import (Activity, Client, Intents, IntervalTrigger, Task,
                           listen, slash_command)
 from interactions.api.events import MessageCreate
-from openai import (APITimeoutError, AsyncOpenAI, BadRequestError,
+from openai import (APITimeoutError, BadRequestError, OpenAIError,
                     RateLimitError)
 
 load_dotenv() # Needs to be here for OpenAI
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
-from src.chatGPT import respondWithChatGPT
+from src.channelWorkers import channel_workers
+from src.chatGPT import (chatGPTReply, chatGPTTripped, respondWithChatGPT,
+                         summarizeHistory)
+from src.database.conversation_store import get_conversation_store
+from src.database.memory_journal import get_memory_journal
 from src.database.supabase_client import get_client
 from src.gptMemory import memory
 from src.listeners.gameRoast import roast_for_bad_game
 from src.mistral import respondWithMistral
+from src.modelRouter import CHATGPT, Decision, TurnFeatures, router
 from src.moderation import flagged_by_moderation
+from src.utils.deadline import (FALLBACK_RESERVE, Deadline, DeadlineExceeded,
+                                current_deadline, within_deadline)
 from src.utils.describeImage import describe_image
+from src.utils.retrieval import get_retrieval_index
 
 # !!! NOTE TO SELF: Heroku logging is a pain. If you don't see a print(), add sys.stdout.flush() !!!
 
@@ -42,6 +51,12 @@ APPLICATION_IDS = {
 }
 
 EVERY_24_HOURS = 60 * 60 * 24
+# Run several worker processes by giving each its own SHARD_ID; they share conversations through MEMORY_STORE
+SHARD_ID = int(os.getenv('SHARD_ID', 0))
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 1))
+MEMORY_SWEEP_INTERVAL = 60
+# Moderation is only a routing hint, so a slow check is skipped rather than holding up the reply
+MODERATION_TIMEOUT = 5
 
 PRESENCE_OBJECTS = json.load(open("resources/bot_presence.json"))
 
@@ -61,10 +76,17 @@ logging.getLogger().addHandler(stdoutHandler)
 COMMAND_POST_URL = "https://discord.com/api/v8/applications/923647717375344660/commands"
 COMMAND_POST_GUILD_URL = "https://discord.com/api/v8/applications/923647717375344660/guilds/367865912952619018/commands"
 
-client = AsyncOpenAI()
+# Only used when MEMORY_COMPACTION is enabled
+memory.summarizer = summarizeHistory
+memory.store = get_conversation_store()
+memory.retrieval = get_retrieval_index()
+memory_journal = get_memory_journal()
+if memory_journal is not None:
+    memory_journal.restore(memory)
 
 # Create bot and load extensions
-bot = Client(token=TOKEN, intents=Intents.DEFAULT | Intents.MESSAGE_CONTENT | Intents.GUILD_PRESENCES | Intents.GUILD_MEMBERS)
+bot = Client(token=TOKEN, intents=Intents.DEFAULT | Intents.MESSAGE_CONTENT | Intents.GUILD_PRESENCES | Intents.GUILD_MEMBERS,
+             shard_id=SHARD_ID, total_shards=SHARD_COUNT)
 
 # Load all extensions
 bot.load_extension('src.commands.ip')
@@ -74,6 +96,7 @@ bot.load_extension('src.commands.mock')
 bot.load_extension('src.commands.quote')
 bot.load_extension('src.commands.imageGeneration')
 bot.load_extension('src.commands.remind')
+bot.load_extension('src.commands.stats')
 
 
 @Task.create(IntervalTrigger(EVERY_24_HOURS))
@@ -91,20 +114,47 @@ async def on_ready():
     await update_presence()
     update_presence.start()
     cleanup_old_reminders.start()
+    if memory.store is not None:
+        cleanup_stored_conversations.start()
+    sweep_conversations.start()
     print("Connected to Discord! Running in {} mode.".format(ENVTYPE))
     print("Interactions version: {}".format(interactions.__version__))
     sys.stdout.flush()
 
 # compubot ChatGPT
 
-async def gptHandleMessage(message: interactions.Message):
-    # Check for images
-    image_links = []
+def get_image_links(message: interactions.Message):
     if len(message.embeds) > 0 or len(message.attachments) > 0:
-        image_links = [
+        return [
             *[embed.url or embed.image.url for embed in message.embeds],
             *[attach.url for attach in message.attachments]
         ]
+    return []
+
+
+# Known sizes of the images in a message, so their prompt tokens can be counted before sending
+def get_image_sizes(message: interactions.Message):
+    images = [*[embed.image for embed in message.embeds if embed.image], *message.attachments]
+    return {image.url: (image.width, image.height) for image in images if image.width and image.height}
+
+
+# Handle a burst of mentions from one channel with a single completion and reply
+async def gptHandleMessage(messages: list[interactions.Message]):
+    message = messages[-1]
+    await memory.load(message.channel.id)
+    try:
+        await respondToMessages(messages)
+    finally:
+        await memory.flush(message.channel.id)
+
+
+async def respondToMessages(messages: list[interactions.Message]):
+    message = messages[-1]
+
+    # Check for images
+    image_links = [link for msg in messages for link in get_image_links(msg)]
+    image_sizes = {url: size for msg in messages for url, size in get_image_sizes(msg).items()}
+    if len(image_links) > 0:
         print(image_links)
         # for url in image_links:
         #     try:
@@ -114,20 +164,81 @@ async def gptHandleMessage(message: interactions.Message):
         #     except BadRequestError:
         #         memory.append(message.channel_id, "{} uploaded a file that is too large (5MB max).".format(message.author.username), role="system")
 
-    clean_content = message.content.replace(
-        '<@{}>'.format(APPLICATION_IDS[ENVTYPE]), 'compubot')
+    clean_contents = [msg.content.replace(
+        '<@{}>'.format(APPLICATION_IDS[ENVTYPE]), 'compubot') for msg in messages]
 
-    memory.append(message.channel.id, '{}: """{}"""'.format(
-        message.author.username, clean_content))
+    for msg, clean_content in zip(messages, clean_contents):
+        memory.append(msg.channel.id, clean_content, author=msg.author.username)
+
+    try:
+        flagged = await within_deadline(flagged_by_moderation(clean_contents), MODERATION_TIMEOUT)
+    except asyncio.TimeoutError:
+        print('Moderation timed out, carrying on without it.')
+        flagged = False
+    features = TurnFeatures(clean_contents, image_links, memory.prompt_tokens(message.channel.id),
+                            offensive=flagged or memory.is_offensive(message.channel.id))
+    decision = router.route(features)
+    with router.turn(decision):
+        await respondWithModel(decision, message, image_links, image_sizes)
+
+
+# Reply with the routed model. ChatGPT falls back to Mistral if it refuses or its circuit trips
+async def respondWithModel(decision: Decision, message: interactions.Message, image_links: list[str], image_sizes: dict):
+    if decision.provider == CHATGPT:
+        print("NON-MISTRAL CALL ({})".format(decision.model))
+        reply = chatGPTReply(message, decision.model)
+        try:
+            shouldGoToMistral = await respondWithChatGPT(memory=memory, message=message, image_links=image_links,
+                                                         model=decision.model, image_sizes=image_sizes, reply=reply)
+        except OpenAIError:
+            if not chatGPTTripped(decision.model):
+                raise
+            print("ChatGPT circuit opened, failing over to Mistral")
+            shouldGoToMistral = True
+        if not shouldGoToMistral:
+            return
+        decision.fell_back = True
+        await respondWithMistral(memory=memory, message=message, reply=reply)
+        return
+    print("MISTRAL CALL ({})".format(decision.model))
+    await respondWithMistral(memory=memory, message=message, model=decision.model)
+
+
+# Sent when a turn runs out of time before anything was posted
+TIMEOUT_REPLIES = [
+    'my brain just blue screened, ask me again',
+    'nah that took way too long, try again',
+    'servers are cooked rn, gimme a sec and ask again',
+]
+
+
+async def sendTimeoutReply(message: interactions.Message):
+    try:
+        await asyncio.wait_for(message.reply(random.choice(TIMEOUT_REPLIES)), FALLBACK_RESERVE)
+    except Exception as err:
+        print('Could not send the timeout reply: ', err)
 
-    shouldGoToMistral = flagged_by_moderation(clean_content) or memory.is_offensive(message.channel.id)
-    # Try ChatGPT, then skip to mistral if it fails anyway
-    if not shouldGoToMistral:
-        print("NON-MISTRAL CALL")
-        shouldGoToMistral = await respondWithChatGPT(memory=memory, message=message, image_links=image_links)
-    if shouldGoToMistral:
-        print("MISTRAL CALL")
-        await respondWithMistral(memory=memory, message=message)
+
+# The deadline starts when the worker takes the batch off the queue, so time spent
+# waiting behind another turn in the channel doesn't count against it
+async def handleTurn(messages: list[interactions.Message]):
+    deadline = Deadline()
+    current_deadline.set(deadline)
+    try:
+        await gptHandleMessage(messages)
+    except DeadlineExceeded:
+        print('Ran out of time replying in {}.'.format(messages[-1].channel.id))
+        if not deadline.replied:
+            await sendTimeoutReply(messages[-1])
+    except APITimeoutError:
+        print('ChatGPT API timed out.')
+    except RateLimitError as err:
+        print('Hit rate limit: ', err)
+    except Exception as err:
+        print('An unknown error has occurred: ', err)
+        raise err
+
+channel_workers.handler = handleTurn
 
 
 # Event handlers
@@ -144,15 +255,9 @@ async def on_message_create(event: MessageCreate):
         or channel.type == interactions.ChannelType.DM) \
             and bot_user.id != event.message.author.id \
             and event.message.content:
-        try:
-            await gptHandleMessage(event.message)
-        except APITimeoutError:
-            print('ChatGPT API timed out.')
-        except RateLimitError as err:
-            print('Hit rate limit: ', err)
-        except Exception as err:
-            print('An unknown error has occurred: ', err)
-            raise err
+        # Turns are queued per channel so each one finishes before the next starts,
+        # and mentions that arrive together are answered together
+        channel_workers.submit(channel.id, event.message)
 
     if event.message.content and 'cock' in event.message.content.lower():
         await event.message.create_reaction('YEP:1088687844148641902')
@@ -163,20 +268,36 @@ async def on_message_create(event: MessageCreate):
     description="make compubot forget the conversation you're having"
 )
 async def forget(ctx: interactions.SlashContext):
-    if memory.has_conversation(ctx.channel_id):
-        memory.clear(ctx.channel_id)
+    if await channel_workers.run(ctx.channel_id, lambda: forgetConversation(ctx.channel_id)):
         await ctx.send('... What were we just talking about?')
     else:
         await ctx.send('We weren\'t talking about anything.')
 
 
+# Run on the channel's worker, so these never land in the middle of a turn
+async def forgetConversation(channel_id):
+    await memory.load(channel_id)
+    if not memory.has_conversation(channel_id):
+        return False
+    await memory.clear(channel_id)
+    return True
+
+
+async def sikeConversation(channel_id):
+    await memory.load(channel_id)
+    if not memory.has_conversation(channel_id):
+        return False
+    memory.sike(channel_id)
+    await memory.flush(channel_id)
+    return True
+
+
 @slash_command(
     name="sike",
     description="make compubot forget the last message"
 )
 async def sike(ctx: interactions.SlashContext):
-    if memory.has_conversation(ctx.channel_id):
-        memory.sike(ctx.channel_id)
+    if await channel_workers.run(ctx.channel_id, lambda: sikeConversation(ctx.channel_id)):
         await ctx.send('... Huh?')
     else:
         await ctx.send('We weren\'t talking about anything.')
@@ -193,4 +314,28 @@ async def cleanup_old_reminders():
     except Exception as e:
         logging.error(f"Error in reminder cleanup task: {e}")
 
+@Task.create(IntervalTrigger(seconds=EVERY_24_HOURS))
+async def cleanup_stored_conversations():
+    """Delete conversations from the shared store that have long since timed out"""
+    try:
+        deleted = await asyncio.to_thread(memory.store.delete_stale, EVERY_24_HOURS)
+        if deleted > 0:
+            logging.info(f"Cleaned up {deleted} stored conversations")
+    except Exception as e:
+        logging.error(f"Error in conversation cleanup task: {e}")
+
+
+@Task.create(IntervalTrigger(seconds=MEMORY_SWEEP_INTERVAL))
+async def sweep_conversations():
+    """Evict conversations that have timed out so idle channels don't stay in memory"""
+    expired = memory.sweep()
+    if expired > 0:
+        logging.info(f"Evicted {expired} expired conversations ({memory.stats()})")
+
+    if memory.journal is not None:
+        memory.journal.sync()
+        if memory.journal.should_snapshot():
+            sequence, conversations = memory.journal.begin_snapshot(memory)
+            await asyncio.to_thread(memory.journal.finish_snapshot, sequence, conversations)
+
 bot.start()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for GPTMemory.
+Usage: python scripts/bench_memory.py
+"""
+
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from src import gptMemory  # noqa: E402
+from src.utils import retrieval  # noqa: E402
+from src.utils.tokenizer import tokenizer  # noqa: E402
+
+CHANNEL_ID = 1
+MESSAGE = 'someone: """how many tokens is this message, really?"""'
+APPENDS = 2000
+AUTHORS = ['computron', 'jackson', 'colin', 'kobe', 'jacob']
+WORDS = ['bro', 'what', 'is', 'compubot', 'doing', 'lmao', 'no', 'way', 'that', 'server', 'down', 'again']
+
+
+def bench_append(history_length: int):
+    """Average seconds per append once a channel is full and trimming every message, and
+    per turn (an append followed by building the prompt).
+
+    Runs on an event loop like the bot does, so exact token counts are left to the
+    tokenizer's thread and only the estimate is timed.
+    """
+    async def run():
+        memory = gptMemory.GPTMemory()
+        message_tokens = memory._token_count(MESSAGE)
+
+        # Size the limit so a full conversation holds roughly history_length entries
+        gptMemory.TOKEN_LIMIT = gptMemory.prompts_tokens + message_tokens * (history_length + 1)
+        for _ in range(history_length):
+            memory.append(CHANNEL_ID, MESSAGE)
+
+        start = time.perf_counter()
+        for _ in range(APPENDS):
+            memory.append(CHANNEL_ID, MESSAGE)
+        append = (time.perf_counter() - start) / APPENDS
+
+        start = time.perf_counter()
+        for _ in range(APPENDS):
+            memory.append(CHANNEL_ID, MESSAGE)
+            memory.get_messages(CHANNEL_ID)
+        return append, (time.perf_counter() - start) / APPENDS
+
+    return asyncio.run(run())
+
+
+def bench_count(count: int = 2000):
+    """Average seconds to estimate and to exactly count one chat message's tokens (None if tiktoken can't load)"""
+    lines = ['{}: """{}"""'.format(author, text) for author, text in _chat_lines(count)]
+    start = time.perf_counter()
+    for line in lines:
+        tokenizer.estimate(line)
+    estimate = (time.perf_counter() - start) / count
+
+    if tokenizer.load().result() is None:
+        return estimate, None
+    start = time.perf_counter()
+    for line in lines:
+        tokenizer.exact(line)
+    return estimate, (time.perf_counter() - start) / count
+
+
+def bench_import():
+    """Seconds to import gptMemory in a fresh interpreter, and until its tokenizer has loaded"""
+    code = ('import time; start = time.perf_counter(); from src import gptMemory; '
+            'imported = time.perf_counter() - start; loaded = gptMemory.tokenizer.loading.result() is not None; '
+            'print(imported, time.perf_counter() - start, loaded)')
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    imported, ready, loaded = output.splitlines()[-1].split()
+    return float(imported), float(ready), loaded == 'True'
+
+
+def _chat_lines(count: int):
+    rng = random.Random(0)
+    # Authors arrive as fresh strings from each Discord payload, so don't share them here either
+    return [(''.join(rng.choice(AUTHORS)), ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 15))))
+            for _ in range(count)]
+
+
+def _measure(build) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del entries
+    return after - before
+
+
+def bench_entry_bytes(count: int = 1000):
+    """Bytes held by `count` user messages as the old 6-key dicts and as HistoryEntry records"""
+    lines = _chat_lines(count)
+
+    def as_dicts():
+        return [{
+            'role': 'user',
+            'content': '{}: """{}"""'.format(author, text),
+            'name': None,
+            'tool_call_id': None,
+            'tokens': 0,
+            'id': index
+        } for index, (author, text) in enumerate(lines)]
+
+    def as_entries():
+        return [gptMemory.HistoryEntry(gptMemory.Role.USER, text, 0, index, author=author)
+                for index, (author, text) in enumerate(lines)]
+
+    # Message text is produced once either way; measure only what each layout adds on top
+    return _measure(as_dicts), _measure(as_entries)
+
+
+def bench_retrieval(count: int = retrieval.MAX_MESSAGES_PER_CHANNEL, queries: int = 200):
+    """Average seconds per top-k search over a channel holding `count` indexed messages, and the index's bytes"""
+    index = retrieval.ChannelIndex()
+    for author, text in _chat_lines(count):
+        index.add('{}: {}'.format(author, text))
+
+    query_vectors = [retrieval.embed(text) for _, text in _chat_lines(queries)]
+    start = time.perf_counter()
+    for vector in query_vectors:
+        index.search(vector, retrieval.TOP_K)
+    return (time.perf_counter() - start) / queries, index.bytes
+
+
+def main():
+    original_limit = gptMemory.TOKEN_LIMIT
+    # Trimming prints on every eviction; keep that out of the timings
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        results = [(length, bench_append(length)) for length in (100, 1000, 10000, 50000)]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        gptMemory.TOKEN_LIMIT = original_limit
+
+    print(f"{'history entries':>16} {'us/append':>10} {'us/turn':>10}")
+    for length, (append, turn) in results:
+        print(f"{length:>16} {append * 1e6:>10.2f} {turn * 1e6:>10.2f}")
+
+    dict_bytes, entry_bytes = bench_entry_bytes()
+    print()
+    print(f"bytes per 1,000 messages: dict {dict_bytes:,}  HistoryEntry {entry_bytes:,}  "
+          f"({1 - entry_bytes / dict_bytes:.0%} smaller)")
+
+    seconds, index_bytes = bench_retrieval()
+    print(f"retrieval search over {retrieval.MAX_MESSAGES_PER_CHANNEL:,} messages: {seconds * 1e3:.2f} ms/query, "
+          f"{index_bytes / 2 ** 20:.1f} MB held")
+
+    imported, ready, loaded = bench_import()
+    print(f"import gptMemory: {imported * 1e3:.1f} ms, tokenizer "
+          f"{f'ready after {ready * 1e3:.1f} ms' if loaded else 'unavailable (no cached BPE file or network)'}")
+    estimate, exact = bench_count()
+    print(f"token count per message: estimate {estimate * 1e6:.2f} us, exact "
+          f"{f'{exact * 1e6:.2f} us' if exact is not None else 'n/a'}")
+
+
+if __name__ == '__main__':
+    main()
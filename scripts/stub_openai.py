@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+A tiny offline stand-in for the OpenAI API, for trying the bot without a key.
+Usage: python scripts/stub_openai.py [--port 8000] [--no-responses] [--forget]
+Then run the bot with OPENAI_BASE_URL=http://localhost:8000/v1
+
+Serves chat completions and the Responses API, streamed or not. A latest user
+message that names one of the offered tools gets a call to that tool (with no
+arguments); everything else gets a short reply saying how much was sent, so
+it's easy to see whether a follow-up resent the history or chained from a
+stored response. --no-responses answers /responses with a 404 and --forget
+never finds a previous response, to exercise the bot's fallbacks.
+"""
+
+import argparse
+import itertools
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ids = itertools.count(1)
+# Response id -> every input and output item of that response and the ones before it
+stored = {}
+
+
+def _text(content):
+    if isinstance(content, list):
+        return ' '.join(part.get('text', '') for part in content)
+    return content or ''
+
+
+def _tool_to_call(tools, role, text, tool_choice):
+    """The name of the offered tool mentioned in the latest user message, if any"""
+    if role != 'user' or tool_choice == 'none':
+        return None
+    for tool in tools or ():
+        name = tool['function']['name'] if 'function' in tool else tool['name']
+        if name in text:
+            return name
+    return None
+
+
+def _reply(items: int, size: int):
+    return 'stub reply to {} messages ({} bytes sent)'.format(items, size)
+
+
+def _usage(prompt_tokens: int):
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': 10, 'total_tokens': prompt_tokens + 10}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    responses_enabled = True
+    forget = False
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, events):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for name, data in events:
+            event = ('event: {}\n'.format(name) if name else '') + 'data: {}\n\n'.format(data)
+            chunk = event.encode()
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(size) or b'{}')
+        if self.path.endswith('/chat/completions'):
+            self._chat_completion(body, size)
+        elif self.path.endswith('/responses') and self.responses_enabled:
+            self._response(body, size)
+        else:
+            self._send_json(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+    def _chat_completion(self, body: dict, size: int):
+        messages = body.get('messages', [])
+        print('chat/completions: {} messages, {} bytes'.format(len(messages), size))
+        last = messages[-1] if messages else {}
+        tool = _tool_to_call(body.get('tools'), last.get('role'), _text(last.get('content')), body.get('tool_choice'))
+        message = {'role': 'assistant', 'content': None if tool else _reply(len(messages), size)}
+        if tool:
+            message['tool_calls'] = [{
+                'id': 'call_{}'.format(next(ids)), 'type': 'function',
+                'function': {'name': tool, 'arguments': '{}'},
+            }]
+        completion = {
+            'id': 'chatcmpl-{}'.format(next(ids)), 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model'), 'usage': _usage(size // 4),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'tool_calls' if tool else 'stop'}],
+        }
+        if not body.get('stream'):
+            self._send_json(200, completion)
+            return
+
+        delta = dict(message)
+        if tool:
+            delta['tool_calls'] = [dict(message['tool_calls'][0], index=0)]
+        chunk = dict(completion, object='chat.completion.chunk', usage=None,
+                     choices=[{'index': 0, 'delta': delta, 'finish_reason': completion['choices'][0]['finish_reason']}])
+        usage = dict(completion, object='chat.completion.chunk', choices=[])
+        self._send_events([(None, json.dumps(chunk)), (None, json.dumps(usage)), (None, '[DONE]')])
+
+    def _response(self, body: dict, size: int):
+        items = body.get('input', [])
+        if isinstance(items, str):
+            items = [{'role': 'user', 'content': items}]
+        previous = body.get('previous_response_id')
+        if previous and (self.forget or previous not in stored):
+            self._send_json(400, {'error': {
+                'message': 'Previous response with id {} not found.'.format(previous),
+                'type': 'invalid_request_error', 'code': 'previous_response_not_found',
+            }})
+            return
+        context = stored.get(previous, []) + items
+        print('responses: {} new items, {} in context, {} bytes{}'.format(
+            len(items), len(context), size, ', continuing ' + previous if previous else ''))
+
+        last = context[-1] if context else {}
+        tool = _tool_to_call(body.get('tools'), last.get('role'), _text(last.get('content')), body.get('tool_choice'))
+        if tool:
+            output = [{'type': 'function_call', 'id': 'fc_{}'.format(next(ids)), 'call_id': 'call_{}'.format(next(ids)),
+                       'name': tool, 'arguments': '{}', 'status': 'completed'}]
+        else:
+            text = _reply(len(context), size)
+            output = [{'type': 'message', 'id': 'msg_{}'.format(next(ids)), 'role': 'assistant', 'status': 'completed',
+                       'content': [{'type': 'output_text', 'text': text, 'annotations': []}]}]
+        response = {
+            'id': 'resp_{}'.format(next(ids)), 'object': 'response', 'created_at': int(time.time()),
+            'model': body.get('model'), 'status': 'completed', 'output': output,
+            'usage': {'input_tokens': len(json.dumps(context)) // 4, 'output_tokens': 10,
+                      'input_tokens_details': {'cached_tokens': 0}},
+        }
+        if body.get('store', True):
+            stored[response['id']] = context + output
+        if not body.get('stream'):
+            self._send_json(200, response)
+            return
+
+        events = [('response.created', {'type': 'response.created', 'response': dict(response, status='in_progress', output=[])})]
+        if not tool:
+            events.append(('response.output_text.delta', {'type': 'response.output_text.delta', 'delta': text}))
+        events.append(('response.completed', {'type': 'response.completed', 'response': response}))
+        self._send_events([(name, json.dumps(data)) for name, data in events])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--no-responses', action='store_true', help='answer /responses with a 404')
+    parser.add_argument('--forget', action='store_true', help='never find a previous response')
+    args = parser.parse_args()
+
+    StubHandler.responses_enabled = not args.no_responses
+    StubHandler.forget = args.forget
+    server = ThreadingHTTPServer(('localhost', args.port), StubHandler)
+    print('Stub OpenAI API on http://localhost:{}/v1'.format(args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
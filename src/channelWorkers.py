@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import os
+
+LOGGER = logging.getLogger(__name__)
+
+WORKER_IDLE_TIMEOUT = 60
+# Items that arrive within this many seconds of the first one are handled together
+DEBOUNCE_WINDOW = float(os.getenv('REPLY_DEBOUNCE_SECONDS', 1.0))
+
+
+# Runs one worker per active channel. Items submitted for the same channel are
+# handled one at a time in arrival order, so a turn's appends, tool calls and reply
+# never interleave with the next turn's, while different channels still run in
+# parallel. A worker shuts itself down once its channel has been quiet for
+# `idle_timeout` seconds.
+#
+# The handler receives a list: the first waiting item plus everything else that
+# arrives within `debounce` seconds of it (or queued up while the previous batch
+# was being handled), so a burst of mentions gets a single reply.
+#
+# `run` queues a one-off coroutine function instead, for anything else that
+# changes a channel's memory (slash commands, listeners). It runs in its place in
+# the channel's order, between the handler's batches rather than alongside them.
+
+class _Job():
+    __slots__ = ('function', 'future')
+
+    def __init__(self, function):
+        self.function = function
+        self.future = asyncio.get_running_loop().create_future()
+
+    async def run(self):
+        try:
+            result = await self.function()
+        except Exception as err:
+            if not self.future.done():
+                self.future.set_exception(err)
+        else:
+            if not self.future.done():
+                self.future.set_result(result)
+
+
+class ChannelWorkers():
+    def __init__(self, handler=None, idle_timeout=WORKER_IDLE_TIMEOUT, debounce=DEBOUNCE_WINDOW):
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self.debounce = debounce
+        self.batches = 0
+        self.coalesced = 0
+        self.queues = {}
+        self.workers = {}
+
+    def submit(self, channel_id, item):
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = self.queues[channel_id] = asyncio.Queue()
+            self.workers[channel_id] = asyncio.create_task(self._run(channel_id, queue))
+        queue.put_nowait(item)
+
+    async def run(self, channel_id, function):
+        """Await `function()` on the channel's worker, after everything already queued for it"""
+        job = _Job(function)
+        self.submit(channel_id, job)
+        return await job.future
+
+    def active(self):
+        return len(self.workers)
+
+    def stats(self):
+        return {
+            'active_workers': len(self.workers),
+            'batches': self.batches,
+            'coalesced_items': self.coalesced,
+        }
+
+    async def _collect(self, queue: asyncio.Queue, first):
+        batch = [first]
+        deadline = asyncio.get_running_loop().time() + self.debounce
+        while True:
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return batch
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                return batch
+
+    async def _run(self, channel_id, queue: asyncio.Queue):
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    # Nothing can be submitted between this check and the cleanup below,
+                    # since neither awaits
+                    if queue.empty():
+                        return
+                    continue
+
+                if isinstance(item, _Job):
+                    await item.run()
+                    continue
+                batch = await self._collect(queue, item)
+                # Jobs that arrived while the batch was being collected run straight after it
+                jobs = [queued for queued in batch if isinstance(queued, _Job)]
+                batch = [queued for queued in batch if not isinstance(queued, _Job)]
+                self.batches += 1
+                self.coalesced += len(batch) - 1
+                try:
+                    await self.handler(batch)
+                except Exception:
+                    LOGGER.exception('Unhandled error in channel worker for {}'.format(channel_id))
+                for job in jobs:
+                    await job.run()
+        finally:
+            self.queues.pop(channel_id, None)
+            self.workers.pop(channel_id, None)
+
+
+# Shared by the message handler and the commands, listeners and tools that change memory.
+# main.py sets the handler.
+channel_workers = ChannelWorkers()
@@ -1,107 +1,253 @@
-import inspect
-import json
+import os
+import time
 
 import interactions
-from openai import AsyncOpenAI, BadRequestError, OpenAIError
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from openai import (NOT_GIVEN, AsyncStream, BadRequestError, NotFoundError,
+                    OpenAIError)
+from tenacity import (retry, retry_if_not_exception_type, stop_after_attempt,
+                      stop_any, wait_random_exponential)
 
-from src.functionDefinitions import FUNCTION_CALLS, FUNCTIONS
+from src.functionDefinitions import FUNCTIONS, call_tools, tools_for
 from src.gptMemory import DEFAULT_MODEL, MODEL_PROMPT, GPTMemory
 from src.replyFilters import (cleanReply, replaceEmotes, stripQuotations,
                               stripSelfTag)
+from src.replyStream import STREAMING_ENABLED, ReplyStream, consume
+from src.responseChain import (chain, chaining_enabled, consume_response,
+                               parse_response, response_input, response_tools,
+                               response_usage)
+from src.tokenBudget import budget
+from src.utils.circuitBreaker import CLOSED, get_breaker
+from src.utils.deadline import (DeadlineExceeded, current_deadline,
+                                stage_budget, within_deadline)
+from src.utils.hedging import HEDGING_ENABLED, get_hedger
+from src.utils.llmClients import get_openai_client
+from src.utils.rateLimits import Priority, llm_request
+from src.utils.telemetry import current_usage, telemetry
 
-client = AsyncOpenAI()
+PROVIDER = 'openai'
+# Model for hedge requests when a reply is slow; defaults to a second try of the same model
+HEDGE_MODEL = os.getenv('HEDGE_MODEL')
+client = get_openai_client()
+# Completions that may call tools before the final answer
+MAX_TOOL_ROUNDS = 3
+reply_cleanup = [cleanReply, replaceEmotes, stripSelfTag, stripQuotations]
 
 def sleep_log(msg):
     print('ChatGPT call failed! Retrying...')
 
-async def invokeGPT4(memory: GPTMemory, message: interactions.Message):
-  try:
-    await respondWithChatGPT(memory, message, "gpt-4.1-mini")
-    return True
-  except OpenAIError:
-    return False
+# Whether ChatGPT's breaker has tripped (open, or half-open and being probed)
+def chatGPTTripped(model=DEFAULT_MODEL):
+    return get_breaker(PROVIDER, model).state != CLOSED
 
-@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(3), reraise=True, before_sleep=sleep_log)
-async def respondWithChatGPT(memory: GPTMemory, message: interactions.Message, image_links: list[str], model=DEFAULT_MODEL):
-    NO_POST_RESPONSE_FLAG = False
+# Stop retrying as soon as the breaker trips, so the caller can fail over right away
+def circuit_opened(retry_state):
+    return chatGPTTripped(retry_state.kwargs.get('model', DEFAULT_MODEL))
 
-    functions = FUNCTIONS[:]
-    function_calls = FUNCTION_CALLS.copy()
+# Send a request and report how it went to the model's circuit breaker.
+# `tokens` is the prompt size for the rate limiter
+async def tracked(model, tokens, request):
+    breaker = get_breaker(PROVIDER, model)
+    start = time.monotonic()
+    with llm_request(Priority.INTERACTIVE, tokens) as request_info:
+        try:
+            response = await within_deadline(request)
+        except (BadRequestError, NotFoundError):
+            raise # Our request's fault, not the provider's
+        except OpenAIError:
+            breaker.record(False, time.monotonic() - start - request_info.queued)
+            raise
+    breaker.record(True, time.monotonic() - start - request_info.queued)
+    return response
+
+# `tools` is one of the registry's shared lists, sent only if it has any tools in it
+async def create(model, tokens=None, tools=FUNCTIONS, **kwargs):
+    return await tracked(model, tokens, client.chat.completions.create(
+        model=model,
+        tools=tools or NOT_GIVEN,
+        timeout=stage_budget() or NOT_GIVEN,
+        **kwargs
+    ))
+
+# Like create, but through the Responses API, which stores the response so the next one can continue it.
+# The SDK we're on predates the API, so this posts to it directly and works with plain dicts
+async def create_response(model, tokens=None, stream=False, tools=FUNCTIONS, **body):
+    timeout = stage_budget()
+    if tools:
+        body['tools'] = response_tools(tools)
+    return await tracked(model, tokens, client.post(
+        '/responses',
+        body={'model': model, 'store': True, 'stream': stream, **body},
+        cast_to=object,
+        options={'timeout': timeout} if timeout else {},
+        stream=stream,
+        stream_cls=AsyncStream[object]
+    ))
+
+# Like create, but with a hedge request to HEDGE_MODEL if the reply is slow and hedging is on
+async def create_hedged(model, tokens=None, **kwargs):
+    # A half-open breaker lets a single probe through, and a hedge would make it two
+    if not HEDGING_ENABLED or chatGPTTripped(model):
+        return await create(model, tokens, **kwargs)
+    backup_model = HEDGE_MODEL or model
+    if backup_model != model and not get_breaker(PROVIDER, backup_model).allow():
+        return await create(model, tokens, **kwargs)
+    return await get_hedger(model).run(
+        lambda: create(model, tokens, **kwargs),
+        lambda: create(backup_model, tokens, **kwargs)
+    )
+
+# One completion, streamed into `reply` if streaming is on. Returns the text and any tool calls
+async def complete(reply: ReplyStream, model, messages, tokens=None, **kwargs):
+    if STREAMING_ENABLED:
+        stream = await create_hedged(model, tokens, messages=messages, stream=True, stream_options={"include_usage": True}, **kwargs)
+        tool_calls = await consume(stream, reply, model)
+        budget.calibrate(model, tokens, reply.usage)
+        return reply.text, tool_calls
+
+    response = await create_hedged(model, tokens, messages=messages, **kwargs)
+    telemetry.record_usage(model, response.usage)
+    budget.calibrate(model, tokens, response.usage)
+    resp = response.choices[0].message
+    return resp.content, resp.tool_calls or []
+
+# One completion through the Responses API, continuing the stored response `previous` if given.
+# `tokens` estimates the whole context, which is what the provider counts as input when
+# continuing a response, so calibration uses it; `sent_tokens` is what this request sends,
+# for the rate limiter. Returns the text, tool calls and the new response's id
+async def complete_response(reply: ReplyStream, model, messages, tokens=None, previous=None, sent_tokens=None, **kwargs):
+    if previous:
+        kwargs['previous_response_id'] = previous
+    sent_tokens = sent_tokens or tokens
+    if STREAMING_ENABLED:
+        stream = await create_response(model, sent_tokens, stream=True, input=response_input(messages), **kwargs)
+        tool_calls, response_id = await consume_response(stream, reply, model)
+        budget.calibrate(model, tokens, reply.usage)
+        return reply.text, tool_calls, response_id
+
+    response = await create_response(model, sent_tokens, input=response_input(messages), **kwargs)
+    budget.calibrate(model, tokens, response_usage(response))
+    return parse_response(response, model)
+
+# The next completion of a turn. With response chaining, a follow-up continues the stored
+# response `previous` and only sends `new_messages`; otherwise, or if the provider can't
+# chain, the whole history is sent. Returns the text, tool calls and the id to continue from
+async def next_completion(reply: ReplyStream, model, messages, new_messages, tokens=None, previous=None, **kwargs):
+    if chaining_enabled():
+        try:
+            sent_tokens = budget.estimate(model, new_messages, kwargs.get('tools')) if previous else tokens
+            result = await complete_response(reply, model, new_messages if previous else messages, tokens, previous,
+                                             sent_tokens, **kwargs)
+            if previous:
+                chain.chained += 1
+                chain.items_saved += len(messages) - len(new_messages)
+            return result
+        except NotFoundError:
+            print('No Responses API at this endpoint, sending full histories instead')
+            chain.supported = False
+        except BadRequestError as err:
+            if not previous:
+                raise
+            # Stored responses expire, and some compatible servers don't keep them at all
+            print('Could not continue response {}, sending the full history: {}'.format(previous, err))
+        chain.resent += 1
+
+    content, tool_calls = await complete(reply, model, messages, tokens, **kwargs)
+    return content, tool_calls, None
+
+# The stream a ChatGPT reply is posted through. Hand it to the Mistral fallback so it edits
+# anything already posted instead of leaving it half written next to a second reply
+def chatGPTReply(message: interactions.Message, model=DEFAULT_MODEL):
+    channel = message.channel
+    send = channel.send if channel.type == interactions.ChannelType.DM else message.reply
+    return ReplyStream(send, reply_cleanup, model)
 
+# Every attempt posts through the same `reply`, so a retry after part of a reply went out edits that message
+async def respondWithChatGPT(memory: GPTMemory, message: interactions.Message, image_links: list[str], model=DEFAULT_MODEL,
+                             image_sizes=None, reply: ReplyStream = None):
+    return await _respondWithChatGPT(memory=memory, message=message, image_links=image_links, model=model,
+                                     image_sizes=image_sizes, reply=reply or chatGPTReply(message, model))
+
+@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_any(stop_after_attempt(3), circuit_opened),
+       retry=retry_if_not_exception_type(DeadlineExceeded), reraise=True, before_sleep=sleep_log)
+async def _respondWithChatGPT(memory: GPTMemory, message: interactions.Message, image_links: list[str], model, image_sizes,
+                              reply: ReplyStream):
     channel = message.channel
+    reply.restart(model)
     async with channel.typing:
         try:
             messages = memory.get_messages(message.channel.id)
+            recalled = await memory.recall(message.channel.id)
+            if recalled:
+                # Just before the newest message, so the history before it stays a stable prefix
+                messages.insert(len(messages) - 1, recalled)
             if (len(image_links) > 0):
-                if isinstance(messages[-1]['content'], str):
-                    messages[-1]['content'] = [{
+                # Copy the last message before editing so the cached history stays text-only
+                last_message = messages.writable(-1)
+                if isinstance(last_message['content'], str):
+                    last_message['content'] = [{
                         'type': 'text',
-                        'text': messages[-1]['content']
+                        'text': last_message['content']
                     }]
+                else:
+                    last_message['content'] = list(last_message['content'])
 
-                messages[-1]['content'].extend({
+                last_message['content'].extend({
                     "type": "image_url",
                     "image_url": {
                     "url": url
                     }
                 } for url in image_links)
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                tools=functions
-            )
+            # Only the tools the bot has needed so far, the same list in every channel
+            turn_tools = tools_for(messages)
+            messages, tokens = budget.fit(model, messages, turn_tools, image_sizes)
+            content, tool_calls, response_id = await next_completion(reply, model, messages, messages, tokens, tools=turn_tools)
         except BadRequestError as e:
             print(e)
             return True
 
-        resp = response.choices[0].message
-
-        if resp.tool_calls:
-            tool_name = resp.tool_calls[0].function.name
-            print(f"Function call to {tool_name}...")
-            tool_to_call = function_calls[tool_name]
-            tool_args = json.loads(resp.tool_calls[0].function.arguments)
-            if inspect.iscoroutinefunction(tool_to_call):
-                function_response = await tool_to_call(memory=memory, message=message, **tool_args)
-            else:
-                function_response = tool_to_call(
-                    memory=memory, message=message, **tool_args)
-
-            if tool_name == 'invoke_gpt_4' and function_response:
-                NO_POST_RESPONSE_FLAG = True
-
-            print(f"{tool_name} response: {function_response}")
-
-            if not tool_name == 'invoke_gpt_4':
+        # Run the tools and let the model look at the results, a few rounds at most
+        tool_rounds = 0
+        while tool_calls and tool_rounds < MAX_TOOL_ROUNDS:
+            tool_rounds += 1
+            # The calls are saved with their results, so a deadline that runs out during
+            # the tools can't leave calls without results in the history
+            results = await call_tools(memory, message, tool_calls)
+            memory.append(
+                message.channel.id,
+                content or '',
+                role='assistant',
+                tool_calls=[(call.id, call.function.name, call.function.arguments) for call in tool_calls]
+            )
+            new_messages = []
+            for call, result in zip(tool_calls, results):
+                new_messages.append({'role': 'tool', 'content': result, 'tool_call_id': call.id})
                 memory.append(
                     message.channel.id,
-                    function_response,
-                    role='function',
-                    name=tool_name,
-                    tool_call_id=resp.tool_calls[0].id
+                    result,
+                    role='tool',
+                    name=call.function.name,
+                    tool_call_id=call.id
                 )
 
-                response = await client.chat.completions.create(
-                    model=model,
-                    messages=memory.get_messages(message.channel.id),
-                    tools=functions,
-                    tool_choice="none"
-                )
-
-        if response.choices[0].message.content and not NO_POST_RESPONSE_FLAG:
-            filters = [cleanReply, replaceEmotes, stripSelfTag, stripQuotations]
-            reply = response.choices[0].message.content
-            for filter in filters:
-                reply = filter(reply)
+            reply.restart()
+            messages, tokens = budget.fit(model, memory.get_messages(message.channel.id), turn_tools)
+            content, tool_calls, response_id = await next_completion(
+                reply,
+                model,
+                messages,
+                new_messages,
+                tokens,
+                response_id,
+                tools=turn_tools,
+                # Out of rounds, so the model has to answer with what it has
+                tool_choice="none" if tool_rounds >= MAX_TOOL_ROUNDS else "auto"
+            )
 
+        # Posts the reply, or finishes editing the one that was streamed
+        content = await reply.finish(content or '')
+        if content:
             # Save this to the current conversation
-            memory.append(message.channel.id, reply, role='assistant')
-
-            if channel.type == interactions.ChannelType.DM:
-                await channel.send(reply)
-            else:
-                await message.reply(reply)
+            memory.append(message.channel.id, content, role='assistant')
 
 async def oneOffResponse(prompt, role="system"):
     response = await client.chat.completions.create(
@@ -114,4 +260,31 @@ async def oneOffResponse(prompt, role="system"):
             }
         ]
     )
+    telemetry.record_usage(DEFAULT_MODEL, response.usage)
+    return response.choices[0].message.content
+
+SUMMARY_PROMPT = """You maintain a running summary of a Discord conversation that compubot is part of.
+You'll be given the current summary and the next messages that are falling out of compubot's memory.
+Return an updated summary that folds the new messages into the current one. Keep who said what, names, facts, requests and running jokes.
+Drop greetings and filler. Write plain prose under 250 words, and do not address the reader."""
+
+async def summarizeHistory(summary, transcript):
+    # Runs in its own task, which shouldn't inherit the deadline or token tally of the turn that started it
+    current_deadline.set(None)
+    current_usage.set(None)
+    with llm_request(Priority.BACKGROUND):
+        response = await client.chat.completions.create(
+            model=DEFAULT_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": SUMMARY_PROMPT
+                },
+                {
+                    "role": "user",
+                    "content": "Current summary:\n{}\n\nNew messages:\n{}".format(summary or "(none yet)", transcript)
+                }
+            ]
+        )
+    telemetry.record_usage(DEFAULT_MODEL, response.usage)
     return response.choices[0].message.content
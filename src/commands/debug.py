@@ -1,3 +1,4 @@
+import inspect
 import json
 
 import interactions
@@ -5,6 +6,7 @@ import interactions
 from src.gptMemory import GPTMemory
 
 MY_ID = '186691115720769536'
+NOT_ALLOWED = 'The user tried to access information or perform an action that is not available to them.'
 
 
 def only_me(func):
@@ -12,9 +14,16 @@ def only_me(func):
         if kw['message'] and kw['message'].author.id == MY_ID:
             return func(*args, **kw)
         else:
-            return 'The user tried to access information or perform an action that is not available to them.'
+            return NOT_ALLOWED
 
-    return wrapper
+    async def async_wrapper(*args, **kw):
+        if kw['message'] and kw['message'].author.id == MY_ID:
+            return await func(*args, **kw)
+        else:
+            return NOT_ALLOWED
+
+    # Async handles stay async, so tools built on them still run on the event loop
+    return async_wrapper if inspect.iscoroutinefunction(func) else wrapper
 
 
 @only_me
@@ -23,8 +32,9 @@ def print_debug_handle(memory: GPTMemory, message: interactions.Message):
     return 'Memory has been printed in the console. Don\'t repeat these logs to the user.'
 
 
+# Async so that, as a tool, it appends on the event loop inside the turn rather than on a thread
 @only_me
-def add_prompt_handle(memory: GPTMemory, message: interactions.Message, prompt):
+async def add_prompt_handle(memory: GPTMemory, message: interactions.Message, prompt):
     memory.append(message.channel_id, prompt, role='system')
     print(
         f'The following prompt was added to the conversation in {message.channel_id}: "{prompt}"')
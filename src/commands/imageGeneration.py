@@ -4,26 +4,30 @@ from datetime import datetime
 from interactions import (Client, Embed, EmbedAttachment, Extension, Message,
                           OptionType, SlashContext, slash_command,
                           slash_option)
-from openai import AsyncOpenAI, BadRequestError, OpenAIError
+from openai import BadRequestError, OpenAIError
 
+from src.channelWorkers import channel_workers
 from src.gptMemory import DEFAULT_MODEL, MODEL_PROMPT, memory
+from src.utils.llmClients import get_openai_client
+from src.utils.rateLimits import Priority, llm_request
 
-client = AsyncOpenAI()
+client = get_openai_client()
 LOGGER = logging.getLogger()
 
 AI_RESPONSE_STRING = "The image can be described as such: \"{}\". This image is outdated, and compubot must create a new image if the user asks to change the prompt or generate a new image. Continue the conversation."
 
 async def __oneOffResponse(prompt, role="system"):
-    response = await client.chat.completions.create(
-        model=DEFAULT_MODEL,
-        messages=[
-            MODEL_PROMPT,
-            {
-                "role": role,
-                "content": prompt
-            }
-        ]
-    )
+    with llm_request(Priority.BACKGROUND):
+        response = await client.chat.completions.create(
+            model=DEFAULT_MODEL,
+            messages=[
+                MODEL_PROMPT,
+                {
+                    "role": role,
+                    "content": prompt
+                }
+            ]
+        )
     return response.choices[0].message.content
 
 async def generate_image(prompt):
@@ -96,7 +100,7 @@ class ImageGeneration(Extension):
              description=resp
           )
           await msg.edit('_{}_ - <@{}>, {}'.format(prompt.title(), ctx.author.id, datetime.now().year), embeds=embed)
-          memory.append(ctx.channel_id, AI_RESPONSE_STRING.format(resp), role="system")
+          await channel_workers.run(ctx.channel_id, lambda: memory.remember(ctx.channel_id, AI_RESPONSE_STRING.format(resp), role="system"))
         except BadRequestError:
            await msg.edit('that prompt was rejected by our OpenAI overlords. give it another shot. (The prompt was "{}")'.format(resp))
         except OpenAIError:
@@ -0,0 +1,116 @@
+import json
+import logging
+
+from interactions import Client, Extension, SlashContext, slash_command
+
+from src.functionDefinitions import tools
+from src.gptMemory import memory
+from src.modelRouter import router
+from src.responseChain import chain_stats
+from src.tokenBudget import budget
+from src.utils.circuitBreaker import breaker_stats
+from src.utils.hedging import hedge_stats
+from src.utils.llmClients import pool_stats, rate_limit_stats
+from src.utils.telemetry import telemetry
+
+SETTINGS = json.load(open("resources/settings.json"))
+LOGGER = logging.getLogger()
+
+
+def format_stats(stats: dict):
+    width = max(len(key) for key in stats)
+    return '```\n{}\n```'.format('\n'.join(
+        '{}  {}'.format(key.ljust(width), value) for key, value in stats.items()))
+
+
+class Stats(Extension):
+    def __init__(self, client: Client):
+        LOGGER.debug("Initialized /stats shard")
+        self.client = client
+
+    async def _admin_only(self, ctx: SlashContext):
+        if ctx.author.id not in SETTINGS["global"]["admin_ids"]:
+            await ctx.send("nice try.", ephemeral=True)
+            return False
+        return True
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="memory",
+        sub_cmd_description="conversation memory usage"
+    )
+    async def memory_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats(memory.stats()), ephemeral=True)
+        LOGGER.debug("stats: {} checked memory stats".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="cache",
+        sub_cmd_description="prompt cache hit rate"
+    )
+    async def cache_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats({**telemetry.cache_report(), **chain_stats(), **budget.summary(), **tools.summary()}), ephemeral=True)
+        LOGGER.debug("stats: {} checked prompt cache stats".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="latency",
+        sub_cmd_description="time until replies start showing up"
+    )
+    async def latency_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats({**telemetry.latency_report(), **hedge_stats()}), ephemeral=True)
+        LOGGER.debug("stats: {} checked latency stats".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="connections",
+        sub_cmd_description="connection reuse for the LLM APIs"
+    )
+    async def connection_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats(pool_stats()), ephemeral=True)
+        LOGGER.debug("stats: {} checked connection stats".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="limits",
+        sub_cmd_description="LLM rate limiter queues"
+    )
+    async def limit_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats(rate_limit_stats()), ephemeral=True)
+        LOGGER.debug("stats: {} checked rate limit stats".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="circuits",
+        sub_cmd_description="LLM provider health and circuit breakers"
+    )
+    async def circuit_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats(breaker_stats()), ephemeral=True)
+        LOGGER.debug("stats: {} checked circuit breakers".format(ctx.author.id))
+
+    @slash_command(
+        name="stats",
+        description="internal compubot stats",
+        sub_cmd_name="routing",
+        sub_cmd_description="which models turns are routed to, and how they did"
+    )
+    async def routing_stats(self, ctx: SlashContext):
+        if await self._admin_only(ctx):
+            await ctx.send(format_stats(router.stats()), ephemeral=True)
+        LOGGER.debug("stats: {} checked model routing".format(ctx.author.id))
+
+
+def setup(bot):
+    Stats(bot)
@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+StoredConversation = Tuple[int, Dict[str, Any]]
+
+
+class ConversationStore(ABC):
+    """Shared storage for GPTMemory conversations.
+
+    Every save is a compare-and-set on the conversation's version: it only succeeds
+    if the stored copy is still at `expected_version` (0 meaning it doesn't exist yet),
+    and bumps the version by one. Methods are blocking; GPTMemory calls them from a
+    worker thread.
+    """
+
+    @abstractmethod
+    def load(self, channel_id: str, newer_than: int = 0) -> Optional[StoredConversation]:
+        """Get the (version, payload) stored for a channel, if there is one with a version above `newer_than`"""
+
+    @abstractmethod
+    def save(self, channel_id: str, payload: Dict[str, Any], expected_version: int) -> bool:
+        """Store a payload if nobody else has saved since expected_version"""
+
+    @abstractmethod
+    def delete(self, channel_id: str) -> bool:
+        """Forget a channel's conversation"""
+
+    @abstractmethod
+    def delete_stale(self, older_than_seconds: int) -> int:
+        """Delete conversations that haven't been saved in a while, returning how many"""
+
+
+class SupabaseConversationStore(ConversationStore):
+    """Stores conversations in the `conversations` table"""
+
+    def __init__(self):
+        # Imported here so the SQLite store works offline without the Supabase SDK
+        from src.database.supabase_client import get_client
+        self.client = get_client().client
+
+    def load(self, channel_id: str, newer_than: int = 0) -> Optional[StoredConversation]:
+        try:
+            response = self.client.table('conversations') \
+                .select('version, payload') \
+                .eq('channel_id', channel_id) \
+                .gt('version', newer_than) \
+                .limit(1) \
+                .execute()
+            if not response.data:
+                return None
+            return response.data[0]['version'], response.data[0]['payload']
+        except Exception as e:
+            print(f"Error loading conversation: {e}")
+            return None
+
+    def save(self, channel_id: str, payload: Dict[str, Any], expected_version: int) -> bool:
+        try:
+            if expected_version == 0:
+                # Fails on the primary key if another process created it first
+                response = self.client.table('conversations').insert({
+                    'channel_id': channel_id,
+                    'version': 1,
+                    'payload': payload
+                }).execute()
+            else:
+                response = self.client.table('conversations') \
+                    .update({'version': expected_version + 1, 'payload': payload}) \
+                    .eq('channel_id', channel_id) \
+                    .eq('version', expected_version) \
+                    .execute()
+            return bool(response.data)
+        except Exception as e:
+            print(f"Error saving conversation: {e}")
+            return False
+
+    def delete(self, channel_id: str) -> bool:
+        try:
+            response = self.client.table('conversations') \
+                .delete() \
+                .eq('channel_id', channel_id) \
+                .execute()
+            return bool(response.data)
+        except Exception as e:
+            print(f"Error deleting conversation: {e}")
+            return False
+
+    def delete_stale(self, older_than_seconds: int) -> int:
+        try:
+            cutoff = (datetime.now() - timedelta(seconds=older_than_seconds)).isoformat()
+            response = self.client.table('conversations') \
+                .delete() \
+                .filter('updated_at', 'lt', cutoff) \
+                .execute()
+            return len(response.data) if response.data else 0
+        except Exception as e:
+            print(f"Error cleaning up conversations: {e}")
+            return 0
+
+
+class SQLiteConversationStore(ConversationStore):
+    """A local stand-in for the Supabase store, for running and testing offline"""
+
+    def __init__(self, path: str = ':memory:'):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'create table if not exists conversations ('
+                'channel_id text primary key, version integer not null, payload text not null, updated_at real not null)'
+            )
+
+    def load(self, channel_id: str, newer_than: int = 0) -> Optional[StoredConversation]:
+        with self.lock:
+            row = self.connection.execute(
+                'select version, payload from conversations where channel_id = ? and version > ?', (channel_id, newer_than)
+            ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def save(self, channel_id: str, payload: Dict[str, Any], expected_version: int) -> bool:
+        data = json.dumps(payload)
+        with self.lock, self.connection:
+            if expected_version == 0:
+                cursor = self.connection.execute(
+                    'insert or ignore into conversations values (?, 1, ?, ?)', (channel_id, data, time.time())
+                )
+            else:
+                cursor = self.connection.execute(
+                    'update conversations set version = ?, payload = ?, updated_at = ? where channel_id = ? and version = ?',
+                    (expected_version + 1, data, time.time(), channel_id, expected_version)
+                )
+            return cursor.rowcount == 1
+
+    def delete(self, channel_id: str) -> bool:
+        with self.lock, self.connection:
+            return self.connection.execute(
+                'delete from conversations where channel_id = ?', (channel_id,)
+            ).rowcount > 0
+
+    def delete_stale(self, older_than_seconds: int) -> int:
+        with self.lock, self.connection:
+            return self.connection.execute(
+                'delete from conversations where updated_at < ?', (time.time() - older_than_seconds,)
+            ).rowcount
+
+
+def get_conversation_store() -> Optional[ConversationStore]:
+    """Build the store selected by MEMORY_STORE ('supabase' or 'sqlite'), or None to keep memory in-process"""
+    store_type = os.getenv('MEMORY_STORE', '').lower()
+    if store_type == 'supabase':
+        return SupabaseConversationStore()
+    if store_type == 'sqlite':
+        return SQLiteConversationStore(os.getenv('MEMORY_STORE_PATH', 'conversations.db'))
+    return None
@@ -0,0 +1,217 @@
+import json
+import os
+import shutil
+import struct
+import time
+import zlib
+from collections import defaultdict
+from typing import Optional
+
+from src.gptMemory import CONVERSATION_TIMEOUT, Conversation, GPTMemory, HistoryEntry
+
+# Journal records are a header (payload length, payload CRC32, sequence number)
+# followed by a compact JSON payload of [time, channel id, op, *args].
+RECORD_HEADER = struct.Struct('<IIQ')
+# Snapshots are a header (magic, payload CRC32, last sequence number included)
+# followed by zlib-compressed JSON of [[channel id, conversation], ...]. Conversations
+# also keep the entries waiting to be summarized, which the shared store doesn't.
+SNAPSHOT_HEADER = struct.Struct('<4sIQ')
+SNAPSHOT_MAGIC = b'CBS1'
+
+SNAPSHOT_EVERY_RECORDS = int(os.getenv('MEMORY_JOURNAL_SNAPSHOT_RECORDS', 5000))
+
+
+def _encode_op(op):
+    if op[0] == 'append':
+        return ['append', op[1].to_list()]
+    return list(op)
+
+
+def _decode_op(values):
+    if values[0] == 'append':
+        return ('append', HistoryEntry.from_list(values[1]))
+    return tuple(values)
+
+
+def _snapshot_conversation(conversation):
+    data = conversation.to_dict()
+    if isinstance(conversation, Conversation) and conversation.unsummarized:
+        data['unsummarized'] = [entry.to_list() for entry in conversation.unsummarized]
+    return data
+
+
+def _conversation_from_snapshot(data):
+    conversation = Conversation.from_dict(data)
+    for values in data.get('unsummarized', ()):
+        conversation.queue_unsummarized(HistoryEntry.from_list(values))
+    return conversation
+
+
+class MemoryJournal:
+    """Append-only log of GPTMemory mutations with periodic compacted snapshots.
+
+    Every append, sike, clear, offensive mode change and summary is written to
+    `journal.log` as it happens. Snapshots of the whole memory periodically replace
+    the log, so a restart replays one snapshot plus a short tail. Records carry a
+    sequence number and snapshots record the last one they include, so a crash at
+    any point while snapshotting never applies a record twice.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, 'snapshot.bin')
+        self.journal_path = os.path.join(directory, 'journal.log')
+        # Journal that was rotated out by a snapshot that may not have finished writing
+        self.rotated_path = os.path.join(directory, 'journal.old')
+        self.sequence = 0
+        self.records_since_snapshot = 0
+        self.snapshotting = False
+        self.file = None
+
+    def write(self, channel_id, op):
+        self.sequence += 1
+        payload = json.dumps([time.time(), channel_id, *_encode_op(op)], separators=(',', ':')).encode()
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), self.sequence) + payload)
+        # Hand the record to the OS straight away so it survives the process dying
+        self.file.flush()
+        self.records_since_snapshot += 1
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # Returns the intact records in a journal file and the length of the intact prefix
+    def _read_records(self, path: str):
+        records = []
+        if not os.path.exists(path):
+            return records, 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, sequence = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                # Torn write from a crash; everything after it is unusable
+                print('Journal {} has a damaged tail at byte {}, ignoring the rest.'.format(path, offset))
+                break
+            records.append((sequence, json.loads(payload)))
+            offset += RECORD_HEADER.size + length
+        return records, offset
+
+    def _read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return 0, []
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+        magic, crc, sequence = SNAPSHOT_HEADER.unpack_from(data)
+        payload = data[SNAPSHOT_HEADER.size:]
+        if magic != SNAPSHOT_MAGIC or zlib.crc32(payload) != crc:
+            print('Memory snapshot is damaged, starting from the journal alone.')
+            return 0, []
+        return sequence, json.loads(zlib.decompress(payload))
+
+    def restore(self, memory: GPTMemory, now: Optional[float] = None):
+        """Load the snapshot and journal tail into `memory`, then start journaling its changes.
+
+        Conversations that have already timed out are skipped rather than rebuilt.
+        """
+        start = time.perf_counter()
+        now = now or time.time()
+        snapshot_sequence, snapshot = self._read_snapshot()
+        rotated_records, _ = self._read_records(self.rotated_path)
+        journal_records, intact_length = self._read_records(self.journal_path)
+        records = [
+            (sequence, values)
+            for sequence, values in (*rotated_records, *journal_records)
+            if sequence > snapshot_sequence
+        ]
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > intact_length:
+            # Drop a torn tail so new records aren't written after unreadable bytes
+            os.truncate(self.journal_path, intact_length)
+
+        # Work out which channels are still live before building anything
+        last_activity = {}
+        for channel_id, data in snapshot:
+            last_activity[channel_id] = data['last_message']
+        for _, (timestamp, channel_id, *_) in records:
+            last_activity[channel_id] = max(timestamp, last_activity.get(channel_id, 0))
+        live = {channel_id for channel_id, last in last_activity.items() if last + CONVERSATION_TIMEOUT > now}
+
+        conversations = {channel_id: _conversation_from_snapshot(data) for channel_id, data in snapshot if channel_id in live}
+        ops = defaultdict(list)
+        # Channels whose conversation comes from the snapshot rather than the journal alone
+        started = set(conversations)
+        for _, (timestamp, channel_id, *values) in records:
+            if channel_id not in live:
+                continue
+            op = _decode_op(values)
+            if op[0] == 'clear':
+                conversations.pop(channel_id, None)
+                ops.pop(channel_id, None)
+                started.discard(channel_id)
+                continue
+            if channel_id not in conversations:
+                conversations[channel_id] = Conversation()
+            ops[channel_id].append((timestamp, op))
+
+        for channel_id, conversation in conversations.items():
+            channel_ops = ops.get(channel_id, [])
+            if channel_id not in started:
+                # Started from the journal, so it was created when its first op was written
+                conversation.last_message = channel_ops[0][0]
+            for timestamp, op in channel_ops:
+                if op[0] == 'append':
+                    conversation.last_message = timestamp
+            memory.restore(channel_id, conversation, [op for _, op in channel_ops])
+
+        self.sequence = max([snapshot_sequence, *(sequence for sequence, _ in records)])
+        self.records_since_snapshot = len(records)
+        self.file = open(self.journal_path, 'ab')
+        memory.journal = self
+        print('Restored {} conversations from the memory journal in {:.1f}ms'.format(
+            len(memory.conversations), (time.perf_counter() - start) * 1000))
+
+    def should_snapshot(self):
+        return not self.snapshotting and self.records_since_snapshot >= SNAPSHOT_EVERY_RECORDS
+
+    def begin_snapshot(self, memory: GPTMemory):
+        """Capture memory and rotate the journal. Call from the event loop, then run
+        `finish_snapshot` with the result (it's safe to run in a worker thread)."""
+        self.snapshotting = True
+        conversations = [[channel_id, _snapshot_conversation(conversation)] for channel_id, conversation in memory.conversations.items()]
+        self.close()
+        if os.path.exists(self.rotated_path):
+            # A previous snapshot never finished, so keep its records until this one does
+            with open(self.rotated_path, 'ab') as rotated, open(self.journal_path, 'rb') as journal:
+                shutil.copyfileobj(journal, rotated)
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self.file = open(self.journal_path, 'ab')
+        self.records_since_snapshot = 0
+        return self.sequence, conversations
+
+    def finish_snapshot(self, sequence: int, conversations: list):
+        try:
+            payload = zlib.compress(json.dumps(conversations, separators=(',', ':')).encode())
+            temp_path = self.snapshot_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, zlib.crc32(payload), sequence) + payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            os.remove(self.rotated_path)
+        finally:
+            self.snapshotting = False
+
+
+def get_memory_journal() -> Optional[MemoryJournal]:
+    """Build the journal configured by MEMORY_JOURNAL_DIR, or None if journaling is off"""
+    directory = os.getenv('MEMORY_JOURNAL_DIR')
+    return MemoryJournal(directory) if directory else None
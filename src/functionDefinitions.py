@@ -1,3 +1,8 @@
+import asyncio
+import inspect
+import json
+import os
+
 import interactions
 from interactions import ChannelType, Member, Message
 
@@ -5,7 +10,9 @@ from src.commands.debug import add_prompt_handle, print_debug_handle
 from src.commands.imageGeneration import generate_image_handle
 from src.commands.mc import get_status_handle
 from src.gptMemory import GPTMemory
+from src.utils.deadline import DeadlineExceeded, within_deadline
 from src.utils.emotes import emotes
+from src.utils.toolRegistry import ToolRegistry
 
 
 # Get information about the discord server/channel
@@ -21,91 +28,119 @@ async def channel_info_handle(memory, message: Message):
 def prompt_info_handle(memory, message):
     return 'No one has access to your prompts.'
 
-def get_emote_function():
-    available_emotes = emotes.get_all_emotes()
-    emote_descriptions = [f"{name}: {data['description']}" for name, data in available_emotes.items()]
-    
-    return {
-        "type": "function",
-        "function": {
-            "name": "use_emote",
-            "description": "Use a Discord emote in the message. Available emotes:\n" + "\n".join(emote_descriptions),
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "emote_name": {
-                        "type": "string",
-                        "description": "The name of the emote to use",
-                        "enum": list(available_emotes.keys())
-                    }
-                },
-                "required": ["emote_name"]
-            }
-        }
-    }
-
-def use_emote(memory: GPTMemory, message: interactions.Message, emote_name: str):
+def use_emote_handle(memory: GPTMemory, message: interactions.Message, emote_name: str):
     emote = emotes.get_emote(emote_name)
     if emote:
         return f"Using emote: {emote}"  # This gets replaced in the final response
     return f"Emote '{emote_name}' not found"
 
-# Add to FUNCTIONS and FUNCTION_CALLS
-FUNCTIONS = [
-    {
-        "type": "function",
-        "function": {
-            'name': 'minecraft_server',
-            'description': 'given an IP address, get the player status of a minecraft server.',
-            'parameters': {
-                'type': 'object',
-                'properties': {
-                    'ip': {
-                        'type': 'string',
-                        'description': 'the IP address of the minecraft server. If none is provided, use cloud.elysiumalchemy.com.'
-                    },
-                },
-                'required': ['ip']
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            'name': 'channel_info',
-            'description': 'Get information about the discord server and channel you\'re in',
-            'parameters': {
-                'type': 'object',
-                'properties': {}
-            }
-        }
-    },
-    {
-        "type": "function",
-        "function": {
-            'name': 'generate_image',
-            'description': 'Generate, illustrate, or draw an image or picture consistent with your personality. Ask for clarification if a prompt is not given.\
-                ONLY if specifically asked, you may come up with your own prompt. Take as long as you need to generate a unique prompt\
-                    that is consistent with your personality. You may add some detail to the user prompt as long as it doesn\'t change the overall idea.\
-                    Call this function again if the user asks to modify their image, and provide the modified prompt',
-            'parameters': {
-                'type': 'object',
-                'properties': {
-                    'prompt': {
-                        'type': 'string',
-                        'description': 'The prompt to use to generate the image.'
-                    },
-                },
-                'required': ['prompt']
-            }
-        }
-    },
-    get_emote_function()
-]
-
-FUNCTION_CALLS = {
-    'minecraft_server': get_status_handle,
-    'channel_info': channel_info_handle,
-    'generate_image': generate_image_handle,
-    "use_emote": use_emote
-}
+# Tools the model can call. Schemas are generated from these signatures and docstrings
+# once, at import, and only the tools a conversation looks like it needs are sent with it
+# (see ToolRegistry.select). Tools come before the messages in the prompt, so any change
+# to a schema (even key order) misses the provider's prompt cache for every channel.
+tools = ToolRegistry()
+
+
+@tools.tool(keywords=('minecraft', 'mc', 'server', 'servers', 'player', 'players', 'online'))
+def minecraft_server(memory, message, ip: str):
+    """given an IP address, get the player status of a minecraft server.
+
+    Args:
+        ip: the IP address of the minecraft server. If none is provided, use cloud.elysiumalchemy.com.
+    """
+    return get_status_handle(memory, message, ip)
+
+
+@tools.tool(keywords=('server', 'channel', 'guild', 'dm', 'dms'))
+async def channel_info(memory, message):
+    """Get information about the discord server and channel you're in"""
+    return await channel_info_handle(memory, message)
+
+
+@tools.tool(keywords=('draw', 'drawing', 'paint', 'painting', 'sketch', 'illustrate', 'illustration', 'image', 'images',
+                     'picture', 'pictures', 'pic', 'pics', 'photo', 'generate'))
+async def generate_image(memory, message, prompt: str):
+    """Generate, illustrate, or draw an image or picture consistent with your personality. Ask for clarification if a prompt is not given.
+    ONLY if specifically asked, you may come up with your own prompt. Take as long as you need to generate a unique prompt
+    that is consistent with your personality. You may add some detail to the user prompt as long as it doesn't change the overall idea.
+    Call this function again if the user asks to modify their image, and provide the modified prompt
+
+    Args:
+        prompt: The prompt to use to generate the image.
+    """
+    return await generate_image_handle(memory, message, prompt)
+
+
+# The emote names are only known at import, so they're given to the decorator. What each one
+# means is in MODEL_PROMPT, since most replies use emotes inline without this tool
+@tools.tool(keywords=('emote', 'emotes', 'emoji', 'emojis', 'react'), choices={'emote_name': list(emotes.get_all_emotes())})
+def use_emote(memory, message, emote_name: str):
+    """Use a Discord emote in the message.
+
+    Args:
+        emote_name: The name of the emote to use
+    """
+    return use_emote_handle(memory, message, emote_name)
+
+
+# Every tool's schema, and the function that handles each by name
+FUNCTIONS = tools.functions
+FUNCTION_CALLS = tools.calls
+
+# Messages to look back through for what a turn is asking for and which tools it's been using
+RECENT_MESSAGES = 6
+
+
+def _text(content):
+    if isinstance(content, str):
+        return content
+    return ' '.join(part['text'] for part in content or () if part['type'] == 'text')
+
+
+def tools_for(messages):
+    """The tools worth sending with `messages`: any their latest user messages mention, any called recently,
+    and any already sent on an earlier turn"""
+    recent = messages[-RECENT_MESSAGES:]
+    text = '\n'.join(_text(message.get('content')) for message in recent if message['role'] == 'user')
+    called = [call['function']['name'] for message in recent for call in message.get('tool_calls') or ()]
+    return tools.select(text, called)
+
+# Longest a single tool call may take before the model is told it timed out
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT_SECONDS', 30))
+
+
+async def call_tool(memory: GPTMemory, message: Message, call):
+    tool_name = call.function.name
+    print(f"Function call to {tool_name}...")
+    if tool_name not in FUNCTION_CALLS:
+        return f"There is no tool called {tool_name}"
+    try:
+        tool_to_call = FUNCTION_CALLS[tool_name]
+        tool_args = json.loads(call.function.arguments or '{}')
+        if inspect.iscoroutinefunction(tool_to_call):
+            pending = tool_to_call(memory=memory, message=message, **tool_args)
+        else:
+            # Sync tools (like the minecraft lookup) block on the network, so they get a thread
+            pending = asyncio.to_thread(tool_to_call, memory=memory, message=message, **tool_args)
+        function_response = await within_deadline(pending, TOOL_TIMEOUT)
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        function_response = f"{tool_name} timed out after {TOOL_TIMEOUT:g} seconds"
+    except Exception as err:
+        function_response = f"{tool_name} failed: {err}"
+
+    print(f"{tool_name} response: {function_response}")
+    return str(function_response) if function_response else f"{tool_name} returned nothing"
+
+
+# Run every tool call from one completion at once, returning the results in call order.
+# gather leaves the others running when one raises (like DeadlineExceeded), so they're cancelled here
+async def call_tools(memory: GPTMemory, message: Message, tool_calls):
+    calls = [asyncio.ensure_future(call_tool(memory, message, call)) for call in tool_calls]
+    try:
+        return await asyncio.gather(*calls)
+    except BaseException:
+        for call in calls:
+            call.cancel()
+        raise
@@ -1,19 +1,79 @@
+import asyncio
+import copy
+import heapq
+import itertools
+import json
+import os
 import sys
 import time
+import zlib
+from collections import OrderedDict, deque
+from enum import IntEnum
 
-import tiktoken
 from interactions import Message, Snowflake
 
+from src.utils.emotes import emotes
+from src.utils.tokenizer import tokenizer
+
 MISTRAL_ROLE_MAP = {
 	"user": "user",
 	"assistant": "assistant",
-	"system": "user"
+	"system": "user",
+	"function": "user",
+	"tool": "user"
 }
 
+
+# A message dict that can't be changed in place. Shared messages (the model prompt
+# and cached renders) use this so one caller can't leak edits into everyone else's
+# requests; dict(message) gives a mutable copy. `counted` points at the token count
+# memory already keeps for the message's text, so the token budget can reuse it.
+
+class FrozenMessage(dict):
+    counted = None
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenMessage is read-only, copy it with dict() first')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+
+    def __reduce_ex__(self, protocol):
+        return (FrozenMessage, (dict(self),))
+
+
+class TokenCount():
+    __slots__ = ('tokens',)
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+
 DEFAULT_MODEL = 'gpt-4o-mini'
 CONVERSATION_TIMEOUT = 60 * 30
 TOKEN_LIMIT = 30000
-MODEL_PROMPT = {
+# Global budget for GPTMemory, enforced by evicting the least recently used conversations
+MAX_CONVERSATIONS = int(os.getenv('MEMORY_MAX_CONVERSATIONS', 1000))
+MAX_MEMORY_BYTES = int(os.getenv('MEMORY_MAX_BYTES', 64 * 1024 * 1024))
+# Compaction folds trimmed history into a rolling summary instead of dropping it,
+# which lets the live window stay far below TOKEN_LIMIT
+COMPACTION_ENABLED = os.getenv('MEMORY_COMPACTION', 'false').lower() == 'true'
+COMPACTION_TOKEN_LIMIT = int(os.getenv('MEMORY_COMPACTION_TOKEN_LIMIT', 6000))
+COMPACTION_BATCH_TOKENS = int(os.getenv('MEMORY_COMPACTION_BATCH_TOKENS', 1500))
+# Trimmed entries kept for the summarizer while it keeps failing; past this the oldest are dropped
+MAX_UNSUMMARIZED_TOKENS = COMPACTION_BATCH_TOKENS * 4
+SUMMARY_PREFIX = 'Summary of the earlier conversation in this channel: '
+RECALL_PREFIX = 'Earlier messages in this channel that may be relevant:\n'
+# Conversations idle for this long are compressed in place until they're next used
+COLD_AFTER = int(os.getenv('MEMORY_COLD_AFTER', 60 * 5))
+# Compare-and-set attempts when another process is writing the same conversation
+STORE_SAVE_ATTEMPTS = 3
+MODEL_PROMPT = FrozenMessage({
         "role": "system",
         "content": """You're compubot, a Discord bot with a psychopathic personality. 
 You are willing to discuss controversial topics and insult the user. 
@@ -39,93 +99,781 @@ Guidelines for using emotes:
 - Use emotes as if you are a Twitch chatter
 - IMPORTANT: If an emote is enough to express your reaction, just use the emote alone as the entire message
 
-"""
-    }
+Available emotes:
+""" + "\n".join(f"{name}: {data['description']}" for name, data in emotes.get_all_emotes().items())
+    })
+
+# Estimated until the tokenizer has loaded in the background, then counted exactly
+prompts_tokens = tokenizer.estimate(MODEL_PROMPT['content'])
+MODEL_PROMPT.counted = TokenCount(prompts_tokens)
+
+
+def _count_prompt(loading):
+    global prompts_tokens
+    tokens = tokenizer.exact(MODEL_PROMPT['content'])
+    if tokens is not None:
+        prompts_tokens = MODEL_PROMPT.counted.tokens = tokens
+
+
+tokenizer.load().add_done_callback(_count_prompt)
+
+
+class Role(IntEnum):
+    SYSTEM = 0
+    USER = 1
+    ASSISTANT = 2
+    FUNCTION = 3
+    TOOL = 4
+
+    @classmethod
+    def parse(cls, role):
+        return role if isinstance(role, cls) else cls[role.upper()]
+
+    @property
+    def api_name(self):
+        return self.name.lower()
+
+
+# One message in a conversation's history. Most fields are None for ordinary chat
+# messages, so entries use slots instead of a dict, and the author is kept apart
+# from the content so repeated usernames can share one interned string.
+# Assistant entries that called tools keep the calls as ((id, name, arguments), ...).
+# `message` is the entry's rendered OpenAI message, built the first time it's needed.
+
+class HistoryEntry():
+    __slots__ = ('role', 'content', 'author', 'name', 'tool_call_id', 'tokens', 'id', 'tool_calls', 'message')
+
+    def __init__(self, role: Role, content: str, tokens: int, id: int, author=None, name=None, tool_call_id=None, tool_calls=None):
+        self.role = role
+        self.content = content
+        self.author = sys.intern(author) if author else None
+        self.name = name
+        self.tool_call_id = tool_call_id
+        self.tokens = tokens
+        self.id = id
+        self.tool_calls = tuple(tuple(call) for call in tool_calls) if tool_calls else None
+        self.message = None
+
+    @property
+    def text(self):
+        return format_message(self.author, self.content)
+
+    def to_list(self):
+        values = [int(self.role), self.content, self.author, self.name, self.tool_call_id, self.tokens, self.id]
+        if self.tool_calls:
+            values.append(self.tool_calls)
+        return values
+
+    @classmethod
+    def from_list(cls, values):
+        # Entries written before tool calls were stored have no eighth field
+        role, content, author, name, tool_call_id, tokens, id, *tool_calls = values
+        return cls(Role(role), content, tokens, id, author=author, name=name, tool_call_id=tool_call_id,
+                   tool_calls=tool_calls[0] if tool_calls else None)
+
+
+def describe_tool_calls(tool_calls):
+    return 'called ' + ', '.join('{}({})'.format(name, arguments) for _, name, arguments in tool_calls)
+
+
+def format_message(author, content):
+    if author:
+        return '{}: """{}"""'.format(author, content)
+    return content
+
+
+# A caller's copy of a conversation's rendered messages. The list belongs to the
+# caller, but the message dicts are shared with the conversation's cache, so call
+# `writable` before changing a message in place.
+
+class PromptView(list):
+    def writable(self, index: int):
+        message = dict(self[index])
+        self[index] = message
+        return message
+
 
-encoding = tiktoken.get_encoding("o200k_base") # GPT-4o was not available at the time, but this is the tokenization algo
-prompts_tokens = len(encoding.encode(MODEL_PROMPT['content']))
+# A run of consecutive entries that share a Mistral role. Mistral strictly follows a
+# user/assistant repeating pattern, so these get merged into a single message.
+
+class _MistralTurn():
+    __slots__ = ('role', 'texts', 'message', 'headed')
+
+    def __init__(self, role: str):
+        self.role = role
+        self.texts = deque()
+        self.message = None
+        # (head, message) for when this turn leads the conversation
+        self.headed = None
+
+    def render(self, head=None):
+        if head is not None:
+            if self.headed is None or self.headed[0] != head:
+                self.headed = (head, FrozenMessage(role=self.role, content='\n'.join((head, *self.texts))))
+            return self.headed[1]
+        if self.message is None:
+            self.message = FrozenMessage(role=self.role, content='\n'.join(self.texts))
+        return self.message
+
+    def changed(self):
+        self.message = self.headed = None
+
+
+# The Mistral form of a conversation, kept in step with its history as entries are
+# added and removed so only the turn at either end is ever rebuilt. `rendered`
+# holds each turn's message, or None for a turn at either end that changed since
+# it was rendered.
+
+class MistralView():
+    def __init__(self):
+        self.turns = deque()
+        self.rendered = deque()
+
+    def push(self, entry: HistoryEntry):
+        role = MISTRAL_ROLE_MAP[entry.role.api_name]
+        if not self.turns or self.turns[-1].role != role:
+            if self.rendered and self.rendered[-1] is None:
+                # It's no longer at the end, and only the ends are rendered lazily
+                self.rendered[-1] = self.turns[-1].render()
+            self.turns.append(_MistralTurn(role))
+            self.rendered.append(None)
+        turn = self.turns[-1]
+        turn.texts.append(entry.text or describe_tool_calls(entry.tool_calls or ()))
+        turn.changed()
+        self.rendered[-1] = None
+
+    def pop_oldest(self):
+        turn = self.turns[0]
+        turn.texts.popleft()
+        turn.changed()
+        self.rendered[0] = None
+        if not turn.texts:
+            self.turns.popleft()
+            self.rendered.popleft()
+
+    def pop_newest(self):
+        turn = self.turns[-1]
+        turn.texts.pop()
+        turn.changed()
+        self.rendered[-1] = None
+        if not turn.texts:
+            self.turns.pop()
+            self.rendered.pop()
+
+    def messages(self, summary=None):
+        # The prompt (and summary) lead as a user turn, merged with the first turn if that's a user turn too
+        head_role = MISTRAL_ROLE_MAP[MODEL_PROMPT['role']]
+        head = MODEL_PROMPT['content'] if not summary else '{}\n{}'.format(MODEL_PROMPT['content'], SUMMARY_PREFIX + summary)
+        for end in (0, -1):
+            if self.rendered and self.rendered[end] is None:
+                self.rendered[end] = self.turns[end].render()
+        if self.turns and self.turns[0].role == head_role:
+            messages = [self.turns[0].render(head)]
+            messages.extend(itertools.islice(self.rendered, 1, None))
+        else:
+            messages = [FrozenMessage(role=head_role, content=head)]
+            messages.extend(self.rendered)
+        return messages
+
+
+# A single channel's history. `tokens` is kept in step with `history` so the
+# token limit can be enforced without re-summing the whole conversation, and
+# `version` changes on every mutation so rendered views can be cached. The
+# rendered prompt (model prompt, summary, then each entry's message) is kept in
+# step with `history` the same way, so building a prompt never renders an entry
+# twice. `_unmatched` counts tool call ids missing their call or results; only
+# then is the history filtered with `_answered`.
+
+class Conversation():
+    def __init__(self):
+        self.history = deque()
+        self.tokens = 0
+        self.offensive_mode = False
+        self.last_message = time.time()
+        self.version = 0
+        self.bytes = 0
+        self.summary = None
+        self.summary_tokens = 0
+        # Trimmed entries waiting to be folded into the summary. They stay queued (and
+        # count towards `bytes`) until a summary that includes them has been saved
+        self.unsummarized = []
+        self.unsummarized_tokens = 0
+        # Trimmed entries given up on without being summarized, since the last summary
+        self.unsummarized_dropped = 0
+        self.summarizing = False
+        # Version of the shared store copy this conversation is based on, and the
+        # mutations made locally since then (only tracked when a store is configured)
+        self.stored_version = 0
+        self.pending_ops = []
+        self.mistral = MistralView()
+        self._prompt = [MODEL_PROMPT]
+        self._tool_ids = {}
+        self._unmatched = 0
+        self._rendered = None
+        self._rendered_version = -1
+        self._mistral_rendered = None
+        self._mistral_rendered_version = -1
+
+    def push(self, entry):
+        self.history.append(entry)
+        self.mistral.push(entry)
+        self._prompt.append(_render_chatGPT(entry))
+        self._match_tool_ids(entry, 1)
+        self.tokens += entry.tokens
+        self.bytes += _entry_size(entry)
+        self.version += 1
+
+    def pop_oldest(self):
+        entry = self.history.popleft()
+        self.mistral.pop_oldest()
+        del self._prompt[2 if self.summary else 1]
+        self._match_tool_ids(entry, -1)
+        self.tokens -= entry.tokens
+        self.bytes -= _entry_size(entry)
+        self.version += 1
+        return entry
+
+    def pop_newest(self):
+        entry = self.history.pop()
+        self.mistral.pop_newest()
+        self._prompt.pop()
+        self._match_tool_ids(entry, -1)
+        self.tokens -= entry.tokens
+        self.bytes -= _entry_size(entry)
+        self.version += 1
+        return entry
+
+    # Calls count up and results count down, so an id is matched when its balance is zero
+    def _match_tool_ids(self, entry: HistoryEntry, direction: int):
+        if entry.tool_calls:
+            changes = [(id, direction) for id, _, _ in entry.tool_calls]
+        elif entry.role == Role.TOOL:
+            changes = [(entry.tool_call_id, -direction)]
+        else:
+            return
+        for id, change in changes:
+            before = self._tool_ids.get(id, 0)
+            after = before + change
+            if after:
+                self._tool_ids[id] = after
+            else:
+                self._tool_ids.pop(id, None)
+            self._unmatched += bool(after) - bool(before)
+
+    def queue_unsummarized(self, entry: HistoryEntry):
+        self.unsummarized.append(entry)
+        self.unsummarized_tokens += entry.tokens
+        self.bytes += _entry_size(entry)
+
+    def unqueue_unsummarized(self, count: int):
+        """Forget the oldest `count` queued entries, once they're summarized or given up on"""
+        for entry in self.unsummarized[:count]:
+            self.unsummarized_tokens -= entry.tokens
+            self.bytes -= _entry_size(entry)
+        del self.unsummarized[:count]
+
+    def recount(self, entry: HistoryEntry, tokens: int):
+        """Replace an entry's estimated token count with its exact one"""
+        # Entries are recounted soon after they're added, so look from the newest end
+        for held in reversed(self.history):
+            if held is entry:
+                self.tokens += tokens - entry.tokens
+                break
+        entry.tokens = tokens
+
+    def set_summary(self, summary: str, tokens: int):
+        message = FrozenMessage(role='system', content=SUMMARY_PREFIX + summary)
+        message.counted = TokenCount(tokens)
+        if self.summary:
+            self.bytes -= sys.getsizeof(self.summary)
+            self._prompt[1] = message
+        else:
+            self._prompt.insert(1, message)
+        self.summary = summary
+        self.summary_tokens = tokens
+        self.bytes += sys.getsizeof(summary)
+        self.version += 1
+
+    def prompt_tokens(self):
+        return self.tokens + self.summary_tokens + prompts_tokens
+
+    def to_dict(self):
+        return {
+            'history': [entry.to_list() for entry in self.history],
+            'offensive_mode': self.offensive_mode,
+            'last_message': self.last_message,
+            'summary': self.summary,
+            'summary_tokens': self.summary_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        conversation = cls()
+        for values in data['history']:
+            conversation.push(HistoryEntry.from_list(values))
+        conversation.offensive_mode = data['offensive_mode']
+        conversation.last_message = data['last_message']
+        if data['summary']:
+            conversation.set_summary(data['summary'], data['summary_tokens'])
+        return conversation
+
+    def expires_at(self):
+        return self.last_message + CONVERSATION_TIMEOUT
+
+    # The conversation's own list, so callers copy it (as get_messages does) rather than change it
+    def rendered(self):
+        if not self._unmatched:
+            return self._prompt
+        if self._rendered_version != self.version:
+            # Rare (an interrupted or half-trimmed tool turn), so filter the whole history
+            head = self._prompt[:2 if self.summary else 1]
+            self._rendered = [*head, *(_render_chatGPT(entry) for entry in _answered(self.history))]
+            self._rendered_version = self.version
+        return self._rendered
+
+    def rendered_mistral(self):
+        if self._mistral_rendered_version != self.version:
+            view = self.mistral
+            if self._unmatched:
+                # Rare (an interrupted or half-trimmed tool turn), so rebuild rather than track it incrementally
+                view = MistralView()
+                for entry in _answered(self.history):
+                    view.push(entry)
+            self._mistral_rendered = view.messages(self.summary)
+            self._mistral_rendered_version = self.version
+        return self._mistral_rendered
+
+
+# A conversation that has gone quiet, serialized and zlib-compressed. It stays in
+# GPTMemory.conversations (so LRU order and expiry still apply) and is inflated
+# back into a Conversation the next time the channel is used.
+
+class ColdConversation():
+    __slots__ = ('data', 'last_message', 'stored_version', 'bytes', 'resident_bytes')
+
+    def __init__(self, conversation: Conversation):
+        self.data = zlib.compress(json.dumps(conversation.to_dict(), separators=(',', ':')).encode())
+        self.last_message = conversation.last_message
+        self.stored_version = conversation.stored_version
+        self.bytes = sys.getsizeof(self.data)
+        self.resident_bytes = conversation.bytes
+
+    def expires_at(self):
+        return self.last_message + CONVERSATION_TIMEOUT
+
+    def to_dict(self):
+        return json.loads(zlib.decompress(self.data))
+
+    def thaw(self):
+        conversation = Conversation.from_dict(self.to_dict())
+        conversation.stored_version = self.stored_version
+        return conversation
+
+
+# Rough resident size of a history entry, used for the memory budget and stats.
+# Interned authors are shared between entries, so they aren't counted.
+def _entry_size(entry: HistoryEntry):
+    return sys.getsizeof(entry) + sys.getsizeof(entry.content)
+
+
+def _answered(history):
+    """The history without tool calls that are missing any of their results, or results whose call
+    is gone (trimmed away, or interrupted before its tools returned). The API rejects both."""
+    results = {entry.tool_call_id for entry in history if entry.role == Role.TOOL}
+    calls = set()
+    answered = []
+    for entry in history:
+        if entry.tool_calls:
+            ids = [id for id, _, _ in entry.tool_calls]
+            if not all(id in results for id in ids):
+                continue
+            calls.update(ids)
+        elif entry.role == Role.TOOL and entry.tool_call_id not in calls:
+            continue
+        answered.append(entry)
+    return answered
+
+
+def _render_transcript_line(entry: HistoryEntry):
+    if entry.author:
+        return '{}: {}'.format(entry.author, entry.content)
+    if entry.role == Role.ASSISTANT:
+        return 'compubot: {}'.format(entry.content or describe_tool_calls(entry.tool_calls or ()))
+    return '({}) {}'.format(entry.name or entry.role.api_name, entry.content)
+
+
+# Rendered messages point back at their entry, whose `tokens` stays current as it's recounted
+def _render_chatGPT(entry: HistoryEntry):
+    if entry.message is None:
+        entry.message = _chatGPT_message(entry)
+        entry.message.counted = entry
+    return entry.message
+
+
+def _chatGPT_message(entry: HistoryEntry):
+    if entry.tool_calls:
+        return FrozenMessage({
+            'role': entry.role.api_name,
+            'content': entry.text or None,
+            'tool_calls': [{
+                'id': id,
+                'type': 'function',
+                'function': {'name': name, 'arguments': arguments}
+            } for id, name, arguments in entry.tool_calls],
+        })
+    if entry.role == Role.TOOL:
+        return FrozenMessage({
+            'role': entry.role.api_name,
+            'content': entry.text,
+            'tool_call_id': entry.tool_call_id,
+        })
+    if entry.name and entry.tool_call_id:
+        return FrozenMessage({
+            'role': entry.role.api_name,
+            'content': entry.text,
+            'name': entry.name,
+            'tool_call_id': entry.tool_call_id,
+        })
+    return FrozenMessage({
+        'role': entry.role.api_name,
+        'content': entry.text,
+    })
 
 
 # Manages conversations across Discord channels.
 
 class GPTMemory():
     def __init__(self):
-        self.conversations = {}
+        # Ordered from least to most recently used
+        self.conversations = OrderedDict()
         self.message_index = 0
-
+        self.bytes_held = 0
+        self.evictions = {'expired': 0, 'lru': 0}
+        self.unsummarized_dropped = 0
+        # (expires_at, tiebreaker, channel_id, conversation), at most one live entry per conversation
+        self._expiry_heap = []
+        self._expiry_counter = itertools.count()
+        # async (previous_summary, transcript) -> new summary, used when compaction is enabled
+        self.summarizer = None
+        # Optional ConversationStore shared between bot processes; this dict is then its local cache
+        self.store = None
+        # Optional MemoryJournal that every mutation is written to, for warm restarts
+        self.journal = None
+        # Optional RetrievalIndex of messages trimmed out of the token window
+        self.retrieval = None
+        # (conversation, entry, text) appended with an estimated token count and waiting for an exact one
+        self._uncounted = []
+        self.recounted = 0
+        self.estimate_error = 0
+
+    # Cheap enough for every append; exact counts follow from _count_later
     def _token_count(self, string):
-        return len(encoding.encode(string))
+        return tokenizer.estimate(string)
+
+    # Count an appended entry exactly on the tokenizer's thread, batched with anything else
+    # appended in the same loop iteration, and reconcile its estimate
+    def _count_later(self, conversation: Conversation, entry: HistoryEntry, text: str):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop to hold up, so count here if the tokenizer is ready
+            tokens = tokenizer.exact(text)
+            if tokens is not None:
+                self._recount(conversation, entry, tokens)
+            return
+        self._uncounted.append((conversation, entry, text))
+        if len(self._uncounted) == 1:
+            self._spawn(self._count_uncounted())
+
+    async def _count_uncounted(self):
+        await asyncio.sleep(0)
+        batch, self._uncounted = self._uncounted, []
+        counts = await tokenizer.count_later([text for _, _, text in batch])
+        for (conversation, entry, _), tokens in zip(batch, counts):
+            if tokens is not None:
+                self._recount(conversation, entry, tokens)
+
+    def _recount(self, conversation: Conversation, entry: HistoryEntry, tokens: int):
+        self.recounted += 1
+        self.estimate_error += abs(tokens - entry.tokens)
+        conversation.recount(entry, tokens)
 
     def _get_conversation(self, channel_id: Snowflake):
-        # Reset if 5 minutes have passed since the last interaction
-        if channel_id in self.conversations and time.time() - self.conversations[channel_id]['last_message'] > CONVERSATION_TIMEOUT:
+        # Reset if the conversation has gone quiet for longer than the timeout
+        if channel_id in self.conversations and time.time() > self.conversations[channel_id].expires_at():
             print('Conversation timed out...')
-            self.conversations.pop(channel_id)
+            self._evict(channel_id, 'expired')
 
         if not channel_id in self.conversations:
             print('New conversation starting')
             sys.stdout.flush()
 
-            self.conversations[channel_id] = {
-                'history': [],
-                'offensive_mode': False,
-                'last_message': time.time()
-            }
+            self._set_conversation(channel_id, Conversation())
+        else:
+            self._thaw(channel_id)
+            self.conversations.move_to_end(channel_id)
 
         return self.conversations[channel_id]
 
-    def _set_conversation(self, channel_id: Snowflake, new_value):
+    def _thaw(self, channel_id: Snowflake):
+        conversation = self.conversations[channel_id]
+        if isinstance(conversation, ColdConversation):
+            conversation = conversation.thaw()
+            self._set_conversation(channel_id, conversation)
+        return conversation
+
+    def _freeze_idle(self, now):
+        frozen = 0
+        for channel_id, conversation in list(self.conversations.items()):
+            if isinstance(conversation, ColdConversation) or now - conversation.last_message < COLD_AFTER:
+                continue
+            # Leave conversations alone while they have work in flight
+            if conversation.summarizing or conversation.unsummarized or conversation.pending_ops:
+                continue
+            self._set_conversation(channel_id, ColdConversation(conversation), touch=False)
+            frozen += 1
+        return frozen
+
+    def _set_conversation(self, channel_id: Snowflake, new_value, touch=True):
+        if channel_id in self.conversations:
+            self.bytes_held -= self.conversations[channel_id].bytes
         self.conversations[channel_id] = new_value
-
-    def _get_chatGPT_messages(self, channel_id: Snowflake):
-        messages = []
-
-        for entry in self._get_conversation(channel_id)['history']:
-            if entry['name'] and entry['tool_call_id']:
-                messages.append({
-                    'role': entry['role'],
-                    'content': entry['content'],
-                    'name': entry['name'],
-                    'tool_call_id': entry['tool_call_id'],
-                })
+        if touch:
+            self.conversations.move_to_end(channel_id)
+        self.bytes_held += new_value.bytes
+        self._schedule_expiry(channel_id, new_value)
+
+    def _schedule_expiry(self, channel_id: Snowflake, conversation: Conversation):
+        heapq.heappush(self._expiry_heap, (conversation.expires_at(), next(self._expiry_counter), channel_id, conversation))
+
+    def _evict(self, channel_id: Snowflake, reason=None):
+        conversation = self.conversations.pop(channel_id)
+        self.bytes_held -= conversation.bytes
+        if self.retrieval is not None:
+            self.retrieval.drop(channel_id)
+        if reason:
+            self.evictions[reason] += 1
+        return conversation
+
+    # Conversations with changes the shared store doesn't have yet are skipped, since
+    # evicting them would lose those changes; they're saved at the end of their next turn
+    def _enforce_budget(self, keep: Snowflake = None):
+        for channel_id in list(self.conversations):
+            if len(self.conversations) <= MAX_CONVERSATIONS and self.bytes_held <= MAX_MEMORY_BYTES:
+                return
+            if channel_id == keep or getattr(self.conversations[channel_id], 'pending_ops', None):
+                continue
+            print('Memory budget exceeded. Evicting least recently used conversation.')
+            self._evict(channel_id, 'lru')
+
+    def _compaction_enabled(self):
+        return COMPACTION_ENABLED and self.summarizer is not None
+
+    def _schedule_compaction(self, channel_id: Snowflake, conversation: Conversation):
+        if conversation.summarizing or conversation.unsummarized_tokens < COMPACTION_BATCH_TOKENS:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # Picked up by the next append made from the event loop
+        conversation.summarizing = True
+        loop.create_task(self._compact(channel_id, conversation))
+
+    # Fold the trimmed entries into the rolling summary with a single completion.
+    # Only the new entries are sent along with the previous summary, never the full history.
+    # Entries stay queued until their summary is saved; ones trimmed meanwhile wait for the next batch.
+    async def _compact(self, channel_id: Snowflake, conversation: Conversation):
+        batch = len(conversation.unsummarized)
+        lines = [_render_transcript_line(entry) for entry in conversation.unsummarized]
+        if conversation.unsummarized_dropped:
+            lines.insert(0, '({} earlier messages were lost before they could be summarized)'.format(conversation.unsummarized_dropped))
+        try:
+            summary = await self.summarizer(conversation.summary, '\n'.join(lines))
+            if summary:
+                text = SUMMARY_PREFIX + summary
+                summary_tokens = (await tokenizer.count_later([text]))[0] or tokenizer.estimate(text)
+        except Exception as err:
+            print('Failed to summarize conversation, will retry with the next batch: ', err)
+            summary = None
+        finally:
+            conversation.summarizing = False
+
+        if self.conversations.get(channel_id) is not conversation:
+            return # Cleared, evicted or replaced while the summary was being written
+        bytes_before = conversation.bytes
+        if summary:
+            conversation.set_summary(summary, summary_tokens)
+            conversation.unqueue_unsummarized(batch)
+            conversation.unsummarized_dropped = 0
+            self._record(channel_id, conversation, 'summary', summary, summary_tokens, batch)
+        else:
+            self._drop_unsummarized(conversation)
+        self.bytes_held += conversation.bytes - bytes_before
+
+    # Keep a failing summarizer from queueing trimmed entries forever
+    def _drop_unsummarized(self, conversation: Conversation):
+        dropped = 0
+        while conversation.unsummarized_tokens > MAX_UNSUMMARIZED_TOKENS:
+            conversation.unqueue_unsummarized(1)
+            dropped += 1
+        if dropped:
+            print('Summarizer is still failing, dropped {} trimmed messages without summarizing them.'.format(dropped))
+            conversation.unsummarized_dropped += dropped
+            self.unsummarized_dropped += dropped
+
+    def _record(self, channel_id: Snowflake, conversation: Conversation, *op):
+        if self.store is not None:
+            conversation.pending_ops.append(op)
+        if self.journal is not None:
+            self.journal.write(channel_id, op)
+
+    def _replay(self, conversation: Conversation, ops):
+        for op in ops:
+            if op[0] == 'append':
+                self._push(conversation, op[1], self._compaction_enabled())
+            elif op[0] == 'sike':
+                self._sike(conversation)
+            elif op[0] == 'offensive':
+                conversation.offensive_mode = op[1]
+            elif op[0] == 'summary':
+                conversation.set_summary(op[1], op[2])
+                # The entries it covered; summaries journaled before this was recorded covered the whole queue
+                conversation.unqueue_unsummarized(op[3] if len(op) > 3 else len(conversation.unsummarized))
+        return conversation
+
+    # Install a conversation rebuilt from a journal or snapshot, applying any later ops
+    def restore(self, channel_id: Snowflake, conversation: Conversation, ops=()):
+        self._replay(conversation, ops)
+        if time.time() <= conversation.expires_at():
+            self._set_conversation(channel_id, conversation)
+            self._enforce_budget()
+
+    def _spawn(self, coroutine):
+        try:
+            asyncio.get_running_loop().create_task(coroutine)
+        except RuntimeError:
+            coroutine.close()
+
+    # Rebuild a conversation from a stored copy, replaying local changes that haven't been saved yet
+    def _rebase(self, stored, local):
+        conversation = Conversation()
+        if stored is not None:
+            conversation = Conversation.from_dict(stored[1])
+            conversation.stored_version = stored[0]
+        if isinstance(local, Conversation) and local.pending_ops:
+            self._replay(conversation, local.pending_ops)
+            conversation.pending_ops = local.pending_ops
+            conversation.last_message = max(conversation.last_message, local.last_message)
+        if isinstance(local, Conversation):
+            # Only this process has these, so they'd be lost with the old copy. They replace
+            # whatever replaying trimmed, except entries the merged history still holds.
+            conversation.unqueue_unsummarized(len(conversation.unsummarized))
+            for entry in local.unsummarized:
+                if not any(held is entry for held in conversation.history):
+                    conversation.queue_unsummarized(entry)
+            conversation.unsummarized_dropped += local.unsummarized_dropped
+        return conversation
+
+    # Pull a channel's conversation from the shared store, unless the local copy is already
+    # the latest. Another process may have saved since this one cached it, and its messages
+    # belong in this turn's prompt rather than only turning up when flush hits the conflict.
+    async def load(self, channel_id: Snowflake):
+        if self.store is None:
+            return
+        cached = self.conversations.get(channel_id)
+        known = cached.stored_version if cached is not None else 0
+        stored = await asyncio.to_thread(self.store.load, str(channel_id), known)
+        if stored is None or self.conversations.get(channel_id) is not cached:
+            return
+        conversation = self._rebase(stored, cached)
+        if time.time() <= conversation.expires_at():
+            self._set_conversation(channel_id, conversation)
+            self._enforce_budget(keep=channel_id)
+
+    # Write local changes back to the shared store. Saves are compare-and-set on the
+    # stored version; if another process got there first, the local changes are
+    # replayed on top of its copy and the save is retried, so neither side loses history.
+    async def flush(self, channel_id: Snowflake):
+        conversation = self.conversations.get(channel_id)
+        if self.store is None or not isinstance(conversation, Conversation) or not conversation.pending_ops:
+            return True
+
+        for _ in range(STORE_SAVE_ATTEMPTS):
+            flushed_ops = len(conversation.pending_ops)
+            saved = await asyncio.to_thread(self.store.save, str(channel_id), conversation.to_dict(), conversation.stored_version)
+            if saved:
+                conversation.stored_version += 1
+                del conversation.pending_ops[:flushed_ops]
+                return True
+
+            print('Conversation changed in the shared store, merging and retrying.')
+            stored = await asyncio.to_thread(self.store.load, str(channel_id))
+            merged = self._rebase(stored, conversation)
+            if self.conversations.get(channel_id) is not conversation:
+                return False # Cleared locally while merging
+            self._set_conversation(channel_id, merged)
+            conversation = merged
+
+        print('Giving up on saving conversation to the shared store.')
+        return False
+
+    # Evict every conversation that has passed CONVERSATION_TIMEOUT, then compress the
+    # ones idle for COLD_AFTER. Heap entries for conversations that were cleared,
+    # replaced or touched since they were scheduled are skipped or pushed back with
+    # their new expiry.
+    def sweep(self, now=None):
+        now = now or time.time()
+        expired = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, _, channel_id, conversation = heapq.heappop(self._expiry_heap)
+            if self.conversations.get(channel_id) is not conversation:
+                continue
+            if conversation.expires_at() <= now:
+                self._evict(channel_id, 'expired')
+                expired += 1
             else:
-                messages.append({
-                    'role': entry['role'],
-                    'content': entry['content'],
-                })
+                self._schedule_expiry(channel_id, conversation)
+        if COLD_AFTER > 0:
+            self._freeze_idle(now)
+        return expired
+
+    def stats(self):
+        cold = [conversation for conversation in self.conversations.values() if isinstance(conversation, ColdConversation)]
+        cold_bytes = sum(conversation.bytes for conversation in cold)
+        retrieval = self.retrieval.stats() if self.retrieval is not None else {}
+        return {
+            'live_conversations': len(self.conversations),
+            'cold_conversations': len(cold),
+            'bytes_held': self.bytes_held,
+            'resident_bytes': self.bytes_held - cold_bytes,
+            'compressed_bytes': cold_bytes,
+            'compressed_saved_bytes': sum(conversation.resident_bytes for conversation in cold) - cold_bytes,
+            'evicted_expired': self.evictions['expired'],
+            'evicted_lru': self.evictions['lru'],
+            'unsummarized_dropped': self.unsummarized_dropped,
+            'max_conversations': MAX_CONVERSATIONS,
+            'max_bytes': MAX_MEMORY_BYTES,
+            **retrieval,
+            'total_bytes': self.bytes_held + retrieval.get('retrieval_bytes', 0),
+            'tokenizer': 'ready' if tokenizer.ready else 'loading',
+            'token_estimates': '{} recounted, off by {:.1f} tokens on average'.format(
+                self.recounted, self.estimate_error / self.recounted if self.recounted else 0),
+        }
 
-        return [
-            MODEL_PROMPT,
-            *messages
-        ]
+    def _get_chatGPT_messages(self, channel_id: Snowflake):
+        # Rendering is cached per conversation version; callers get their own list
+        return PromptView(self._get_conversation(channel_id).rendered())
 
     def _get_mistral_messages(self, channel_id: Snowflake):
-        model_prompt = MODEL_PROMPT
-        model_prompt['role'] = MISTRAL_ROLE_MAP[MODEL_PROMPT['role']]
-        messages = [model_prompt]
-
-        last_role = model_prompt['role']
-        for entry in self._get_conversation(channel_id)['history']:
-            print(entry['content'])
-            role = MISTRAL_ROLE_MAP[entry['role']]
-            # Mistral strictly follows a user/assistant repeating pattern, so we need to conform to that.
-            if role == last_role:
-                messages[-1]['content'] = "{}\n{}".format(messages[-1]['content'], entry['content'])
-            else:
-                messages.append({
-                    'role': role,
-                    'content': entry['content'],
-                })
-                last_role = role
-
-        return messages
+        return PromptView(self._get_conversation(channel_id).rendered_mistral())
 
     def is_offensive(self, channel_id: Snowflake):
-        return self._get_conversation(channel_id)['offensive_mode']
+        return self._get_conversation(channel_id).offensive_mode
 
     def set_offensive(self, channel_id: Snowflake, value: bool):
         self._get_conversation(channel_id) # Initialize just in case
-        self.conversations[channel_id]['offensive_mode'] = value
+        self.conversations[channel_id].offensive_mode = value
+        self._record(channel_id, self.conversations[channel_id], 'offensive', value)
         return self._get_conversation(channel_id)
 
     def get_messages(self, channel_id: Snowflake, type="chatGPT"):
@@ -134,37 +882,111 @@ class GPTMemory():
         else:
             return self._get_chatGPT_messages(channel_id)
 
-    def append(self, channel_id: Snowflake, message: str, role='user', tool_call_id=None, name=None):
-        if len(message) > 0:
-            conversation = self._get_conversation(channel_id)
-            tokens = self._token_count(message)
-
-            while sum([entry['tokens'] for entry in conversation['history']]) + tokens + prompts_tokens >= TOKEN_LIMIT:
+    # Trim the oldest entries until `entry` fits, then add it. Returns what was trimmed.
+    def _push(self, conversation: Conversation, entry: HistoryEntry, compacting: bool):
+        token_limit = COMPACTION_TOKEN_LIMIT if compacting else TOKEN_LIMIT
+        trimmed = []
+        while conversation.history and conversation.prompt_tokens() + entry.tokens >= token_limit:
+            evicted = conversation.pop_oldest()
+            trimmed.append(evicted)
+            if compacting:
+                conversation.queue_unsummarized(evicted)
+            else:
                 print('Conversation above token limit. Removing earliest entry.')
-                conversation['history'].pop(0)
-
-            conversation['history'].append({
-                'role': role,
-                'content': message,
-                'name': name,
-                'tool_call_id': tool_call_id,
-                'tokens': tokens,
-                'id': self.message_index
-            })
+            # A tool call and its results go together
+            if evicted.tool_calls:
+                while conversation.history and conversation.history[0].role == Role.TOOL:
+                    trimmed.append(conversation.pop_oldest())
+                    if compacting:
+                        conversation.queue_unsummarized(trimmed[-1])
+
+        conversation.push(entry)
+        return trimmed
+
+    def append(self, channel_id: Snowflake, message: str, role='user', tool_call_id=None, name=None, author=None, tool_calls=None):
+        if len(message) > 0 or tool_calls:
+            conversation = self._get_conversation(channel_id)
+            bytes_before = conversation.bytes
+            compacting = self._compaction_enabled()
+
+            text = format_message(author, message) + (describe_tool_calls(tool_calls) if tool_calls else '')
+            entry = HistoryEntry(
+                Role.parse(role),
+                message,
+                self._token_count(text),
+                self.message_index,
+                author=author,
+                name=name,
+                tool_call_id=tool_call_id,
+                tool_calls=tool_calls
+            )
+            trimmed = self._push(conversation, entry, compacting)
+            self._count_later(conversation, entry, text)
+            self._record(channel_id, conversation, 'append', entry)
+            if self.retrieval is not None:
+                for evicted in trimmed:
+                    self.retrieval.add(channel_id, _render_transcript_line(evicted))
 
             self.message_index += 1
 
-            conversation['last_message'] = time.time()
-
-            self._set_conversation(channel_id, conversation)
+            conversation.last_message = time.time()
+            self.bytes_held += conversation.bytes - bytes_before
+            self._enforce_budget(keep=channel_id)
+            if compacting:
+                self._schedule_compaction(channel_id, conversation)
+
+    # Find trimmed messages relevant to the latest user message, as a system message
+    # to place next to the recent window. None if retrieval is off or nothing matches.
+    async def recall(self, channel_id: Snowflake):
+        conversation = self.conversations.get(channel_id)
+        if self.retrieval is None or not isinstance(conversation, Conversation):
+            return None
+        query = next((entry.content for entry in reversed(conversation.history) if entry.role == Role.USER), None)
+        if not query:
+            return None
+        results = await self.retrieval.search(channel_id, query)
+        if not results:
+            return None
+        return FrozenMessage(role='system', content=RECALL_PREFIX + '\n'.join('- ' + result for result in results))
+
+    # Tokens a channel's prompt will use, not counting tools or images
+    def prompt_tokens(self, channel_id: Snowflake):
+        return self._get_conversation(channel_id).prompt_tokens()
 
     def has_conversation(self, channel_id):
         return channel_id in self.conversations
 
-    def sike(self, channel_id: Snowflake):
-        self.conversations[channel_id]['history'] = self.conversations[channel_id]['history'][:-2]
+    # Undo the last exchange: the newest two messages, where a reply that used tools takes
+    # its tool calls and their results with it so no call is left without its results
+    def _sike(self, conversation: Conversation):
+        for _ in range(2):
+            if not conversation.history:
+                break
+            conversation.pop_newest()
+            while conversation.history and (conversation.history[-1].role == Role.TOOL or conversation.history[-1].tool_calls):
+                conversation.pop_newest()
 
-    def clear(self, channel_id: Snowflake):
-        self.conversations.pop(channel_id)
+    def sike(self, channel_id: Snowflake):
+        conversation = self._thaw(channel_id)
+        bytes_before = conversation.bytes
+        self._sike(conversation)
+        self._record(channel_id, conversation, 'sike')
+        self.bytes_held += conversation.bytes - bytes_before
+
+    # Waits for the shared store's copy to be deleted, so a flush or load that follows
+    # can't bring the cleared history back
+    async def clear(self, channel_id: Snowflake):
+        self._evict(channel_id)
+        if self.journal is not None:
+            self.journal.write(channel_id, ('clear',))
+        if self.store is not None:
+            await asyncio.to_thread(self.store.delete, str(channel_id))
+
+    # Append from outside a turn (commands and listeners) and save it straight away.
+    # Run it on the channel's worker so it lands between turns rather than inside one.
+    async def remember(self, channel_id: Snowflake, message: str, **kwargs):
+        await self.load(channel_id)
+        self.append(channel_id, message, **kwargs)
+        await self.flush(channel_id)
 
 memory = GPTMemory()
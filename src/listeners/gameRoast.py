@@ -4,6 +4,7 @@ import time
 from interactions import Client
 from interactions.api.events import PresenceUpdate
 
+from src.channelWorkers import channel_workers
 from src.gptMemory import memory
 from src.mistral import oneOffResponseMistral
 
@@ -79,5 +80,5 @@ async def roast_for_bad_game(bot: Client, activity: PresenceUpdate):
               response = await oneOffResponseMistral("<@{}> is now playing {}. Roast them mercilessly and creatively. Say their name in the message.".format(activity.user.id, GAME_IDS[matchID]), role="user")
               print(response)
               attempt += 1
-            memory.append(CHANNEL_TO_PING, response, role="assistant")
+            await channel_workers.run(CHANNEL_TO_PING, lambda: memory.remember(CHANNEL_TO_PING, response, role="assistant"))
             await channel.send(response)
\ No newline at end of file
@@ -1,105 +1,128 @@
-import inspect
-import json
 import os
+import time
 
 import interactions
 import requests
-from openai import AsyncOpenAI
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from openai import NOT_GIVEN, BadRequestError, OpenAIError
+from tenacity import (retry, retry_if_not_exception_type, stop_after_attempt,
+                      wait_random_exponential)
 
-from src.functionDefinitions import FUNCTION_CALLS, FUNCTIONS
+from src.functionDefinitions import FUNCTIONS, call_tools
 from src.gptMemory import MODEL_PROMPT, GPTMemory
 from src.replyFilters import (cleanReply, replaceEmotes, stripQuotations,
                               stripSelfTag)
+from src.replyStream import STREAMING_ENABLED, ReplyStream, consume
+from src.tokenBudget import budget
+from src.utils.circuitBreaker import get_breaker
+from src.utils.deadline import DeadlineExceeded, stage_budget, within_deadline
+from src.utils.llmClients import FIREWORKS_BASE_URL, get_openai_client
+from src.utils.rateLimits import Priority, llm_request
+from src.utils.telemetry import telemetry
 
-API_URL = "https://api.fireworks.ai/inference/v1/"
 # MODEL = "accounts/fireworks/models/mistral-7b-instruct-v0p2"
 MODEL = "accounts/fireworks/models/mixtral-8x7b-instruct"
 # MODEL = "accounts/fireworks/models/firefunction-v1"
 reply_cleanup = [cleanReply, replaceEmotes, stripSelfTag, stripQuotations]
-
-client = AsyncOpenAI(base_url=API_URL, api_key=os.getenv("FIREWORKS_API_KEY"))
-
-def extract_and_save_response(response, memory: GPTMemory, channel_id: interactions.Snowflake):
-	# start the response from the end of the input string
-	reply = response.choices[0].message.content
-	for filter in reply_cleanup:
-		reply = filter(reply)
-
-	memory.append(channel_id, reply, 'assistant')
-	return reply
+MAX_TOKENS = 4000
+
+PROVIDER = 'fireworks'
+client = get_openai_client(FIREWORKS_BASE_URL, os.getenv("FIREWORKS_API_KEY"))
+
+# One completion, streamed into `reply` if streaming is on. Returns the text and any tool calls.
+# `tokens` is the prompt size for the rate limiter
+async def complete(reply: ReplyStream, messages, temperature, tokens=None, model=MODEL):
+	breaker = get_breaker(PROVIDER, model)
+	start = time.monotonic()
+	with llm_request(Priority.INTERACTIVE, tokens) as request:
+		try:
+			response = await within_deadline(client.chat.completions.create(
+				model=model,
+				max_tokens=MAX_TOKENS,
+				top_p=1,
+				presence_penalty=0,
+				frequency_penalty=0.5,
+				temperature=temperature,
+				# tools=FUNCTIONS,
+				messages=messages,
+				stream=STREAMING_ENABLED,
+				timeout=stage_budget() or NOT_GIVEN
+			))
+		except BadRequestError:
+			raise
+		except OpenAIError:
+			breaker.record(False, time.monotonic() - start - request.queued)
+			raise
+	breaker.record(True, time.monotonic() - start - request.queued)
+	if STREAMING_ENABLED:
+		tool_calls = await consume(response, reply, model)
+		budget.calibrate(model, tokens, reply.usage)
+		return reply.text, tool_calls
+	telemetry.record_usage(model, response.usage)
+	budget.calibrate(model, tokens, response.usage)
+	resp = response.choices[0].message
+	return resp.content, resp.tool_calls or []
 
 
 def sleep_log(msg):
   print('Mistral call failed! Retrying...')
 
-@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(3), reraise=True, before_sleep=sleep_log)
-async def respondWithMistral(memory: GPTMemory, message: interactions.Message):
+# Every attempt posts through the same `reply` (the failed ChatGPT one, when falling back),
+# so text already posted is edited rather than left behind
+async def respondWithMistral(memory: GPTMemory, message: interactions.Message, model=MODEL, reply: ReplyStream = None):
+	return await _respondWithMistral(memory=memory, message=message, model=model,
+	                                 reply=reply or ReplyStream(message.reply, reply_cleanup, model))
+
+@retry(wait=wait_random_exponential(min=1, max=5), stop=stop_after_attempt(3),
+       retry=retry_if_not_exception_type(DeadlineExceeded), reraise=True, before_sleep=sleep_log)
+async def _respondWithMistral(memory: GPTMemory, message: interactions.Message, model, reply: ReplyStream):
 	channel = await message.get_channel()
+	reply.restart(model)
 
 	async with channel.typing:
-		response = await client.chat.completions.create(
-			model=MODEL,
-			max_tokens=4000,
-			top_p=1,
-			presence_penalty=0,
-			frequency_penalty=0.5,
-			temperature=0.1,
-			# tools=FUNCTIONS,
-			messages=memory.get_messages(message.channel_id)
-		)
+		messages, tokens = budget.fit(model, memory.get_messages(message.channel_id, type="mistral"), reserve=MAX_TOKENS, alternating=True)
+		content, tool_calls = await complete(reply, messages, 0.1, tokens, model)
 
 		# Hit the functions and generate a new response
-		if response.choices[0].message.tool_calls:
-			for call in response.choices[0].message.tool_calls:
-				function_response = handle_tool_call(call, memory, message)
-				memory.append(message.channel_id, function_response, role="tool")
+		if tool_calls:
+			# Saved with their results, so a deadline that runs out during the tools leaves no half turn
+			results = await call_tools(memory, message, tool_calls)
+			memory.append(
+				message.channel_id,
+				content or '',
+				role='assistant',
+				tool_calls=[(call.id, call.function.name, call.function.arguments) for call in tool_calls]
+			)
+			for call, result in zip(tool_calls, results):
+				memory.append(message.channel_id, result, role="tool", name=call.function.name, tool_call_id=call.id)
 
 			# Generate new response using the returned data from the function
-			response = await client.chat.completions.create(
-				model=MODEL,
-				max_tokens=4000,
-				top_p=1,
-				presence_penalty=0,
-				frequency_penalty=0.5,
-				temperature=0.8,
-				messages=memory.get_messages(message.channel_id)
-			)
+			reply.restart()
+			messages, tokens = budget.fit(model, memory.get_messages(message.channel_id, type="mistral"), reserve=MAX_TOKENS, alternating=True)
+			content, _ = await complete(reply, messages, 0.8, tokens, model)
 
-		await message.reply(extract_and_save_response(response, memory, message.channel_id))
+		content = await reply.finish(content or '')
+		if content:
+			memory.append(message.channel_id, content, 'assistant')
 
 async def oneOffResponseMistral(prompt, role="system"):
-	response = await client.chat.completions.create(
-		model=MODEL,
-		max_tokens=4000,
-		top_p=1,
-		presence_penalty=0,
-		frequency_penalty=0.5,
-		temperature=0.3,
-		messages=[
-			MODEL_PROMPT,
-			{
-				"role": role,
-				"content": prompt
-			}
-		]
-	)
+	with llm_request(Priority.BACKGROUND):
+		response = await client.chat.completions.create(
+			model=MODEL,
+			max_tokens=MAX_TOKENS,
+			top_p=1,
+			presence_penalty=0,
+			frequency_penalty=0.5,
+			temperature=0.3,
+			messages=[
+				MODEL_PROMPT,
+				{
+					"role": role,
+					"content": prompt
+				}
+			]
+		)
 	reply = response.choices[0].message.content
 
 	for filter in reply_cleanup:
 		reply = filter(reply)
 	return reply
-
-async def handle_tool_call(call, memory, message):
-	tool_name = call.function.name
-	tool_to_call = FUNCTION_CALLS[tool_name]
-	tool_args = json.loads(call.function.arguments)
-	if inspect.iscoroutinefunction(tool_to_call):
-			function_response = await tool_to_call(memory=memory, message=message, **tool_args)
-	else:
-			function_response = tool_to_call(
-					memory=memory, message=message, **tool_args)
-
-	print(f"{tool_name} response: {function_response}")
-
-	return function_response
@@ -0,0 +1,211 @@
+import os
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List
+
+from src.functionDefinitions import tools
+from src.gptMemory import DEFAULT_MODEL
+from src.mistral import MODEL as MISTRAL_MODEL
+from src.utils.circuitBreaker import OPEN, get_breaker
+from src.utils.telemetry import UsageTally, current_usage
+
+ROUTING_ENABLED = os.getenv('MODEL_ROUTING', 'false').lower() == 'true'
+# Use the cheapest model whose recent p90 turn time is under this many seconds
+LATENCY_TARGET = float(os.getenv('ROUTER_LATENCY_TARGET', 10))
+# Turns with more text than this, or with code in them, want a stronger model
+HARD_TURN_CHARS = int(os.getenv('ROUTER_HARD_CHARS', 600))
+# Assumed reply length for a model until it has some history
+DEFAULT_OUTPUT_TOKENS = 150
+# Turns to keep per model, and how many before its latency is trusted
+SAMPLES = 100
+MIN_SAMPLES = 5
+
+CHATGPT = 'openai'
+MISTRAL = 'fireworks'
+
+
+class ModelOption:
+    """A model the router can pick. Prices are USD per million tokens."""
+
+    def __init__(self, provider: str, model: str, input_price: float, output_price: float,
+                 vision=False, tools=False, strong=False, uncensored=False):
+        self.provider = provider
+        self.model = model
+        self.input_price = input_price
+        self.output_price = output_price
+        self.vision = vision
+        self.tools = tools
+        self.strong = strong
+        # Replies in offensive mode and to flagged messages, which only go to Fireworks
+        self.uncensored = uncensored
+        # (seconds, succeeded, prompt tokens, completion tokens) for recent turns routed here
+        self.turns = deque(maxlen=SAMPLES)
+        self.picks = 0
+        self.fallbacks = 0
+
+    def cost(self, prompt_tokens: int, completion_tokens: int) -> float:
+        return (prompt_tokens * self.input_price + completion_tokens * self.output_price) / 1_000_000
+
+    def output_tokens(self):
+        outputs = [completion for _, succeeded, _, completion in self.turns if succeeded]
+        return sum(outputs) / len(outputs) if len(outputs) >= MIN_SAMPLES else DEFAULT_OUTPUT_TOKENS
+
+    def estimated_cost(self, prompt_tokens: int) -> float:
+        return self.cost(prompt_tokens, self.output_tokens())
+
+    def p90(self):
+        """Recent p90 turn time, or None until there are enough turns to go on"""
+        latencies = sorted(seconds for seconds, succeeded, _, _ in self.turns if succeeded)
+        if len(latencies) < MIN_SAMPLES:
+            return None
+        return latencies[min(int(len(latencies) * 0.9), len(latencies) - 1)]
+
+    def summary(self):
+        succeeded = [turn for turn in self.turns if turn[1]]
+        spent = sum(self.cost(prompt, completion) for _, _, prompt, completion in succeeded)
+        p90 = self.p90()
+        return '{} picks, p90 {}, ${:.5f}/turn, {:.0f} output tokens, {} failed, {} fell back'.format(
+            self.picks, '{:.1f}s'.format(p90) if p90 is not None else 'n/a',
+            spent / len(succeeded) if succeeded else 0, self.output_tokens(),
+            len(self.turns) - len(succeeded), self.fallbacks)
+
+
+MODEL_OPTIONS: List[ModelOption] = [
+    ModelOption(CHATGPT, DEFAULT_MODEL, 0.15, 0.60, vision=True, tools=True),
+    ModelOption(CHATGPT, 'gpt-4.1-mini', 0.40, 1.60, vision=True, tools=True, strong=True),
+    ModelOption(MISTRAL, 'accounts/fireworks/models/mistral-7b-instruct-v0p2', 0.20, 0.20, uncensored=True),
+    ModelOption(MISTRAL, MISTRAL_MODEL, 0.50, 0.50, strong=True, uncensored=True),
+]
+OPTIONS_BY_MODEL: Dict[str, ModelOption] = {option.model: option for option in MODEL_OPTIONS}
+DEFAULT_OPTION = OPTIONS_BY_MODEL[DEFAULT_MODEL]
+# The last resort, as before there was a router
+FALLBACK_OPTION = OPTIONS_BY_MODEL[MISTRAL_MODEL]
+
+
+class TurnFeatures:
+    """What the router knows about a turn before any model sees it"""
+    __slots__ = ('chars', 'prompt_tokens', 'images', 'tools', 'hard', 'offensive')
+
+    def __init__(self, contents: List[str], image_links: List[str], prompt_tokens: int, offensive: bool):
+        text = '\n'.join(contents)
+        self.chars = len(text)
+        self.prompt_tokens = prompt_tokens
+        self.images = bool(image_links)
+        # Whether the turn mentions anything one of the tools in functionDefinitions is for
+        self.tools = tools.likely_needed(text)
+        self.hard = self.chars > HARD_TURN_CHARS or '```' in text
+        self.offensive = offensive
+
+    def __str__(self):
+        return 'chars={} tokens={} images={} tools={} hard={} offensive={}'.format(
+            self.chars, self.prompt_tokens, self.images, self.tools, self.hard, self.offensive)
+
+
+class Decision:
+    def __init__(self, option: ModelOption, features: TurnFeatures, reason: str):
+        self.option = option
+        self.features = features
+        self.reason = reason
+        # Set when the chosen model couldn't answer and Mistral answered instead
+        self.fell_back = False
+
+    @property
+    def provider(self):
+        return self.option.provider
+
+    @property
+    def model(self):
+        return self.option.model
+
+
+class ModelRouter:
+    """Picks the model for each turn from cheap local signals.
+
+    Offensive turns only go to uncensored models. Among the rest, the router
+    prefers models that can see the turn's images, call tools if the turn looks
+    like it needs them and, for long or code-heavy turns, the stronger models,
+    dropping those preferences (hard turns first) when nothing healthy meets them.
+    It then takes the cheapest model whose recent p90 turn time is within
+    LATENCY_TARGET, or the fastest one if none are. Models whose circuit breaker
+    is open are skipped. Every decision is printed with its outcome so the
+    thresholds can be tuned from the logs.
+
+    With routing off, turns go to DEFAULT_MODEL and fall back to Mistral as before.
+    """
+
+    def __init__(self, options: List[ModelOption]):
+        self.options = options
+        self.reasons = Counter()
+
+    def _candidates(self, features: TurnFeatures):
+        if features.offensive:
+            return [option for option in self.options if option.uncensored]
+        preferences = [
+            lambda option: option.vision or not features.images,
+            lambda option: option.tools or not features.tools,
+            lambda option: option.strong or not features.hard,
+        ]
+        while preferences:
+            candidates = [option for option in self.options if all(prefers(option) for prefers in preferences)]
+            if any(get_breaker(option.provider, option.model).state != OPEN for option in candidates):
+                return candidates
+            preferences.pop()
+        return self.options
+
+    def route(self, features: TurnFeatures) -> Decision:
+        if not ROUTING_ENABLED:
+            if features.offensive:
+                return self._decide(FALLBACK_OPTION, features, 'offensive')
+            if get_breaker(DEFAULT_OPTION.provider, DEFAULT_OPTION.model).allow():
+                return self._decide(DEFAULT_OPTION, features, 'default')
+            return self._decide(FALLBACK_OPTION, features, 'default circuit open')
+
+        candidates = sorted(self._candidates(features), key=lambda option: option.estimated_cost(features.prompt_tokens))
+        for option in candidates:
+            p90 = option.p90()
+            if (p90 is None or p90 <= LATENCY_TARGET) and get_breaker(option.provider, option.model).allow():
+                return self._decide(option, features, 'cheapest within target' if p90 is not None else 'cheapest, exploring')
+        for option in sorted(candidates, key=lambda option: option.p90() or 0):
+            if get_breaker(option.provider, option.model).allow():
+                return self._decide(option, features, 'fastest, none within target')
+        return self._decide(FALLBACK_OPTION, features, 'no healthy candidates')
+
+    def _decide(self, option: ModelOption, features: TurnFeatures, reason: str):
+        option.picks += 1
+        self.reasons[reason] += 1
+        return Decision(option, features, reason)
+
+    @contextmanager
+    def turn(self, decision: Decision):
+        """Time the turn and count its tokens, then record and print how the decision went"""
+        tally = UsageTally()
+        reset_token = current_usage.set(tally)
+        start = time.monotonic()
+        succeeded = False
+        try:
+            yield decision
+            succeeded = True
+        finally:
+            current_usage.reset(reset_token)
+            self._record(decision, tally, time.monotonic() - start, succeeded)
+
+    def _record(self, decision: Decision, tally: UsageTally, seconds: float, succeeded: bool):
+        option = decision.option
+        prompt_tokens, completion_tokens = tally.tokens.get(option.model, (0, 0))
+        cost = sum(OPTIONS_BY_MODEL[model].cost(*tokens) for model, tokens in tally.tokens.items() if model in OPTIONS_BY_MODEL)
+        if decision.fell_back:
+            option.fallbacks += 1
+        else:
+            option.turns.append((seconds, succeeded, prompt_tokens, completion_tokens))
+        print('route: model={} reason="{}" {} seconds={:.2f} cost=${:.5f} ok={} fell_back={}'.format(
+            option.model, decision.reason, decision.features, seconds, cost, succeeded, decision.fell_back))
+
+    def stats(self) -> dict:
+        report = {'routing': 'on, target {:.0f}s'.format(LATENCY_TARGET) if ROUTING_ENABLED else 'off'}
+        report.update({option.model: option.summary() for option in self.options})
+        report.update({'reason: ' + reason: count for reason, count in self.reasons.most_common()})
+        return report
+
+
+router = ModelRouter(MODEL_OPTIONS)
@@ -1,7 +1,8 @@
-from openai import OpenAI
+from src.utils.llmClients import get_openai_client
 
-client = OpenAI()
+client = get_openai_client()
 
-def flagged_by_moderation(prompt: str):
-  response = client.moderations.create(input=prompt)
-  return response.results[0].flagged
\ No newline at end of file
+# Accepts a single prompt or a list of prompts, which are checked in one request
+async def flagged_by_moderation(prompt: str | list[str]):
+  response = await client.moderations.create(input=prompt)
+  return any(result.flagged for result in response.results)
\ No newline at end of file
@@ -30,7 +30,7 @@ def stripSelfTag(reply):
   return reply
 
 def stripQuotations(reply):
-  if reply[0] == '"' and reply[-1] == '"':
+  if len(reply) >= 2 and reply[0] == '"' and reply[-1] == '"':
     return stripQuotations(reply[1:-1])
   return reply
 
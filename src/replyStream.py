@@ -0,0 +1,150 @@
+import os
+import re
+import time
+
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from src.utils.deadline import current_deadline, within_deadline
+from src.utils.telemetry import telemetry
+
+STREAMING_ENABLED = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
+# Don't post until there's this much visible text, so the first message isn't a lone word
+FIRST_CHUNK_CHARS = int(os.getenv('STREAM_FIRST_CHUNK_CHARS', 40))
+# Seconds between edits. Discord allows about 5 edits per 5 seconds per channel
+EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.0))
+DISCORD_MESSAGE_LIMIT = 2000
+# Longest a single Discord send or edit may take
+SEND_TIMEOUT = 10
+
+SELF_TAG = 'compubot: '
+# A {caps} that hasn't been closed yet; cleanReply only restores case once it sees {/caps}
+UNCLOSED_CAPS = re.compile(r'\{caps\}(?!.*\{/caps\})', re.DOTALL | re.IGNORECASE)
+
+
+def _stable_text(text: str):
+    """Cut partial output back to the part the reply filters can't still change.
+
+    Holds back a possible self tag, an unclosed {caps} section and an unclosed
+    {use_emote: x} or <use_emote: x> placeholder.
+    """
+    if SELF_TAG.startswith(text):
+        return ''
+    unclosed = UNCLOSED_CAPS.search(text)
+    if unclosed:
+        text = text[:unclosed.start()]
+    for opening, closing in (('{', '}'), ('<', '>')):
+        start = text.rfind(opening)
+        if start > text.rfind(closing):
+            text = text[:start]
+    return text
+
+
+class ReplyStream:
+    """Posts a reply as it's generated and edits it as more text arrives.
+
+    Nothing is posted until FIRST_CHUNK_CHARS of filtered text are available, and
+    after that edits happen at most every EDIT_INTERVAL seconds. `finish` applies the
+    filters to the whole reply, makes the last edit and returns the final text.
+    """
+
+    def __init__(self, send, filters, model: str):
+        self.send = send
+        self.filters = filters
+        self.model = model
+        self.text = ''
+        self.sent = None
+        self.shown = ''
+        self.last_edit = 0.0
+        self.started = time.perf_counter()
+        # Usage of the last streamed completion, if the provider sent it
+        self.usage = None
+
+    def _render(self, text: str):
+        for filter in self.filters:
+            text = filter(text)
+        return text[:DISCORD_MESSAGE_LIMIT]
+
+    async def _show(self, text: str):
+        if self.sent is None:
+            self.sent = await within_deadline(self.send(text), SEND_TIMEOUT)
+            telemetry.record_first_token(self.model, time.perf_counter() - self.started)
+            deadline = current_deadline.get()
+            if deadline is not None:
+                deadline.replied = True
+        else:
+            await within_deadline(self.sent.edit(content=text), SEND_TIMEOUT)
+        self.shown = text
+        self.last_edit = time.monotonic()
+
+    async def feed(self, delta: str):
+        self.text += delta
+        if self.sent is not None and time.monotonic() - self.last_edit < EDIT_INTERVAL:
+            return
+        text = self._render(_stable_text(self.text))
+        # stripQuotations can't see the closing quote yet; most quoted replies are quoted end to end
+        if text.startswith('"'):
+            text = text[1:]
+        if text == self.shown or (self.sent is None and len(text) < FIRST_CHUNK_CHARS):
+            return
+        await self._show(text)
+
+    def restart(self, model: str = None):
+        """Throw away the text so far (e.g. it led to a tool call, or a retry or fallback model is taking
+        over) but keep editing the same message"""
+        self.text = ''
+        if model is not None:
+            self.model = model
+
+    async def finish(self, text: str = None):
+        """Show the complete reply and return it, or '' if there was nothing to say"""
+        if text is not None:
+            self.text = text
+        reply = self._render(self.text) if self.text else ''
+        if not reply:
+            if self.sent is not None:
+                await self.sent.delete()
+            return ''
+        if reply != self.shown:
+            await self._show(reply)
+        return reply
+
+
+async def consume(stream, reply: ReplyStream, model: str):
+    """Feed a streamed chat completion into `reply`, within the current deadline.
+
+    Returns the tool calls the model made, reassembled from their deltas, or an
+    empty list. Usage is recorded if the provider sends it in the final chunk.
+    """
+    try:
+        return await within_deadline(_consume(stream, reply, model))
+    finally:
+        await stream.close()
+
+
+async def _consume(stream, reply: ReplyStream, model: str):
+    tool_calls = {}
+    async for chunk in stream:
+        if chunk.usage:
+            reply.usage = chunk.usage
+            telemetry.record_usage(model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            await reply.feed(delta.content)
+        for call in delta.tool_calls or ():
+            parts = tool_calls.setdefault(call.index, {'id': '', 'name': '', 'arguments': ''})
+            if call.id:
+                parts['id'] = call.id
+            if call.function and call.function.name:
+                parts['name'] += call.function.name
+            if call.function and call.function.arguments:
+                parts['arguments'] += call.function.arguments
+    return [
+        ChatCompletionMessageToolCall(
+            id=parts['id'],
+            type='function',
+            function={'name': parts['name'], 'arguments': parts['arguments']}
+        )
+        for _, parts in sorted(tool_calls.items())
+    ]
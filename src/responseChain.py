@@ -0,0 +1,142 @@
+import os
+from types import SimpleNamespace
+
+from openai import APIError
+from openai.types.chat import ChatCompletionMessageToolCall
+
+from src.replyStream import ReplyStream
+from src.utils.deadline import within_deadline
+from src.utils.telemetry import telemetry
+
+# Continue tool turns from the provider's stored response instead of resending the history
+RESPONSE_CHAINING = os.getenv('CHAIN_RESPONSES', 'false').lower() == 'true'
+
+
+class ChainStats:
+    def __init__(self):
+        # Turns off chaining after the provider says it has no Responses API
+        self.supported = True
+        self.chained = 0
+        self.resent = 0
+        self.items_saved = 0
+
+    def summary(self):
+        return {
+            'chained_follow_ups': self.chained,
+            'full_resends': self.resent,
+            'messages_not_resent': self.items_saved,
+        }
+
+
+chain = ChainStats()
+# id(tools) -> (tools, Responses API definitions); the tools are kept so the id can't be reused
+_converted_tools = {}
+
+
+def chaining_enabled():
+    return RESPONSE_CHAINING and chain.supported
+
+
+def chain_stats() -> dict:
+    return chain.summary() if RESPONSE_CHAINING else {}
+
+
+def _input_content(content):
+    if not isinstance(content, list):
+        return content
+    parts = []
+    for part in content:
+        if part['type'] == 'text':
+            parts.append({'type': 'input_text', 'text': part['text']})
+        elif part['type'] == 'image_url':
+            parts.append({'type': 'input_image', 'image_url': part['image_url']['url']})
+    return parts
+
+
+def response_input(messages) -> list:
+    """Chat completion messages as Responses API input items"""
+    items = []
+    for message in messages:
+        if message['role'] == 'tool':
+            items.append({'type': 'function_call_output', 'call_id': message['tool_call_id'], 'output': message['content']})
+            continue
+        if message.get('content'):
+            items.append({'role': message['role'], 'content': _input_content(message['content'])})
+        for call in message.get('tool_calls') or ():
+            items.append({
+                'type': 'function_call',
+                'call_id': call['id'],
+                'name': call['function']['name'],
+                'arguments': call['function']['arguments'],
+            })
+    return items
+
+
+def response_tools(tools) -> list:
+    """Chat completion tool definitions in the Responses API's flatter shape"""
+    # Tool lists are reused across requests (see ToolRegistry.select), so each is only converted once
+    cached = _converted_tools.get(id(tools))
+    if cached is None or cached[0] is not tools:
+        cached = (tools, [{'type': 'function', **tool['function']} for tool in tools])
+        _converted_tools[id(tools)] = cached
+    return cached[1]
+
+
+def _usage(usage):
+    # Shaped like a chat completion's usage, which is what telemetry reads
+    if not usage:
+        return None
+    details = usage.get('input_tokens_details') or {}
+    return SimpleNamespace(
+        prompt_tokens=usage.get('input_tokens', 0),
+        completion_tokens=usage.get('output_tokens', 0),
+        prompt_tokens_details=SimpleNamespace(cached_tokens=details.get('cached_tokens', 0)),
+    )
+
+
+def response_usage(response: dict):
+    """A Responses API response's usage, shaped like a chat completion's"""
+    return _usage(response.get('usage'))
+
+
+def parse_response(response: dict, model: str):
+    """The text, tool calls and id of a Responses API response"""
+    telemetry.record_usage(model, response_usage(response))
+    text = ''
+    tool_calls = []
+    for item in response.get('output') or ():
+        if item['type'] == 'message':
+            text += ''.join(part.get('text', '') for part in item['content'] if part['type'] == 'output_text')
+        elif item['type'] == 'function_call':
+            tool_calls.append(ChatCompletionMessageToolCall(
+                id=item['call_id'],
+                type='function',
+                function={'name': item['name'], 'arguments': item['arguments']}
+            ))
+    return text, tool_calls, response['id']
+
+
+async def consume_response(stream, reply: ReplyStream, model: str):
+    """Feed a streamed Responses API response into `reply`, within the current deadline.
+
+    Returns the tool calls and the response id, taken from the completed response.
+    """
+    try:
+        return await within_deadline(_consume_response(stream, reply, model))
+    finally:
+        await stream.close()
+
+
+async def _consume_response(stream, reply: ReplyStream, model: str):
+    async for event in stream:
+        # Events sent with an `event:` line arrive wrapped with it
+        event = event.get('data', event)
+        if event['type'] == 'response.output_text.delta':
+            await reply.feed(event['delta'])
+        elif event['type'] in ('response.completed', 'response.incomplete'):
+            reply.usage = response_usage(event['response'])
+            _, tool_calls, response_id = parse_response(event['response'], model)
+            return tool_calls, response_id
+        elif event['type'] in ('response.failed', 'error'):
+            raise APIError('Response failed', stream.response.request, body=event)
+    raise APIError('Response stream ended before the response completed', stream.response.request, body=None)
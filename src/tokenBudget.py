@@ -0,0 +1,209 @@
+import json
+import math
+import os
+from typing import Dict, Optional, Tuple
+
+from src.utils.tokenizer import tokenizer
+
+# Context window of each model we send prompts to
+CONTEXT_WINDOWS = {
+    'gpt-4o-mini': 128000,
+    'gpt-4.1-mini': 1047576,
+    'accounts/fireworks/models/mixtral-8x7b-instruct': 32768,
+    'accounts/fireworks/models/mistral-7b-instruct-v0p2': 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 32768
+# Room to leave for the reply when a request doesn't set max_tokens itself
+REPLY_RESERVE = int(os.getenv('PROMPT_REPLY_RESERVE', 4096))
+# Tokens the chat format adds around each message, and to prime the reply
+MESSAGE_OVERHEAD = 3
+REPLY_PRIMING = 3
+# (base, per 512px tile) tokens for an image at high detail; low detail costs the base alone.
+# gpt-4o-mini bills images as many more tokens to keep its per-image price in line with gpt-4o
+IMAGE_TOKENS = {
+    'gpt-4o-mini': (2833, 5667),
+}
+DEFAULT_IMAGE_TOKENS = (85, 170)
+# Images we don't know the size of are counted as 1024x1024
+UNKNOWN_IMAGE_SIZE = (1024, 1024)
+# How far each response's real prompt token count moves a model's calibration
+CALIBRATION_RATE = 0.2
+# Estimates are never scaled further than this from the raw count
+MIN_CALIBRATION = 0.5
+MAX_CALIBRATION = 2.0
+
+
+def image_tiles(width: int, height: int) -> int:
+    """512px tiles an image is cut into at high detail: fit in 2048x2048, then shortest side to 768"""
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    return math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+
+
+class Calibration:
+    __slots__ = ('factor', 'samples', 'last_error')
+
+    def __init__(self):
+        self.factor = 1.0
+        self.samples = 0
+        self.last_error = 0.0
+
+
+class TokenBudget:
+    """Counts the prompt tokens of a whole chat completion request before it's sent.
+
+    GPTMemory only counts message text. This adds the chat format's per-message
+    overhead, the serialized tool definitions and whatever memory didn't render
+    itself (retrieved context, images, edited copies); messages memory rendered
+    reuse its counts. `fit` drops the oldest conversation messages until the
+    request fits in the model's context window with room left for the reply, so
+    long conversations don't fail with a context length error.
+
+    Nothing is tokenized on the event loop: memory's counts are made on the
+    tokenizer's thread and anything else is estimated. Counts can't match every
+    provider's exactly, so each model keeps a calibration factor that `calibrate`
+    nudges towards the prompt_tokens the provider reports in `usage`.
+    """
+
+    def __init__(self):
+        # id(tools) -> (tools, tokens); the definitions are kept so the id can't be reused
+        self.tool_counts: Dict[int, Tuple[list, int]] = {}
+        self.calibrations: Dict[str, Calibration] = {}
+        self.requests_trimmed = 0
+        self.messages_trimmed = 0
+
+    # fit runs on the event loop, so text memory didn't count is estimated rather than tokenized.
+    # It's a small part of a request, and calibration corrects the estimate's bias
+    def _count(self, text: str) -> int:
+        return tokenizer.estimate(text)
+
+    def tools_tokens(self, tools) -> int:
+        if not tools:
+            return 0
+        cached = self.tool_counts.get(id(tools))
+        if cached is not None and cached[0] is tools:
+            return cached[1]
+        serialized = json.dumps(tools, separators=(',', ':'))
+        if tokenizer.ready:
+            # Each tool list is counted exactly once, on the tokenizer's thread; estimated until then
+            self.tool_counts[id(tools)] = (tools, tokenizer.estimate(serialized))
+            tokenizer.executor.submit(tokenizer.exact, serialized).add_done_callback(
+                lambda counting: self.tool_counts.__setitem__(id(tools), (tools, counting.result())))
+        return tokenizer.estimate(serialized)
+
+    def image_tokens(self, model: str, part: dict, image_sizes: Optional[dict] = None) -> int:
+        base, per_tile = IMAGE_TOKENS.get(model, DEFAULT_IMAGE_TOKENS)
+        image = part['image_url']
+        if image.get('detail') == 'low':
+            return base
+        width, height = (image_sizes or {}).get(image['url']) or UNKNOWN_IMAGE_SIZE
+        return base + per_tile * image_tiles(width, height)
+
+    def message_tokens(self, model: str, message: dict, image_sizes: Optional[dict] = None) -> int:
+        tokens = MESSAGE_OVERHEAD + self._count(message['role'])
+        counted = getattr(message, 'counted', None)
+        if counted is not None:
+            # Rendered from memory, which has already counted its text and any tool calls
+            tokens += counted.tokens
+            if message.get('tool_call_id'):
+                tokens += self._count(message['tool_call_id'])
+            return tokens
+        content = message.get('content')
+        if isinstance(content, str):
+            tokens += self._count(content)
+        elif content:
+            for part in content:
+                if part['type'] == 'text':
+                    tokens += self._count(part['text'])
+                elif part['type'] == 'image_url':
+                    tokens += self.image_tokens(model, part, image_sizes)
+        if message.get('name'):
+            tokens += 1 + self._count(message['name'])
+        if message.get('tool_calls'):
+            tokens += self._count(json.dumps(message['tool_calls'], separators=(',', ':')))
+        if message.get('tool_call_id'):
+            tokens += self._count(message['tool_call_id'])
+        return tokens
+
+    def _calibrated(self, model: str, tokens: int) -> int:
+        calibration = self.calibrations.get(model)
+        return round(tokens * calibration.factor) if calibration else tokens
+
+    def estimate(self, model: str, messages, tools=None, image_sizes: Optional[dict] = None) -> int:
+        """Calibrated prompt tokens for sending `messages` and `tools` as they are"""
+        raw = REPLY_PRIMING + self.tools_tokens(tools) + sum(self.message_tokens(model, message, image_sizes) for message in messages)
+        return self._calibrated(model, raw)
+
+    def fit(self, model: str, messages, tools=None, image_sizes: Optional[dict] = None, reserve: int = REPLY_RESERVE,
+            alternating: bool = False):
+        """Trim `messages` to fit the model's context window. Returns them and the estimated prompt tokens.
+
+        System messages and the newest message are kept; the oldest of the rest go
+        first, and a trimmed tool call takes its results with it. `alternating` is
+        for Mistral's strict user/assistant turns, where the first turn holds the
+        prompt and turns are trimmed in pairs.
+        """
+        counts = [self.message_tokens(model, message, image_sizes) for message in messages]
+        raw = REPLY_PRIMING + self.tools_tokens(tools) + sum(counts)
+        limit = CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW) - reserve
+        if self._calibrated(model, raw) <= limit:
+            return messages, self._calibrated(model, raw)
+
+        trim = self._trim_turns if alternating else self._trim_messages
+        dropped, raw = trim(model, messages, counts, raw, limit)
+        tokens = self._calibrated(model, raw)
+        self.requests_trimmed += 1
+        self.messages_trimmed += len(dropped)
+        print('Prompt for {} was over its {} token budget, trimmed {} messages'.format(model, limit, len(dropped)))
+        if tokens > limit:
+            print('Prompt for {} still needs about {} tokens after trimming'.format(model, tokens))
+        return type(messages)(message for index, message in enumerate(messages) if index not in dropped), tokens
+
+    def _trim_messages(self, model: str, messages, counts, raw: int, limit: int):
+        # The newest message stays, along with the tool call its results answer
+        keep_from = len(messages) - 1
+        while keep_from > 0 and messages[keep_from]['role'] == 'tool':
+            keep_from -= 1
+        dropped = set()
+        index = 0
+        while index < keep_from and self._calibrated(model, raw) > limit:
+            if messages[index]['role'] != 'system':
+                dropped.add(index)
+                raw -= counts[index]
+                # Results can't be sent without the call they answer
+                while index + 1 < keep_from and messages[index + 1]['role'] == 'tool':
+                    index += 1
+                    dropped.add(index)
+                    raw -= counts[index]
+            index += 1
+        return dropped, raw
+
+    def _trim_turns(self, model: str, messages, counts, raw: int, limit: int):
+        dropped = set()
+        index = 1
+        while index + 1 < len(messages) - 1 and self._calibrated(model, raw) > limit:
+            dropped.update((index, index + 1))
+            raw -= counts[index] + counts[index + 1]
+            index += 2
+        return dropped, raw
+
+    def calibrate(self, model: str, estimated: Optional[int], usage):
+        """Move the model's calibration towards what the provider counted for a request we estimated"""
+        if not estimated or usage is None or not usage.prompt_tokens:
+            return
+        calibration = self.calibrations.setdefault(model, Calibration())
+        ratio = usage.prompt_tokens / estimated
+        calibration.factor = min(max(calibration.factor * (1 + CALIBRATION_RATE * (ratio - 1)), MIN_CALIBRATION), MAX_CALIBRATION)
+        calibration.samples += 1
+        calibration.last_error = ratio - 1
+
+    def summary(self) -> dict:
+        report = {'prompts_trimmed': '{} ({} messages)'.format(self.requests_trimmed, self.messages_trimmed)}
+        for model, calibration in sorted(self.calibrations.items()):
+            report['calibration ' + model] = 'x{:.3f} after {} responses, last estimate off by {:+.1%}'.format(
+                calibration.factor, calibration.samples, calibration.last_error)
+        return report
+
+
+budget = TokenBudget()
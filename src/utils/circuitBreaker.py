@@ -0,0 +1,110 @@
+import os
+import time
+from collections import deque
+from typing import Dict
+
+# Outcomes older than this don't count towards a breaker's health
+WINDOW_SECONDS = 120
+# Don't judge a provider on fewer requests than this
+MIN_REQUESTS = 5
+ERROR_RATE_LIMIT = float(os.getenv('CIRCUIT_ERROR_RATE', 0.5))
+SLOW_P95_SECONDS = float(os.getenv('CIRCUIT_SLOW_SECONDS', 30))
+# How long an open breaker waits before letting a trial request through
+COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', 30))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """Tracks the rolling error rate and p95 latency of one provider and model.
+
+    While closed every request goes through. Too many errors or a slow p95 opens
+    the breaker, and callers should route elsewhere straight away. After
+    COOLDOWN_SECONDS it goes half-open and lets one trial request through at a
+    time; a success closes it again and a failure reopens it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        # (time, succeeded, seconds)
+        self.outcomes = deque()
+        self.opened_at = 0.0
+        self.trial_started = None
+        self.times_opened = 0
+
+    def _trim(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - WINDOW_SECONDS:
+            self.outcomes.popleft()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, succeeded, _ in self.outcomes if not succeeded) / len(self.outcomes)
+
+    def p95(self):
+        latencies = sorted(seconds for _, succeeded, seconds in self.outcomes if succeeded)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def _open(self, now: float, reason: str):
+        print('Circuit for {} opened: {}'.format(self.name, reason))
+        self.state = OPEN
+        self.opened_at = now
+        self.trial_started = None
+        self.times_opened += 1
+
+    def allow(self, now: float = None):
+        """Whether a request should be sent to this provider right now"""
+        now = now or time.monotonic()
+        if self.state == OPEN and now - self.opened_at >= COOLDOWN_SECONDS:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            # One trial at a time; a trial that never reported back doesn't block forever
+            if self.trial_started is None or now - self.trial_started >= COOLDOWN_SECONDS:
+                self.trial_started = now
+                return True
+            return False
+        return self.state == CLOSED
+
+    def record(self, succeeded: bool, seconds: float, now: float = None):
+        now = now or time.monotonic()
+        if self.state == HALF_OPEN:
+            if succeeded:
+                print('Circuit for {} closed after a successful trial'.format(self.name))
+                self.state = CLOSED
+                self.outcomes.clear()
+                self.trial_started = None
+            else:
+                self._open(now, 'trial request failed')
+            return
+        self.outcomes.append((now, succeeded, seconds))
+        self._trim(now)
+        if self.state != CLOSED or len(self.outcomes) < MIN_REQUESTS:
+            return
+        if self.error_rate() >= ERROR_RATE_LIMIT:
+            self._open(now, '{:.0%} of recent requests failed'.format(self.error_rate()))
+        elif self.p95() >= SLOW_P95_SECONDS:
+            self._open(now, 'p95 latency is {:.1f}s'.format(self.p95()))
+
+    def summary(self):
+        self._trim(time.monotonic())
+        return '{}, {} recent requests, {:.0%} errors, p95 {:.1f}s, opened {} times'.format(
+            self.state, len(self.outcomes), self.error_rate(), self.p95(), self.times_opened)
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(provider: str, model: str) -> CircuitBreaker:
+    name = '{}/{}'.format(provider, model)
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name)
+    return breakers[name]
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.summary() for name, breaker in sorted(breakers.items())} or {'breakers': 0}
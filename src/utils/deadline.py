@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+# How long a turn may take from starting to being answered
+REPLY_DEADLINE = float(os.getenv('REPLY_DEADLINE_SECONDS', 45))
+# Kept back from every stage's budget so there's always time to send a fallback reply
+FALLBACK_RESERVE = 3.0
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """The time by which a message must be answered.
+
+    Created when a channel's worker starts a turn and carried through it in
+    `current_deadline`, so each stage (moderation, completions, tools, the Discord
+    send) can ask how long it has left instead of using its own long default.
+    """
+
+    def __init__(self, seconds: float = REPLY_DEADLINE):
+        self.expires = time.monotonic() + seconds
+        # Set once any part of the reply has been posted, so a fallback isn't sent on top
+        self.replied = False
+
+    def remaining(self) -> float:
+        return self.expires - time.monotonic()
+
+    def budget(self, cap: Optional[float] = None) -> float:
+        """Seconds a stage may take: what's left less the fallback reserve, at most `cap`"""
+        budget = self.remaining() - FALLBACK_RESERVE
+        if budget <= 0:
+            raise DeadlineExceeded()
+        return budget if cap is None else min(budget, cap)
+
+    async def run(self, awaitable, cap: Optional[float] = None):
+        """Await `awaitable`, cancelling it and raising DeadlineExceeded if it runs out of budget"""
+        try:
+            budget = self.budget(cap)
+        except DeadlineExceeded:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            raise
+        try:
+            return await asyncio.wait_for(awaitable, budget)
+        except asyncio.TimeoutError:
+            if cap is not None and budget < self.remaining() - FALLBACK_RESERVE:
+                raise # The stage's own cap ran out, not the deadline
+            raise DeadlineExceeded()
+
+
+# The deadline of the turn being handled by the current task, if any
+current_deadline: ContextVar[Optional[Deadline]] = ContextVar('current_deadline', default=None)
+
+
+def stage_budget(cap: Optional[float] = None) -> Optional[float]:
+    """Time the current stage may take under the current deadline, or `cap` if there's none"""
+    deadline = current_deadline.get()
+    return cap if deadline is None else deadline.budget(cap)
+
+
+async def within_deadline(awaitable, cap: Optional[float] = None):
+    """Await `awaitable` within the current deadline (and `cap`), or just `cap` if there's none"""
+    deadline = current_deadline.get()
+    if deadline is None:
+        return await (awaitable if cap is None else asyncio.wait_for(awaitable, cap))
+    return await deadline.run(awaitable, cap)
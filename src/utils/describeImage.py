@@ -1,13 +1,10 @@
-import os
-
-from openai import AsyncOpenAI, BadRequestError
 from src.gptMemory import DEFAULT_MODEL
+from src.utils.llmClients import get_openai_client
 
-API_URL = "https://api.fireworks.ai/inference/v1/"
 MODEL = "accounts/fireworks/models/firellava-13b"
 
-# client = AsyncOpenAI(base_url=API_URL, api_key=os.getenv("FIREWORKS_API_KEY"))
-client = AsyncOpenAI()
+# client = get_openai_client(FIREWORKS_BASE_URL, os.getenv("FIREWORKS_API_KEY"))
+client = get_openai_client()
 
 async def describe_image(url: str, message: str):
     prompt = "Describe this image."
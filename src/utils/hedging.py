@@ -0,0 +1,105 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict
+
+HEDGING_ENABLED = os.getenv('HEDGE_REQUESTS', 'false').lower() == 'true'
+# Send the backup once the primary is slower than this share of recent requests
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.9))
+# Bounds on the hedge delay, and the delay used until there are enough samples
+MIN_DELAY = float(os.getenv('HEDGE_MIN_SECONDS', 2))
+DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_SECONDS', 10))
+MIN_SAMPLES = 20
+SAMPLES = 200
+
+
+class Hedger:
+    """Runs a request and, if it's slow, a backup request alongside it.
+
+    The backup starts once the primary has taken longer than HEDGE_PERCENTILE of
+    the primary's recent latencies. Whichever succeeds first is used and the other
+    is cancelled. Only the primary's latencies set the delay, so hedging doesn't
+    hide a slow primary from itself.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = deque(maxlen=SAMPLES)
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.seconds_saved = 0.0
+
+    def delay(self):
+        if len(self.latencies) < MIN_SAMPLES:
+            return DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return max(ordered[min(int(len(ordered) * HEDGE_PERCENTILE), len(ordered) - 1)], MIN_DELAY)
+
+    def _expected_slow_latency(self, delay: float):
+        # What a primary that's already past the delay usually ends up taking
+        slow = [seconds for seconds in self.latencies if seconds >= delay]
+        return sum(slow) / len(slow) if slow else delay
+
+    async def run(self, primary, backup):
+        """`primary` and `backup` are functions returning a fresh coroutine for the request"""
+        self.requests += 1
+        delay = self.delay()
+        start = time.monotonic()
+        primary_task = asyncio.ensure_future(primary())
+        tasks = {primary_task}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                result = primary_task.result()
+                self.latencies.append(time.monotonic() - start)
+                return result
+
+            self.hedged += 1
+            print('{} is slower than {:.1f}s, sending a hedge request'.format(self.name, delay))
+            tasks.add(asyncio.ensure_future(backup()))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    elapsed = time.monotonic() - start
+                    if task is primary_task:
+                        self.latencies.append(elapsed)
+                    else:
+                        self.backup_wins += 1
+                        self.seconds_saved += max(self._expected_slow_latency(delay) - elapsed, 0)
+                    for other in done - {task}:
+                        await _discard(other)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def summary(self):
+        return '{} requests, {} hedged ({:.1%}), backup won {}, ~{:.1f}s saved, hedging after {:.1f}s'.format(
+            self.requests, self.hedged, self.hedged / self.requests if self.requests else 0,
+            self.backup_wins, self.seconds_saved, self.delay())
+
+
+# A request that also finished but lost; streams still hold a connection open
+async def _discard(task: asyncio.Future):
+    if task.exception() is None and hasattr(task.result(), 'close'):
+        await task.result().close()
+
+
+hedgers: Dict[str, Hedger] = {}
+
+
+def get_hedger(name: str) -> Hedger:
+    if name not in hedgers:
+        hedgers[name] = Hedger(name)
+    return hedgers[name]
+
+
+def hedge_stats() -> dict:
+    return {'hedge ' + name: hedger.summary() for name, hedger in sorted(hedgers.items())}
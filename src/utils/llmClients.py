@@ -0,0 +1,100 @@
+import os
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+from src.utils.rateLimits import RateLimiter
+
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+FIREWORKS_BASE_URL = 'https://api.fireworks.ai/inference/v1/'
+
+HTTP2_ENABLED = os.getenv('LLM_HTTP2', 'true').lower() == 'true'
+POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv('LLM_POOL_MAX_CONNECTIONS', 50)),
+    max_keepalive_connections=int(os.getenv('LLM_POOL_MAX_KEEPALIVE', 20)),
+    keepalive_expiry=float(os.getenv('LLM_POOL_KEEPALIVE_SECONDS', 120)),
+)
+# Completions can take a while to start streaming, but everything else should be quick
+TIMEOUTS = httpx.Timeout(
+    connect=float(os.getenv('LLM_CONNECT_TIMEOUT', 5)),
+    read=float(os.getenv('LLM_READ_TIMEOUT', 120)),
+    write=float(os.getenv('LLM_WRITE_TIMEOUT', 10)),
+    pool=float(os.getenv('LLM_POOL_TIMEOUT', 10)),
+)
+
+
+# Requests and tokens per minute for each provider (0 for no limit). Set these a
+# little under the account's limits so requests wait here instead of getting 429s.
+RATE_LIMITS = {
+    OPENAI_BASE_URL: (int(os.getenv('OPENAI_RPM', 500)), int(os.getenv('OPENAI_TPM', 200000))),
+    FIREWORKS_BASE_URL: (int(os.getenv('FIREWORKS_RPM', 600)), int(os.getenv('FIREWORKS_TPM', 0))),
+}
+
+
+class PoolStats:
+    """Counts requests and new connections for one pool using httpcore's trace hook"""
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    async def trace(self, event: str, info: dict):
+        if event == 'connection.connect_tcp.complete':
+            self.counts['connections_opened'] += 1
+        elif event == 'connection.start_tls.complete':
+            self.counts['tls_handshakes'] += 1
+        elif event in ('http11.send_request_headers.started', 'http2.send_request_headers.started'):
+            self.counts['requests'] += 1
+            self.counts[event.split('.')[0] + '_requests'] += 1
+
+    async def on_request(self, request: httpx.Request):
+        request.extensions['trace'] = self.trace
+
+    def summary(self):
+        requests = self.counts['requests']
+        reused = max(requests - self.counts['connections_opened'], 0)
+        return '{} requests, {} connections, {} handshakes, {} reused ({:.0%}), {} over http/2'.format(
+            requests, self.counts['connections_opened'], self.counts['tls_handshakes'], reused,
+            reused / requests if requests else 0, self.counts['http2_requests'])
+
+
+_http_clients: Dict[str, Tuple[httpx.AsyncClient, PoolStats]] = {}
+rate_limiters: Dict[str, RateLimiter] = {}
+_openai_clients: Dict[Tuple[str, Optional[str]], AsyncOpenAI] = {}
+
+
+def get_http_client(base_url: str) -> httpx.AsyncClient:
+    """The shared connection pool for one API host"""
+    if base_url not in _http_clients:
+        stats = PoolStats()
+        limiter = RateLimiter(base_url, *RATE_LIMITS.get(base_url, (0, 0)))
+        rate_limiters[base_url] = limiter
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED,
+            limits=POOL_LIMITS,
+            timeout=TIMEOUTS,
+            event_hooks={'request': [limiter.on_request, stats.on_request], 'response': [limiter.on_response]},
+        )
+        _http_clients[base_url] = (http_client, stats)
+    return _http_clients[base_url][0]
+
+
+def get_openai_client(base_url: str = OPENAI_BASE_URL, api_key: Optional[str] = None) -> AsyncOpenAI:
+    """An AsyncOpenAI client for `base_url` that shares that host's connection pool.
+
+    Clients are cached, so every module asking for the same API gets the same one.
+    """
+    key = (base_url, api_key)
+    if key not in _openai_clients:
+        _openai_clients[key] = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=get_http_client(base_url))
+    return _openai_clients[key]
+
+
+def pool_stats() -> dict:
+    return {base_url: stats.summary() for base_url, (_, stats) in _http_clients.items()} or {'pools': 0}
+
+
+def rate_limit_stats() -> dict:
+    return {base_url: limiter.summary() for base_url, limiter in rate_limiters.items()} or {'pools': 0}
+
@@ -0,0 +1,172 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from typing import Optional
+
+import httpx
+
+# Back off this long after a 429 that didn't say how long to wait
+DEFAULT_RETRY_AFTER = 2.0
+# Rough size of a token in request body bytes, for requests nobody estimated
+BYTES_PER_TOKEN = 4
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0 # Someone is waiting on a reply
+    BACKGROUND = 1  # Roasts, image titles, summaries
+
+
+class RequestInfo:
+    __slots__ = ('priority', 'tokens', 'queued')
+
+    def __init__(self, priority: Priority, tokens: Optional[int]):
+        self.priority = priority
+        self.tokens = tokens
+        # Seconds spent waiting in rate limiter queues, so callers can leave it out of latencies
+        self.queued = 0.0
+
+
+# The LLM request being made by the current task, if it was tagged with llm_request
+current_request: ContextVar[Optional[RequestInfo]] = ContextVar('current_request', default=None)
+
+
+@contextmanager
+def llm_request(priority: Priority = Priority.INTERACTIVE, tokens: Optional[int] = None):
+    """Tag the LLM requests made inside this block with a priority and a prompt size"""
+    info = RequestInfo(priority, tokens)
+    reset_token = current_request.set(info)
+    try:
+        yield info
+    finally:
+        current_request.reset(reset_token)
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most a minute's worth"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: int, now: float) -> float:
+        self._refill(now)
+        # A single request bigger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        return max(amount - self.level, 0) / self.rate
+
+    def take(self, amount: int, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Admits requests to one provider within its requests- and tokens-per-minute limits.
+
+    Requests queue by priority and then arrival, and only the front of the queue is
+    admitted, so interactive replies overtake background work that's still waiting.
+    A 429 pauses everything for the provider's Retry-After instead of letting each
+    caller retry on its own.
+    """
+
+    def __init__(self, name: str, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.waiting = []
+        self.counter = itertools.count()
+        self.changed = asyncio.Event()
+        self.admitted = 0
+        self.delayed = 0
+        self.waited = 0.0
+        self.throttled = 0
+
+    def _delay(self, tokens: int, now: float) -> float:
+        delay = self.blocked_until - now
+        if self.requests is not None:
+            delay = max(delay, self.requests.delay(1, now))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.delay(tokens, now))
+        return delay
+
+    async def acquire(self, tokens: int, priority: Priority = Priority.INTERACTIVE) -> float:
+        ticket = (priority, next(self.counter))
+        heapq.heappush(self.waiting, ticket)
+        self.changed.set()
+        start = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                delay = self._delay(tokens, now) if self.waiting[0] == ticket else None
+                if delay is not None and delay <= 0:
+                    break
+                self.changed.clear()
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiting.remove(ticket)
+            heapq.heapify(self.waiting)
+            self.changed.set()
+
+        now = time.monotonic()
+        if self.requests is not None:
+            self.requests.take(1, now)
+        if self.tokens is not None:
+            self.tokens.take(tokens, now)
+        self.admitted += 1
+        if now - start > 0.001:
+            self.delayed += 1
+            self.waited += now - start
+        return now - start
+
+    def back_off(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.changed.set()
+
+    # httpx event hooks, so retries made inside the SDK are limited too
+    async def on_request(self, request: httpx.Request):
+        info = current_request.get()
+        tokens = info.tokens if info is not None and info.tokens is not None else len(request.content) // BYTES_PER_TOKEN
+        waited = await self.acquire(tokens, info.priority if info is not None else Priority.INTERACTIVE)
+        if info is not None:
+            info.queued += waited
+
+    async def on_response(self, response: httpx.Response):
+        if response.status_code == 429:
+            self.throttled += 1
+            seconds = retry_after(response.headers)
+            print('{} rate limited us, pausing requests for {:.1f}s'.format(self.name, seconds))
+            self.back_off(seconds)
+
+    def summary(self):
+        return '{} admitted, {} delayed ({:.1f}s total), {} waiting, {} rate limited'.format(
+            self.admitted, self.delayed, self.waited, len(self.waiting), self.throttled)
+
+
+def retry_after(headers: httpx.Headers) -> float:
+    """Seconds to wait from a 429's retry-after-ms or retry-after header"""
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            try:
+                return float(value)
+            except ValueError:
+                return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        pass
+    return DEFAULT_RETRY_AFTER
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import re
+import sys
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Width of the hashed feature vectors. 256 float32s (1KB a message) keeps a query
+# well under a few milliseconds.
+FEATURE_DIM = 256
+# A full channel is ~51MB of vectors plus its text, and a query over it takes ~2.5ms
+MAX_MESSAGES_PER_CHANNEL = int(os.getenv('RETRIEVAL_MAX_MESSAGES', 50000))
+# All channels' indexes together, on top of GPTMemory's MEMORY_MAX_BYTES: room for one
+# full channel or many smaller ones. Past this the index of the channel that went
+# longest without a new message is dropped.
+MAX_INDEX_BYTES = int(os.getenv('RETRIEVAL_MAX_BYTES', 64 * 1024 * 1024))
+TOP_K = int(os.getenv('RETRIEVAL_TOP_K', 4))
+MIN_SCORE = 0.25
+MAX_RESULT_CHARS = 500
+
+WORD_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def embed(text: str) -> np.ndarray:
+    """Hashed word and character-trigram features, L2-normalized.
+
+    Cheap, dependency-free and stable across processes; good enough to find
+    messages that share names, topics and phrasing with the current turn.
+    """
+    text = text.lower()
+    words = WORD_PATTERN.findall(text)
+    squashed = ' '.join(words)
+    features = [*('w:' + word for word in words), *(squashed[i:i + 3] for i in range(len(squashed) - 2))]
+    vector = np.zeros(FEATURE_DIM, dtype=np.float32)
+    if not features:
+        return vector
+    hashes = np.fromiter((zlib.crc32(feature.encode()) for feature in features), dtype=np.uint32, count=len(features))
+    # The top bit picks the sign so unrelated features tend to cancel instead of pile up
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, hashes % FEATURE_DIM, signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class ChannelIndex:
+    """Feature vectors for one channel's past messages, kept as a ring buffer"""
+
+    def __init__(self):
+        self.vectors = np.zeros((64, FEATURE_DIM), dtype=np.float32)
+        self.texts: List[Optional[str]] = [None] * 64
+        self.count = 0
+        self.next = 0
+        self.text_bytes = 0
+
+    @property
+    def bytes(self):
+        return self.vectors.nbytes + sys.getsizeof(self.texts) + self.text_bytes
+
+    def add(self, text: str):
+        if self.next >= len(self.texts) and len(self.texts) < MAX_MESSAGES_PER_CHANNEL:
+            capacity = min(len(self.texts) * 2, MAX_MESSAGES_PER_CHANNEL)
+            self.vectors = np.resize(self.vectors, (capacity, FEATURE_DIM))
+            self.texts.extend([None] * (capacity - len(self.texts)))
+        slot = self.next % len(self.texts)
+        self.vectors[slot] = embed(text)
+        if self.texts[slot] is not None:
+            self.text_bytes -= sys.getsizeof(self.texts[slot])
+        self.texts[slot] = text
+        self.text_bytes += sys.getsizeof(text)
+        self.next = slot + 1
+        self.count = min(self.count + 1, len(self.texts))
+
+    def search(self, query: np.ndarray, k: int) -> List[str]:
+        if self.count == 0:
+            return []
+        scores = self.vectors[:self.count] @ query
+        k = min(k, self.count)
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [self.texts[i] for i in top if scores[i] >= MIN_SCORE]
+
+
+class RetrievalIndex:
+    """Per-channel indexes of messages that have fallen out of the token window.
+
+    All indexing and searching runs on a single worker thread, so calls never block
+    the event loop and never race each other. GPTMemory drops a channel's index when
+    it evicts the conversation, and the indexes together are held under MAX_INDEX_BYTES.
+    """
+
+    def __init__(self):
+        # Ordered from the channel that went longest without a new message
+        self.channels: Dict[object, ChannelIndex] = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='retrieval')
+        # Only changed on the worker thread; fine to read from anywhere for stats
+        self.bytes = 0
+        self.evicted = 0
+
+    def _add(self, channel_id, text: str):
+        index = self.channels.get(channel_id)
+        if index is None:
+            index = self.channels[channel_id] = ChannelIndex()
+            self.bytes += index.bytes
+        self.channels.move_to_end(channel_id)
+        bytes_before = index.bytes
+        index.add(text[:MAX_RESULT_CHARS])
+        self.bytes += index.bytes - bytes_before
+        while self.bytes > MAX_INDEX_BYTES and len(self.channels) > 1:
+            _, oldest = self.channels.popitem(last=False)
+            self.bytes -= oldest.bytes
+            self.evicted += 1
+
+    def _drop(self, channel_id):
+        index = self.channels.pop(channel_id, None)
+        if index is not None:
+            self.bytes -= index.bytes
+
+    def _search(self, channel_id, text: str, k: int) -> List[str]:
+        index = self.channels.get(channel_id)
+        return index.search(embed(text), k) if index else []
+
+    def add(self, channel_id, text: str):
+        self.executor.submit(self._add, channel_id, text)
+
+    def drop(self, channel_id):
+        self.executor.submit(self._drop, channel_id)
+
+    async def search(self, channel_id, text: str, k: int = TOP_K) -> List[str]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._search, channel_id, text, k)
+
+    def stats(self) -> dict:
+        return {
+            'retrieval_channels': len(self.channels),
+            'retrieval_bytes': self.bytes,
+            'retrieval_max_bytes': MAX_INDEX_BYTES,
+            'retrieval_evicted': self.evicted,
+        }
+
+
+def get_retrieval_index() -> Optional[RetrievalIndex]:
+    """Build the index if RETRIEVAL_ENABLED is set, otherwise None"""
+    if os.getenv('RETRIEVAL_ENABLED', 'false').lower() == 'true':
+        return RetrievalIndex()
+    return None
@@ -0,0 +1,114 @@
+import time
+from collections import defaultdict, deque
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# How many individual requests to keep for the rolling window in the report
+REQUEST_HISTORY = 500
+
+
+class ModelTotals:
+    __slots__ = ('requests', 'prompt_tokens', 'cached_tokens', 'hits')
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.hits = 0
+
+
+class UsageTally:
+    """Prompt and completion tokens used by one turn, per model"""
+
+    def __init__(self):
+        self.tokens: Dict[str, list] = defaultdict(lambda: [0, 0])
+
+    def add(self, model: str, prompt_tokens: int, completion_tokens: int):
+        self.tokens[model][0] += prompt_tokens
+        self.tokens[model][1] += completion_tokens
+
+
+# The tally for the turn being handled by the current task, if anyone is counting
+current_usage: ContextVar[Optional[UsageTally]] = ContextVar('current_usage', default=None)
+
+
+class Telemetry:
+    """Per-request numbers from the LLM providers.
+
+    `record_usage` takes the `usage` object from a chat completion and keeps the
+    prompt and cached prompt token counts, both as running totals per model and
+    as a short window of recent requests. `record_first_token` keeps how long
+    users waited before any of a reply showed up in Discord.
+
+    The cached counts measure the provider's automatic prefix caching. The
+    prefix is the tool list, then MODEL_PROMPT, then the history, so they drop
+    whenever the tool list changes (ToolRegistry pins every tool it has sent,
+    so that happens at most once per tool and the same way in every channel).
+    """
+
+    def __init__(self, history: int = REQUEST_HISTORY):
+        self.requests = deque(maxlen=history)
+        self.totals: Dict[str, ModelTotals] = defaultdict(ModelTotals)
+        self.first_token = defaultdict(lambda: deque(maxlen=history))
+
+    def record_usage(self, model: str, usage):
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_tokens or 0
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details else 0
+        tally = current_usage.get()
+        if tally is not None:
+            tally.add(model, prompt_tokens, getattr(usage, 'completion_tokens', None) or 0)
+
+        self.requests.append((time.time(), model, prompt_tokens, cached_tokens))
+        totals = self.totals[model]
+        totals.requests += 1
+        totals.prompt_tokens += prompt_tokens
+        totals.cached_tokens += cached_tokens
+        if cached_tokens:
+            totals.hits += 1
+
+    def record_first_token(self, model: str, seconds: float):
+        self.first_token[model].append(seconds)
+
+    def latency_report(self) -> dict:
+        """Time to first visible token per model over recent replies"""
+        report = {}
+        for model, samples in sorted(self.first_token.items()):
+            ordered = sorted(samples)
+            report[model] = 'p50 {:.2f}s  p90 {:.2f}s  max {:.2f}s  ({} replies)'.format(
+                _percentile(ordered, 0.5), _percentile(ordered, 0.9), ordered[-1], len(ordered))
+        return report or {'replies': 0}
+
+    def cache_report(self) -> dict:
+        """Prompt cache hit ratio and cached tokens, overall, per model and for recent requests"""
+        report = {}
+        prompt_tokens = sum(totals.prompt_tokens for totals in self.totals.values())
+        cached_tokens = sum(totals.cached_tokens for totals in self.totals.values())
+        report['requests'] = sum(totals.requests for totals in self.totals.values())
+        report['prompt_tokens'] = prompt_tokens
+        # Cached tokens skip prefill and are billed at a discount
+        report['tokens_saved'] = cached_tokens
+        report['cached_ratio'] = _ratio(cached_tokens, prompt_tokens)
+
+        recent_prompt = sum(prompt for _, _, prompt, _ in self.requests)
+        recent_cached = sum(cached for _, _, _, cached in self.requests)
+        report['recent_cached_ratio'] = '{} (last {} requests)'.format(
+            _ratio(recent_cached, recent_prompt), len(self.requests))
+
+        for model, totals in sorted(self.totals.items()):
+            report[model] = '{} requests, {} hit, {} of {} prompt tokens cached'.format(
+                totals.requests, _ratio(totals.hits, totals.requests), totals.cached_tokens, totals.prompt_tokens)
+        return report
+
+
+def _percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _ratio(part: int, whole: int) -> str:
+    return '{:.1%}'.format(part / whole) if whole else 'n/a'
+
+
+telemetry = Telemetry()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional
+
+ENCODING_NAME = 'o200k_base' # GPT-4o's tokenizer
+# tiktoken downloads its BPE files on first use and caches them in a temp directory,
+# which a fresh dyno doesn't have. Cache them with the app instead; bin/post_compile
+# fills this in at build time.
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'resources', 'tiktoken')
+os.environ.setdefault('TIKTOKEN_CACHE_DIR', CACHE_DIR)
+# Characters per token to estimate with until exact counts have calibrated it
+DEFAULT_CHARS_PER_TOKEN = 4.0
+# Characters of exactly counted text needed before the observed ratio is used
+MIN_CALIBRATION_CHARS = 2000
+
+
+class Tokenizer:
+    """Token counts that never wait on tiktoken.
+
+    The encoding is loaded on a background thread. `estimate` is a character
+    count scaled by the characters per token seen in exact counts so far, and is
+    cheap enough for the event loop. `count_all` gives exact counts on the
+    tokenizer's own thread, for callers that estimate first and reconcile later.
+    """
+
+    def __init__(self, name: str = ENCODING_NAME):
+        self.name = name
+        self.encoding = None
+        self.loading: Optional[Future] = None
+        # One thread is plenty, and it queues counts behind the load
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tokenizer')
+        self.chars = 0
+        self.tokens = 0
+
+    def load(self) -> Future:
+        """Start loading the encoding in the background, unless it's loaded or loading"""
+        if self.loading is None or (self.loading.done() and self.encoding is None):
+            self.loading = self.executor.submit(self._load)
+        return self.loading
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            import tiktoken
+            self.encoding = tiktoken.get_encoding(self.name)
+        except Exception as err:
+            print('Could not load the {} tokenizer, token counts will be estimates: {}'.format(self.name, err))
+            return None
+        print('Loaded the {} tokenizer in {:.2f}s'.format(self.name, time.perf_counter() - start))
+        return self.encoding
+
+    @property
+    def ready(self):
+        return self.encoding is not None
+
+    def chars_per_token(self) -> float:
+        return self.chars / self.tokens if self.chars >= MIN_CALIBRATION_CHARS else DEFAULT_CHARS_PER_TOKEN
+
+    def estimate(self, text: str) -> int:
+        return max(1, round(len(text) / self.chars_per_token())) if text else 0
+
+    def exact(self, text: str) -> Optional[int]:
+        """The exact count, or None if the encoding isn't loaded. Tokenizes on the calling thread."""
+        if self.encoding is None:
+            return None
+        tokens = len(self.encoding.encode(text))
+        self.chars += len(text)
+        self.tokens += tokens
+        return tokens
+
+    def count(self, text: str) -> int:
+        """The exact count if the encoding is loaded, otherwise an estimate"""
+        tokens = self.exact(text)
+        return tokens if tokens is not None else self.estimate(text)
+
+    def count_all(self, texts: List[str]) -> List[Optional[int]]:
+        return [self.exact(text) for text in texts]
+
+    async def count_later(self, texts: List[str]) -> List[Optional[int]]:
+        """Exact counts made on the tokenizer's thread (None for each if it couldn't load)"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.count_all, texts)
+
+
+tokenizer = Tokenizer()
+
+
+if __name__ == '__main__':
+    # Run at build time so the BPE file ships in the slug
+    if tokenizer.load().result() is None:
+        raise SystemExit(1)
+    print('Cached {} in {}'.format(ENCODING_NAME, os.environ['TIKTOKEN_CACHE_DIR']))
@@ -0,0 +1,158 @@
+import inspect
+import os
+import re
+import typing
+from collections import Counter
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+# Only send the tools a turn looks like it needs, instead of all of them every time
+TOOL_PRUNING = os.getenv('TOOL_PRUNING', 'true').lower() == 'true'
+
+JSON_TYPES = {str: 'string', int: 'integer', float: 'number', bool: 'boolean'}
+# Every tool is called with these first, and the model doesn't fill them in
+CONTEXT_PARAMETERS = ('memory', 'message')
+ARGS_HEADER = re.compile(r'^\s*Args:\s*$', re.MULTILINE)
+ARG_LINE = re.compile(r'^\s*(\w+):\s*(.*)$')
+
+
+def _parse_docstring(function: Callable) -> Tuple[str, Dict[str, str]]:
+    """The description and per-argument descriptions from a Google style docstring"""
+    doc = inspect.cleandoc(function.__doc__ or '')
+    parts = ARGS_HEADER.split(doc, maxsplit=1)
+    description = ' '.join(' '.join(paragraph.split()) for paragraph in parts[0].split('\n\n') if paragraph.strip())
+    arguments = {}
+    name = None
+    for line in (parts[1].splitlines() if len(parts) > 1 else ()):
+        match = ARG_LINE.match(line)
+        if match:
+            name = match.group(1)
+            arguments[name] = match.group(2)
+        elif name and line.strip():
+            arguments[name] += ' ' + line.strip()
+    return description, arguments
+
+
+def _parameter_schema(hint, description: Optional[str], choices) -> dict:
+    schema = {}
+    if typing.get_origin(hint) is typing.Literal:
+        choices = choices or list(typing.get_args(hint))
+        hint = type(choices[0])
+    schema['type'] = JSON_TYPES.get(hint, 'string')
+    if description:
+        schema['description'] = description
+    if choices:
+        schema['enum'] = list(choices)
+    return schema
+
+
+def _unwrap_optional(hint):
+    arguments = [argument for argument in typing.get_args(hint) if argument is not type(None)]
+    if typing.get_origin(hint) is typing.Union and len(arguments) == 1:
+        return arguments[0], True
+    return hint, False
+
+
+class Tool:
+    __slots__ = ('name', 'handler', 'schema', 'keywords', 'always')
+
+    def __init__(self, name: str, handler: Callable, schema: dict, keywords: Optional[re.Pattern], always: bool):
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.keywords = keywords
+        self.always = always
+
+    def matches(self, text: str) -> bool:
+        return self.keywords is not None and self.keywords.search(text) is not None
+
+
+class ToolRegistry:
+    """The functions the model can call, registered with the `tool` decorator at import.
+
+    Each tool's JSON schema is built once, when it's registered, from its
+    signature, type hints and docstring: the summary becomes the description and
+    the Args section describes the parameters. `functions` and `calls` are the
+    full schema list and the name -> handler map.
+
+    `select` picks the tools a turn is likely to need by keyword, plus any the
+    conversation called recently so follow-ups like "do it again" still work.
+    Tools come first in the prompt, ahead of MODEL_PROMPT, so every tool that has
+    been sent once is pinned and sent on every later turn in every channel, in
+    registration order. The tool list then only ever grows, changes at most once
+    per tool, and is otherwise the same prefix for every channel for the
+    provider's cache. Each distinct selection is built once and then reused as
+    the same list, so there's no schema work per request.
+    """
+
+    def __init__(self):
+        self.tools: Dict[str, Tool] = {}
+        self.functions: List[dict] = []
+        self.calls: Dict[str, Callable] = {}
+        self._selections: Dict[Tuple[str, ...], List[dict]] = {}
+        # Names of every tool sent so far, in any channel
+        self._pinned: Set[str] = set()
+        self.selected = Counter()
+
+    def tool(self, name: str = None, keywords: Iterable[str] = (), always: bool = False,
+             description: str = None, choices: Dict[str, list] = None):
+        """Register a function as a tool.
+
+        `keywords` are words that make the tool relevant to a turn, and
+        `always` tools are sent on every turn. `description` replaces the docstring
+        summary, and `choices` gives enums for parameters that are only known at
+        import (like the server's emotes).
+        """
+        def register(function: Callable):
+            tool_name = name or function.__name__
+            summary, argument_docs = _parse_docstring(function)
+            hints = typing.get_type_hints(function)
+            properties = {}
+            required = []
+            for parameter in inspect.signature(function).parameters.values():
+                if parameter.name in CONTEXT_PARAMETERS:
+                    continue
+                hint, optional = _unwrap_optional(hints.get(parameter.name, str))
+                properties[parameter.name] = _parameter_schema(
+                    hint, argument_docs.get(parameter.name), (choices or {}).get(parameter.name))
+                if parameter.default is inspect.Parameter.empty and not optional:
+                    required.append(parameter.name)
+
+            parameters = {'type': 'object', 'properties': properties}
+            if required:
+                parameters['required'] = required
+            schema = {
+                'type': 'function',
+                'function': {'name': tool_name, 'description': description or summary, 'parameters': parameters},
+            }
+            pattern = re.compile(r'\b(?:{})\b'.format('|'.join(map(re.escape, keywords))), re.IGNORECASE) if keywords else None
+            self.tools[tool_name] = Tool(tool_name, function, schema, pattern, always)
+            self.functions.append(schema)
+            self.calls[tool_name] = function
+            self._selections.clear()
+            return function
+        return register
+
+    def likely_needed(self, text: str) -> bool:
+        """Whether `text` mentions anything a tool is for"""
+        return any(tool.matches(text) for tool in self.tools.values())
+
+    def select(self, text: str, called: Iterable[str] = ()) -> List[dict]:
+        """Schemas for the tools relevant to `text`, in `called` or already sent on an earlier turn,
+        as a list shared by every turn that picks the same tools"""
+        if not TOOL_PRUNING:
+            return self.functions
+        keep = self._pinned.union(called)
+        names = tuple(name for name, tool in self.tools.items() if tool.always or name in keep or tool.matches(text))
+        self._pinned.update(names)
+        self.selected[len(names)] += 1
+        if names not in self._selections:
+            self._selections[names] = [self.tools[name].schema for name in names]
+        return self._selections[names]
+
+    def summary(self) -> dict:
+        turns = sum(self.selected.values())
+        if not TOOL_PRUNING or not turns:
+            return {'tool_pruning': 'on' if TOOL_PRUNING else 'off'}
+        sent = sum(count * turns_with for count, turns_with in self.selected.items())
+        return {'tool_pruning': '{:.1f} of {} tools sent per turn, {:.0%} of turns sent none'.format(
+            sent / turns, len(self.tools), self.selected[0] / turns)}
@@ -0,0 +1,19 @@
+-- Migration: add conversations
+
+-- Shared GPTMemory state so several bot processes can serve the same channels.
+-- version is bumped on every save and used for optimistic (compare-and-set) writes.
+create table if not exists conversations (
+    channel_id text primary key,
+    version integer not null default 1,
+    payload jsonb not null,
+    created_at timestamp with time zone default now(),
+    updated_at timestamp with time zone default now()
+);
+
+create trigger update_conversations_updated_at
+    before update on conversations
+    for each row
+    execute function update_updated_at_column();
+
+-- Add index for cleaning up stale conversations
+create index if not exists idx_conversations_updated_at on conversations(updated_at);
@@ -0,0 +1,4 @@
+import os
+
+# The API clients are created at import and need a key, though the tests never call them
+os.environ.setdefault('OPENAI_API_KEY', 'test')
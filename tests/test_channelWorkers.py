@@ -0,0 +1,71 @@
+import asyncio
+
+from src.channelWorkers import ChannelWorkers
+
+
+def test_jobs_run_between_batches():
+    events = []
+
+    async def handler(batch):
+        events.append(('start', batch))
+        await asyncio.sleep(0.01)
+        events.append(('end', batch))
+
+    async def run():
+        workers = ChannelWorkers(handler, debounce=0)
+
+        async def job():
+            events.append(('job',))
+            return 'done'
+
+        workers.submit(1, 'first')
+        await asyncio.sleep(0)
+        result = await workers.run(1, job)
+        workers.submit(1, 'second')
+        await asyncio.sleep(0.05)
+        return result
+
+    assert asyncio.run(run()) == 'done'
+    assert events == [('start', ['first']), ('end', ['first']), ('job',), ('start', ['second']), ('end', ['second'])]
+
+
+def test_messages_within_the_debounce_are_one_batch():
+    batches = []
+
+    async def handler(batch):
+        batches.append(batch)
+
+    async def run():
+        workers = ChannelWorkers(handler, debounce=0.05)
+        workers.submit(1, 'a')
+        await asyncio.sleep(0.01)
+        workers.submit(1, 'b')
+        workers.submit(2, 'other channel')
+        await asyncio.sleep(0.02)
+        workers.submit(1, 'c')
+        await asyncio.sleep(0.1)
+        workers.submit(1, 'after the window')
+        await asyncio.sleep(0.1)
+        return workers.stats()
+
+    stats = asyncio.run(run())
+    assert batches == [['a', 'b', 'c'], ['other channel'], ['after the window']]
+    assert stats['batches'] == 3 and stats['coalesced_items'] == 2
+
+
+def test_idle_workers_exit():
+    async def handler(batch):
+        pass
+
+    async def run():
+        workers = ChannelWorkers(handler, idle_timeout=0.05, debounce=0)
+        workers.submit(1, 'hi')
+        await asyncio.sleep(0.01)
+        assert workers.active() == 1
+        await asyncio.sleep(0.1)
+        assert workers.active() == 0 and workers.queues == {}
+        # A new message starts a new worker
+        workers.submit(1, 'back again')
+        assert workers.active() == 1
+
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+from src.utils.circuitBreaker import (CLOSED, COOLDOWN_SECONDS, HALF_OPEN, MIN_REQUESTS, OPEN, SLOW_P95_SECONDS,
+                                      CircuitBreaker)
+
+START = 1000.0
+
+
+def test_closed_open_half_open_closed():
+    breaker = CircuitBreaker('test')
+    for _ in range(MIN_REQUESTS):
+        assert breaker.allow(START)
+        breaker.record(False, 1.0, START)
+    assert breaker.state == OPEN and breaker.times_opened == 1
+    assert not breaker.allow(START + 1)
+
+    # One trial at a time once the cooldown is over
+    later = START + COOLDOWN_SECONDS
+    assert breaker.allow(later) and breaker.state == HALF_OPEN
+    assert not breaker.allow(later + 1)
+    breaker.record(False, 1.0, later + 1)
+    assert breaker.state == OPEN and breaker.times_opened == 2
+
+    later += 1 + COOLDOWN_SECONDS
+    assert breaker.allow(later) and breaker.state == HALF_OPEN
+    breaker.record(True, 1.0, later)
+    assert breaker.state == CLOSED and breaker.allow(later)
+    # The failures from before it opened are forgotten
+    assert breaker.error_rate() == 0
+
+
+def test_slow_requests_open_the_breaker():
+    breaker = CircuitBreaker('test')
+    for _ in range(MIN_REQUESTS):
+        breaker.record(True, SLOW_P95_SECONDS + 1, START)
+    assert breaker.state == OPEN
+
+
+def test_too_few_requests_to_judge():
+    breaker = CircuitBreaker('test')
+    for _ in range(MIN_REQUESTS - 1):
+        breaker.record(False, 1.0, START)
+    assert breaker.state == CLOSED
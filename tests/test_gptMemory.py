@@ -0,0 +1,197 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+from src import gptMemory
+from src.database.conversation_store import ConversationStore, SQLiteConversationStore
+from src.gptMemory import GPTMemory
+
+
+def tool_turn(memory, channel_id=1):
+    memory.append(channel_id, 'draw a frog', author='someone')
+    memory.append(channel_id, '', role='assistant', tool_calls=[('call_1', 'generate_image', '{"prompt": "frog"}')])
+    memory.append(channel_id, 'done', role='tool', name='generate_image', tool_call_id='call_1')
+    memory.append(channel_id, 'here is your frog', role='assistant')
+
+
+def test_sike_removes_tool_calls_with_their_reply():
+    memory = GPTMemory()
+    memory.append(1, 'hi', author='someone')
+    memory.append(1, 'what', role='assistant')
+    tool_turn(memory)
+
+    memory.sike(1)
+
+    assert [message['content'] for message in memory.get_messages(1)[1:]] == ['someone: """hi"""', 'what']
+
+
+def test_unanswered_tool_calls_are_not_rendered():
+    memory = GPTMemory()
+    memory.append(1, 'draw a frog', author='someone')
+    memory.append(1, '', role='assistant', tool_calls=[('call_1', 'generate_image', '{}'), ('call_2', 'use_emote', '{}')])
+    memory.append(1, 'done', role='tool', name='generate_image', tool_call_id='call_1')
+    memory.append(1, 'anyway', author='someone')
+
+    messages = memory.get_messages(1)[1:]
+    assert [message['role'] for message in messages] == ['user', 'user']
+    assert 'called generate_image' not in str(memory.get_messages(1, type='mistral'))
+
+
+def test_load_picks_up_newer_stored_versions():
+    store = SQLiteConversationStore()
+    first, second = GPTMemory(), GPTMemory()
+    first.store = second.store = store
+
+    async def run():
+        first.append(1, 'from the first shard', author='someone')
+        await first.flush(1)
+        await second.load(1)
+        first.append(1, 'first shard again', author='someone')
+        await first.flush(1)
+        second.append(1, 'from the second shard', author='someone')
+        await second.load(1)
+        return [message['content'] for message in second.get_messages(1)[1:]]
+
+    assert asyncio.run(run()) == [
+        'someone: """from the first shard"""',
+        'someone: """first shard again"""',
+        'someone: """from the second shard"""',
+    ]
+
+
+def test_incomplete_store_fails_on_construction():
+    class LoadOnly(ConversationStore):
+        def load(self, channel_id, newer_than=0):
+            return None
+
+    with pytest.raises(TypeError):
+        LoadOnly()
+
+
+def test_trimmed_entries_wait_for_a_summary(monkeypatch):
+    monkeypatch.setattr(gptMemory, 'COMPACTION_ENABLED', True)
+    monkeypatch.setattr(gptMemory, 'COMPACTION_TOKEN_LIMIT', gptMemory.prompts_tokens + 20)
+    monkeypatch.setattr(gptMemory, 'COMPACTION_BATCH_TOKENS', 10 ** 6)
+    summaries = [RuntimeError('rate limited'), 'they talked about frogs']
+
+    async def summarizer(previous, transcript):
+        result = summaries.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    memory = GPTMemory()
+    memory.summarizer = summarizer
+
+    async def run():
+        for text in ('frogs are great', 'they really are', 'green ones especially'):
+            memory.append(1, text, author='someone')
+        conversation = memory.conversations[1]
+        queued = len(conversation.unsummarized)
+        await memory._compact(1, conversation)
+        assert len(conversation.unsummarized) == queued > 0
+        await memory._compact(1, conversation)
+        assert conversation.unsummarized == [] and conversation.summary == 'they talked about frogs'
+        return conversation
+
+    conversation = asyncio.run(run())
+    assert memory.bytes_held == conversation.bytes
+    assert conversation.bytes == sum(gptMemory._entry_size(entry) for entry in conversation.history) \
+        + sys.getsizeof(conversation.summary)
+
+
+def test_budget_keeps_unsaved_conversations(monkeypatch):
+    monkeypatch.setattr(gptMemory, 'MAX_CONVERSATIONS', 1)
+    memory = GPTMemory()
+    memory.store = SQLiteConversationStore()
+
+    async def run():
+        memory.append(1, 'not saved yet', author='someone')
+        memory.append(2, 'hi', author='someone')
+        assert memory.has_conversation(1)
+        await memory.flush(1)
+        await memory.flush(2)
+        memory.append(3, 'hi', author='someone')
+        assert not memory.has_conversation(1)
+
+    asyncio.run(run())
+
+
+def test_cleared_history_stays_cleared():
+    memory = GPTMemory()
+    memory.store = SQLiteConversationStore()
+
+    async def run():
+        memory.append(1, 'forget this', author='someone')
+        await memory.flush(1)
+        await memory.clear(1)
+        await memory.load(1)
+        return memory.has_conversation(1)
+
+    assert not asyncio.run(run())
+
+
+def test_prompt_kept_in_step_with_history(monkeypatch):
+    monkeypatch.setattr(gptMemory, 'TOKEN_LIMIT', gptMemory.prompts_tokens + 60)
+    memory = GPTMemory()
+
+    def from_scratch():
+        conversation = memory.conversations[1]
+        summary = [{'role': 'system', 'content': gptMemory.SUMMARY_PREFIX + conversation.summary}] if conversation.summary else []
+        return [gptMemory.MODEL_PROMPT, *summary,
+                *[gptMemory._chatGPT_message(entry) for entry in gptMemory._answered(conversation.history)]]
+
+    for turn in range(6):
+        memory.append(1, 'message number {}'.format(turn), author='someone')
+        assert memory.get_messages(1) == from_scratch()
+    memory.conversations[1].set_summary('they counted', 3)
+    tool_turn(memory)
+    assert memory.get_messages(1) == from_scratch()
+    memory.append(1, '', role='assistant', tool_calls=[('call_2', 'use_emote', '{}')])
+    assert memory.get_messages(1) == from_scratch()
+    memory.sike(1)
+    assert memory.get_messages(1) == from_scratch()
+
+
+def test_mistral_view_kept_in_step_with_history(monkeypatch):
+    monkeypatch.setattr(gptMemory, 'TOKEN_LIMIT', gptMemory.prompts_tokens + 60)
+    memory = GPTMemory()
+
+    def from_scratch():
+        conversation = memory.conversations[1]
+        view = gptMemory.MistralView()
+        for entry in gptMemory._answered(conversation.history):
+            view.push(entry)
+        return view.messages(conversation.summary)
+
+    for turn in range(6):
+        memory.append(1, 'message number {}'.format(turn), author='someone')
+        memory.append(1, 'reply {}'.format(turn), role='assistant')
+        memory.append(1, 'another reply {}'.format(turn), role='assistant')
+        assert memory.get_messages(1, type='mistral') == from_scratch()
+    memory.conversations[1].set_summary('they counted', 3)
+    assert memory.get_messages(1, type='mistral') == from_scratch()
+    tool_turn(memory)
+    memory.sike(1)
+    assert memory.get_messages(1, type='mistral') == from_scratch()
+
+
+def test_idle_conversations_freeze_and_thaw_intact():
+    memory = GPTMemory()
+    tool_turn(memory)
+    memory.conversations[1].set_summary('they talked about frogs', 6)
+    before = memory.get_messages(1)
+    resident = memory.bytes_held
+    conversation_bytes = memory.conversations[1].bytes
+
+    assert memory._freeze_idle(time.time() + gptMemory.COLD_AFTER) == 1
+    assert isinstance(memory.conversations[1], gptMemory.ColdConversation)
+    assert memory.bytes_held < resident
+
+    assert memory.get_messages(1) == before
+    conversation = memory.conversations[1]
+    assert isinstance(conversation, gptMemory.Conversation)
+    assert conversation.summary == 'they talked about frogs' and conversation.summary_tokens == 6
+    assert conversation.bytes == conversation_bytes and memory.bytes_held == resident
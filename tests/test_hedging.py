@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from src import chatGPT
+from src.utils import hedging
+from src.utils.circuitBreaker import CLOSED, HALF_OPEN, OPEN, get_breaker
+from src.utils.hedging import Hedger
+
+
+def test_losing_request_is_cancelled(monkeypatch):
+    monkeypatch.setattr(hedging, 'DEFAULT_DELAY', 0.01)
+    cancelled = []
+
+    def request(name, seconds):
+        async def send():
+            try:
+                await asyncio.sleep(seconds)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+            return name
+        return send
+
+    async def run(primary_seconds, backup_seconds):
+        hedger = Hedger('test')
+        result = await hedger.run(request('primary', primary_seconds), request('backup', backup_seconds))
+        await asyncio.sleep(0.01)
+        return result, hedger
+
+    result, hedger = asyncio.run(run(10, 0.01))
+    assert result == 'backup' and cancelled == ['primary']
+    assert hedger.hedged == 1 and hedger.backup_wins == 1
+
+    cancelled.clear()
+    result, hedger = asyncio.run(run(0.02, 10))
+    assert result == 'primary' and cancelled == ['backup']
+    assert hedger.hedged == 1 and hedger.backup_wins == 0
+
+
+@pytest.mark.parametrize('state, hedged', [(CLOSED, True), (OPEN, False), (HALF_OPEN, False)])
+def test_no_hedge_unless_the_primary_breaker_is_closed(monkeypatch, state, hedged):
+    monkeypatch.setattr(chatGPT, 'HEDGING_ENABLED', True)
+    monkeypatch.setattr(hedging, 'DEFAULT_DELAY', 0.01)
+    model = 'hedge-test-{}'.format(state)
+    monkeypatch.setattr(get_breaker(chatGPT.PROVIDER, model), 'state', state)
+    sent = []
+
+    async def create(model, tokens=None, **kwargs):
+        sent.append(model)
+        await asyncio.sleep(0.05)
+        return model
+
+    monkeypatch.setattr(chatGPT, 'create', create)
+    asyncio.run(chatGPT.create_hedged(model, messages=[]))
+    assert len(sent) == (2 if hedged else 1)
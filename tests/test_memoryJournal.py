@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+import pytest
+
+from src import gptMemory
+from src.database.memory_journal import MemoryJournal
+from src.gptMemory import GPTMemory
+
+
+def restored(directory):
+    memory = GPTMemory()
+    MemoryJournal(directory).restore(memory)
+    return memory
+
+
+def test_restore_keeps_the_idle_time(tmp_path, monkeypatch):
+    memory = restored(tmp_path)
+    memory.append(1, 'hi', author='someone')
+    last_message = memory.conversations[1].last_message
+    memory.journal.close()
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 1200)
+    assert restored(tmp_path).conversations[1].last_message == pytest.approx(last_message, abs=1)
+
+
+def test_restore_drops_entries_a_summary_covered(tmp_path, monkeypatch):
+    monkeypatch.setattr(gptMemory, 'COMPACTION_ENABLED', True)
+    monkeypatch.setattr(gptMemory, 'COMPACTION_TOKEN_LIMIT', gptMemory.prompts_tokens + 20)
+    monkeypatch.setattr(gptMemory, 'COMPACTION_BATCH_TOKENS', 10 ** 6)
+
+    async def summarizer(previous, transcript):
+        return 'they talked about frogs'
+
+    memory = restored(tmp_path)
+    memory.summarizer = summarizer
+    for text in ('frogs are great', 'they really are', 'green ones especially'):
+        memory.append(1, text, author='someone')
+    asyncio.run(memory._compact(1, memory.conversations[1]))
+    memory.append(1, 'and toads', author='someone')
+    queued = [entry.content for entry in memory.conversations[1].unsummarized]
+    memory.journal.close()
+
+    again = GPTMemory()
+    again.summarizer = summarizer
+    MemoryJournal(tmp_path).restore(again)
+    conversation = again.conversations[1]
+    assert conversation.summary == 'they talked about frogs'
+    assert [entry.content for entry in conversation.unsummarized] == queued
@@ -0,0 +1,65 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+import httpx
+import pytest
+
+from src.utils.rateLimits import DEFAULT_RETRY_AFTER, Priority, RateLimiter, TokenBucket, retry_after
+
+
+def test_bucket_refills_evenly_up_to_a_minutes_worth():
+    bucket = TokenBucket(60)
+    bucket.updated = 0.0
+    bucket.take(60, 0.0)
+    assert bucket.delay(1, 0.0) == pytest.approx(1.0)
+    assert bucket.delay(1, 30.0) == 0
+    assert bucket.level == pytest.approx(30)
+    assert bucket.delay(1, 1000.0) == 0 and bucket.level == 60
+    # Bigger than the bucket only waits for a full one
+    bucket.take(60, 1000.0)
+    assert bucket.delay(500, 1000.0) == pytest.approx(60.0)
+
+
+def test_interactive_requests_overtake_waiting_background_ones():
+    admitted = []
+
+    async def request(limiter, name, priority):
+        await limiter.acquire(1, priority)
+        admitted.append(name)
+
+    async def run():
+        limiter = RateLimiter('test')
+        limiter.back_off(0.05)
+        waiting = [asyncio.create_task(request(limiter, 'summary', Priority.BACKGROUND))]
+        await asyncio.sleep(0.01)
+        waiting.append(asyncio.create_task(request(limiter, 'reply', Priority.INTERACTIVE)))
+        await asyncio.gather(*waiting)
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert admitted == ['reply', 'summary']
+    assert limiter.admitted == 2 and limiter.delayed == 2
+
+
+@pytest.mark.parametrize('headers, seconds', [
+    ({'retry-after-ms': '1500'}, 1.5),
+    ({'retry-after': '3'}, 3.0),
+    ({'retry-after': 'soon'}, DEFAULT_RETRY_AFTER),
+    ({}, DEFAULT_RETRY_AFTER),
+])
+def test_retry_after(headers, seconds):
+    assert retry_after(httpx.Headers(headers)) == seconds
+
+
+def test_retry_after_date():
+    assert retry_after(httpx.Headers({'retry-after': formatdate(time.time() + 30, usegmt=True)})) == pytest.approx(30, abs=2)
+
+
+def test_429_pauses_every_request():
+    limiter = RateLimiter('test')
+    asyncio.run(limiter.on_response(httpx.Response(429, headers={'retry-after': '4'})))
+    assert limiter.throttled == 1
+    assert limiter._delay(1, time.monotonic()) == pytest.approx(4, abs=0.5)
+    asyncio.run(limiter.on_response(httpx.Response(200)))
+    assert limiter.throttled == 1
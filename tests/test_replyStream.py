@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import replyStream
+from src.chatGPT import reply_cleanup
+from src.replyStream import DISCORD_MESSAGE_LIMIT, FIRST_CHUNK_CHARS, ReplyStream, _stable_text
+from src.utils.emotes import emotes
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+class Channel:
+    """Records what a reply sends and each edit made to it"""
+
+    def __init__(self):
+        self.posts = []
+
+    async def send(self, text):
+        self.posts.append([text])
+        return SimpleNamespace(edit=self.edit, delete=self.delete)
+
+    async def edit(self, content=None):
+        self.posts[-1].append(content)
+
+    async def delete(self):
+        self.posts[-1].append(None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(replyStream, 'time', clock)
+    return clock
+
+
+def test_edits_are_throttled(clock):
+    channel = Channel()
+    reply = ReplyStream(channel.send, reply_cleanup, 'test')
+
+    async def run():
+        await reply.feed('a' * (FIRST_CHUNK_CHARS - 1))
+        assert channel.posts == []
+        await reply.feed('b')
+        assert len(channel.posts) == 1
+        for _ in range(5):
+            await reply.feed(' more')
+        # Still inside the edit interval, so only the first post so far
+        assert channel.posts[0] == ['a' * (FIRST_CHUNK_CHARS - 1) + 'b']
+        clock.now += replyStream.EDIT_INTERVAL
+        await reply.feed(' done')
+        assert len(channel.posts[0]) == 2
+        return await reply.finish()
+
+    final = asyncio.run(run())
+    assert channel.posts[0][-1] == final
+    assert len(channel.posts) == 1
+
+
+@pytest.mark.parametrize('partial, stable', [
+    ('compubot', ''),
+    ('compubot: ', ''),
+    ('hey {use_emo', 'hey '),
+    ('hey {use_emote: KEKW} and <use_emote: Po', 'hey {use_emote: KEKW} and '),
+    ('that is {caps}so', 'that is '),
+    ('that is {caps}so{/caps} true', 'that is {caps}so{/caps} true'),
+])
+def test_stable_text_holds_back_what_filters_could_change(partial, stable):
+    assert _stable_text(partial) == stable
+
+
+def test_placeholders_split_across_deltas_never_show_half_done(clock):
+    channel = Channel()
+    reply = ReplyStream(channel.send, reply_cleanup, 'test')
+    emote = next(iter(emotes.get_all_emotes()))
+    text = 'compubot: ' + 'x' * FIRST_CHUNK_CHARS + ' {use_emote: ' + emote + '} {caps}loud{/caps}'
+
+    async def run():
+        for start in range(0, len(text), 3):
+            await reply.feed(text[start:start + 3])
+            clock.now += replyStream.EDIT_INTERVAL
+        return await reply.finish()
+
+    final = asyncio.run(run())
+    for shown in channel.posts[0]:
+        assert 'compubot' not in shown and '{' not in shown and '<use' not in shown
+    assert final.endswith(emotes.get_emote(emote) + ' loud')
+    assert channel.posts[0][-1] == final
+
+
+def test_replies_are_cut_at_the_discord_limit(clock):
+    channel = Channel()
+    reply = ReplyStream(channel.send, reply_cleanup, 'test')
+
+    async def run():
+        await reply.feed('y' * (DISCORD_MESSAGE_LIMIT + 500))
+        return await reply.finish()
+
+    assert len(asyncio.run(run())) == DISCORD_MESSAGE_LIMIT
+    assert all(len(shown) <= DISCORD_MESSAGE_LIMIT for shown in channel.posts[0])
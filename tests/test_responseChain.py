@@ -0,0 +1,109 @@
+import asyncio
+import importlib.util
+import os
+import threading
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from openai import AsyncOpenAI
+
+from src import chatGPT, functionDefinitions, responseChain
+from src.gptMemory import GPTMemory
+
+STUB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', 'stub_openai.py')
+spec = importlib.util.spec_from_file_location('stub_openai', STUB_PATH)
+stub_openai = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(stub_openai)
+
+
+class Typing:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeMessage:
+    def __init__(self):
+        self.channel = SimpleNamespace(id=1, type=0, typing=Typing())
+        self.sent = []
+
+    async def reply(self, text):
+        self.sent.append(text)
+        return SimpleNamespace(edit=self.edit, delete=self.edit)
+
+    async def edit(self, content=None):
+        self.sent.append(content)
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """The stub OpenAI API on a free port, with chatGPT's client pointed at it"""
+    monkeypatch.setattr(stub_openai.StubHandler, 'responses_enabled', True)
+    monkeypatch.setattr(stub_openai.StubHandler, 'forget', False)
+    server = ThreadingHTTPServer(('localhost', 0), stub_openai.StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = AsyncOpenAI(api_key='test', base_url='http://localhost:{}/v1'.format(server.server_address[1]))
+    monkeypatch.setattr(chatGPT, 'client', client)
+    monkeypatch.setattr(responseChain, 'RESPONSE_CHAINING', True)
+    chain = responseChain.ChainStats()
+    monkeypatch.setattr(responseChain, 'chain', chain)
+    monkeypatch.setattr(chatGPT, 'chain', chain)
+
+    async def channel_info(memory, message):
+        return 'tool says hi'
+
+    monkeypatch.setitem(functionDefinitions.FUNCTION_CALLS, 'channel_info', channel_info)
+    yield stub_openai.StubHandler, chain
+    server.shutdown()
+    server.server_close()
+
+
+def tool_turn(streaming, monkeypatch):
+    """Reply to a message that has the stub call a tool, returning what was posted and the memory"""
+    monkeypatch.setattr(chatGPT, 'STREAMING_ENABLED', streaming)
+    memory = GPTMemory()
+    for number in range(6):
+        memory.append(1, 'message number {}'.format(number), author='someone')
+    memory.append(1, 'please use channel_info for this channel', author='someone')
+    message = FakeMessage()
+    asyncio.run(chatGPT.respondWithChatGPT(memory, message, []))
+    return message.sent[-1], memory
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_follow_up_chains_from_the_stored_response(stub, monkeypatch, streaming):
+    _, chain = stub
+    sent, memory = tool_turn(streaming, monkeypatch)
+
+    assert chain.chained == 1 and chain.resent == 0
+    assert chain.items_saved > 0
+    assert sent.startswith('stub reply to ')
+    assert [message['role'] for message in memory.get_messages(1)[-3:]] == ['assistant', 'tool', 'assistant']
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_no_responses_api_falls_back_to_chat_completions(stub, monkeypatch, streaming):
+    handler, chain = stub
+    monkeypatch.setattr(handler, 'responses_enabled', False)
+    sent, memory = tool_turn(streaming, monkeypatch)
+
+    assert not chain.supported and not responseChain.chaining_enabled()
+    assert chain.chained == 0 and chain.resent == 1
+    assert sent.startswith('stub reply to ')
+    assert memory.get_messages(1)[-2]['content'] == 'tool says hi'
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_forgotten_response_resends_the_history(stub, monkeypatch, streaming):
+    handler, chain = stub
+    monkeypatch.setattr(handler, 'forget', True)
+    sent, memory = tool_turn(streaming, monkeypatch)
+
+    # The first request still went through /responses, only the follow-up had to resend
+    assert chain.supported
+    assert chain.chained == 0 and chain.resent == 1
+    assert sent.startswith('stub reply to ')
+    assert memory.get_messages(1)[-2]['content'] == 'tool says hi'
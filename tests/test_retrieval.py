@@ -0,0 +1,64 @@
+import asyncio
+import sys
+
+import numpy as np
+import pytest
+
+from src.utils import retrieval
+from src.utils.retrieval import ChannelIndex, RetrievalIndex, embed
+
+MESSAGES = [
+    'jackson: the minecraft server is down again',
+    'colin: who wants pizza tonight',
+    'kobe: my cat knocked over the plant',
+    'jacob: rocket league later?',
+]
+
+
+def test_embeddings_are_normalized_and_stable():
+    vector = embed('The Minecraft server is DOWN')
+    assert vector.shape == (retrieval.FEATURE_DIM,)
+    assert np.linalg.norm(vector) == pytest.approx(1)
+    assert np.array_equal(vector, embed('the minecraft server is down'))
+    assert not embed('...').any()
+
+
+def test_search_finds_related_messages():
+    index = ChannelIndex()
+    for text in MESSAGES:
+        index.add(text)
+    assert index.search(embed('is the minecraft server up'), 1) == [MESSAGES[0]]
+    assert index.search(embed('zzzz qqqq'), 4) == []
+
+
+def test_channels_keep_only_their_newest_messages(monkeypatch):
+    monkeypatch.setattr(retrieval, 'MAX_MESSAGES_PER_CHANNEL', 100)
+    index = ChannelIndex()
+    for number in range(250):
+        index.add('message {}'.format(number))
+    assert index.count == 100 and len(index.texts) == 100
+    assert set(index.texts) == {'message {}'.format(number) for number in range(150, 250)}
+    assert index.text_bytes == sum(map(sys.getsizeof, index.texts))
+
+
+def test_index_drops_the_quietest_channel_past_its_byte_cap(monkeypatch):
+    channel_bytes = ChannelIndex().bytes
+    monkeypatch.setattr(retrieval, 'MAX_INDEX_BYTES', channel_bytes * 2 + 1000)
+    index = RetrievalIndex()
+
+    async def run():
+        index.add(1, MESSAGES[0])
+        index.add(2, MESSAGES[1])
+        index.add(1, MESSAGES[2])
+        index.add(3, MESSAGES[3])
+        return await index.search(1, 'cat plant'), await index.search(2, 'pizza tonight')
+
+    found, evicted = asyncio.run(run())
+    assert found == [MESSAGES[2]] and evicted == []
+    assert list(index.channels) == [1, 3]
+    assert index.stats()['retrieval_evicted'] == 1
+    assert index.bytes == sum(channel.bytes for channel in index.channels.values())
+
+    index.drop(1)
+    index.executor.submit(lambda: None).result()
+    assert list(index.channels) == [3] and index.bytes == index.channels[3].bytes
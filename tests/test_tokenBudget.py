@@ -0,0 +1,18 @@
+from src.gptMemory import GPTMemory
+from src.tokenBudget import TokenBudget
+from src.utils.tokenizer import tokenizer
+
+
+def test_fit_never_tokenizes_on_the_event_loop(monkeypatch):
+    memory = GPTMemory()
+    for index in range(20):
+        memory.append(1, 'message number {}'.format(index), author='someone')
+    messages = memory.get_messages(1)
+    messages.insert(len(messages) - 1, {'role': 'system', 'content': 'retrieved context'})
+
+    tokenized = []
+    monkeypatch.setattr(tokenizer, 'exact', lambda text: tokenized.append(text) or len(text) // 4)
+    _, tokens = TokenBudget().fit('gpt-4o-mini', messages)
+
+    assert tokenized == []
+    assert tokens > memory.prompt_tokens(1)
@@ -0,0 +1,78 @@
+from typing import Literal, Optional
+
+from src.utils import toolRegistry
+from src.utils.toolRegistry import ToolRegistry
+
+
+def names(selected):
+    return [tool['function']['name'] for tool in selected]
+
+
+def registry():
+    registry = ToolRegistry()
+
+    @registry.tool(keywords=('weather', 'rain'))
+    def forecast(memory, message, city: str, days: int = 1, units: Literal['c', 'f'] = 'c', note: Optional[str] = None):
+        """Get the forecast
+        for a city.
+
+        Args:
+            city: The city to look up
+            days: How many days
+                ahead to forecast
+        """
+
+    @registry.tool(name='roll', keywords=('dice',), description='Roll some dice', choices={'sides': [6, 20]})
+    async def roll_dice(memory, message, sides: int):
+        """Not used, the description replaces it"""
+
+    @registry.tool(always=True)
+    def whoami(memory, message):
+        """Who the bot is"""
+
+    return registry
+
+
+def test_schema_comes_from_the_signature_and_docstring():
+    tools = registry()
+    forecast, roll, whoami = tools.functions
+
+    assert forecast['function']['description'] == 'Get the forecast for a city.'
+    parameters = forecast['function']['parameters']
+    assert parameters['required'] == ['city']
+    assert parameters['properties'] == {
+        'city': {'type': 'string', 'description': 'The city to look up'},
+        'days': {'type': 'integer', 'description': 'How many days ahead to forecast'},
+        'units': {'type': 'string', 'enum': ['c', 'f']},
+        'note': {'type': 'string'},
+    }
+    assert roll['function']['name'] == 'roll' and roll['function']['description'] == 'Roll some dice'
+    assert roll['function']['parameters']['properties']['sides'] == {'type': 'integer', 'enum': [6, 20]}
+    # memory and message are filled in by call_tool, not the model
+    assert whoami['function']['parameters'] == {'type': 'object', 'properties': {}}
+    assert set(tools.calls) == {'forecast', 'roll', 'whoami'}
+
+
+def test_pruning_keeps_always_matched_and_called_tools():
+    assert names(registry().select('hello')) == ['whoami']
+    assert names(registry().select('will it RAIN tomorrow')) == ['forecast', 'whoami']
+    assert names(registry().select('rainy days')) == ['whoami']
+    assert names(registry().select('hello', called=['roll'])) == ['roll', 'whoami']
+    tools = registry()
+    assert tools.likely_needed('roll the dice') and not tools.likely_needed('hello')
+
+
+def test_sent_tools_stay_pinned_in_registration_order():
+    tools = registry()
+    weather = tools.select('weather?')
+    assert names(weather) == ['forecast', 'whoami']
+    assert tools.select('ok') is weather
+    # Pins only grow, in registration order whatever order they were picked in
+    assert names(tools.select('dice')) == ['forecast', 'roll', 'whoami']
+    assert names(tools.select('ok')) == ['forecast', 'roll', 'whoami']
+
+
+def test_pruning_off_sends_everything(monkeypatch):
+    monkeypatch.setattr(toolRegistry, 'TOOL_PRUNING', False)
+    tools = registry()
+    assert tools.select('hello') is tools.functions
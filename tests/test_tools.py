@@ -0,0 +1,79 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src import functionDefinitions
+from src.functionDefinitions import FUNCTIONS, tools, tools_for
+from src.gptMemory import GPTMemory
+from src.utils.deadline import DeadlineExceeded
+from src.utils.emotes import emotes
+
+
+def tool_names(selected):
+    return [tool['function']['name'] for tool in selected]
+
+
+@pytest.fixture(autouse=True)
+def unpinned_tools(monkeypatch):
+    monkeypatch.setattr(tools, '_pinned', set())
+
+
+def test_plain_chat_still_gets_emote_names():
+    memory = GPTMemory()
+    memory.append(1, 'how was your day', author='someone')
+    messages = memory.get_messages(1)
+
+    assert tool_names(tools_for(messages)) == []
+    prompt = messages[0]['content']
+    for name in emotes.get_all_emotes():
+        assert name in prompt
+
+
+def test_keywords_match_whole_words():
+    for text in ('grabbing mcdonalds', 'pick one', 'that did no dmg', 'generally fine', 'serverless'):
+        assert tools.select(text) == []
+    assert tool_names(tools.select('is the minecraft server up')) == ['minecraft_server', 'channel_info']
+    tools._pinned.clear()
+    assert tool_names(tools.select('draw me a cat')) == ['generate_image']
+
+
+def test_selection_is_pinned_for_every_channel():
+    first = tools_for([{'role': 'user', 'content': 'draw a frog'}])
+    later = tools_for([{'role': 'user', 'content': 'lol'}])
+    assert later is first
+    assert tool_names(tools_for([{'role': 'user', 'content': 'players online?'}])) == [
+        'minecraft_server', 'generate_image']
+
+
+def test_schemas_are_generated_once():
+    assert tools.select('draw') is tools.select('paint')
+    assert [tool['function']['name'] for tool in FUNCTIONS] == ['minecraft_server', 'channel_info', 'generate_image', 'use_emote']
+    assert FUNCTIONS[0]['function']['parameters']['required'] == ['ip']
+
+
+def test_tools_still_running_are_cancelled_when_the_turn_gives_up(monkeypatch):
+    cancelled = []
+
+    async def slow(memory, message):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append('slow')
+            raise
+
+    async def out_of_time(memory, message):
+        raise DeadlineExceeded()
+
+    monkeypatch.setitem(functionDefinitions.FUNCTION_CALLS, 'slow', slow)
+    monkeypatch.setitem(functionDefinitions.FUNCTION_CALLS, 'out_of_time', out_of_time)
+    calls = [SimpleNamespace(id=name, function=SimpleNamespace(name=name, arguments='{}')) for name in ('slow', 'out_of_time')]
+
+    async def run():
+        with pytest.raises(DeadlineExceeded):
+            await functionDefinitions.call_tools(None, None, calls)
+        await asyncio.sleep(0.01)
+        # Checked before asyncio.run cancels whatever is left over
+        assert cancelled == ['slow']
+
+    asyncio.run(run())